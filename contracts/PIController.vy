@@ -1,484 +1,110 @@
 #pragma version >0.3.10
 
+import pi_math
+
 authorities: public(HashMap[address, uint256])
 
 
+# in storage rather than immutable, so clones created by PIControllerFactory.vy each have their own
 control_variable: public(bytes32)
 kp: public(int256)
 ki: public(int256)
 co_bias: public(int256)
-output_upper_bound: public(int256)
-output_lower_bound: public(int256)
+# output_upper_bound (high 128 bits) and output_lower_bound (low 128 bits), both int128
+output_bounds: uint256
 error_integral: public(int256)
 last_error: public(int256)
-per_second_integral_leak: public(uint256)
-last_output: public(int256)
+# per_second_integral_leak (low 96 bits), leak_cadence (next 32 bits) and the cached
+# rpower(per_second_integral_leak, leak_cadence, RAY) (high 128 bits)
+leak_and_cache: uint256
+# last_output (high 128 bits, int128), the ring of observations (bits 64-111, see
+# pi_math.RING_SHIFT) and last_update_time (low 64 bits)
+last_output_and_time: uint256
 last_p_output: public(int256)
 last_i_output: public(int256)
-last_update_time: public(uint256)
 
-updater: public(address)
+# updater (low 160 bits) and output_deadband (high 96 bits), both read by update()
+updater_and_deadband: uint256
 
-TWENTY_SEVEN_DECIMAL_NUMBER: constant(uint256) = 10 ** 27
-EIGHTEEN_DECIMAL_NUMBER: constant(int256) = 10**18
-RAY: public(constant(uint256)) = 10 ** 27
+# The last observation_cardinality updates, for windowed averages
+observations: pi_math.Observation[pi_math.MAX_OBSERVATIONS]
 
-@external
-@view
-def my_exp_uint256_external(x: uint256, n: uint256, b: uint256) -> uint256:  
-    y: uint256 = n
-    w: uint256 = x
-    z: uint256 = 0
-    
-    if x == 0:
-        if n == 0:
-            z = b
-            
-    if n % 2 == 0:
-        z = b
-    else:
-        z = x
-    half: uint256 = b//2
-    zx: uint256 = 0
-    xxRound: uint256 = 0
-    zxRound: uint256 = 0
-    xx: uint256 = 0
-
-    #1
-    y = y//2
-    xx = w * w
-    if xx//w != w:
-        raise "0,0"
-    xxRound = xx + half
-    if xxRound < xx:
-        raise "0,0"
-    w = xxRound//b
-    if y % 2 > 0:
-        zx = z * w
-        if (w != 0 and (z*w)//w != z):
-            raise "0,0"
-        zxRound = zx + half
-        if zxRound < zx:
-            raise "0,0"
-        z = zxRound //b
-    #2
-    y = y//2
-    xx = w * w
-    if xx//w != w:
-        raise "0,0"
-    xxRound = xx + half
-    if xxRound < xx:
-        raise "0,0"
-    w = xxRound//b
-    if y % 2 > 0:
-        zx = z * w
-        if (w != 0 and (z*w)//w != z):
-            raise "0,0"
-        zxRound = zx + half
-        if zxRound < zx:
-            raise "0,0"
-        z = zxRound //b
-    #3
-    y = y//2
-    xx = w * w
-    if xx//w != w:
-        raise "0,0"
-    xxRound = xx + half
-    if xxRound < xx:
-        raise "0,0"
-    w = xxRound//b
-    if y % 2 > 0:
-        zx = z * w
-        if (w != 0 and (z*w)//w != z):
-            raise "0,0"
-        zxRound = zx + half
-        if zxRound < zx:
-            raise "0,0"
-        z = zxRound //b
-    #4
-    y = y//2
-    xx = w * w
-    if xx//w != w:
-        raise "0,0"
-    xxRound = xx + half
-    if xxRound < xx:
-        raise "0,0"
-    w = xxRound//b
-    if y % 2 > 0:
-        zx = z * w
-        if (w != 0 and (z*w)//w != z):
-            raise "0,0"
-        zxRound = zx + half
-        if zxRound < zx:
-            raise "0,0"
-        z = zxRound //b
-    #5
-    y = y//2
-    xx = w * w
-    if xx//w != w:
-        raise "0,0"
-    xxRound = xx + half
-    if xxRound < xx:
-        raise "0,0"
-    w = xxRound//b
-    if y % 2 > 0:
-        zx = z * w
-        if (w != 0 and (z*w)//w != z):
-            raise "0,0"
-        zxRound = zx + half
-        if zxRound < zx:
-            raise "0,0"
-        z = zxRound //b
-    #6
-    y = y//2
-    xx = w * w
-    if xx//w != w:
-        raise "0,0"
-    xxRound = xx + half
-    if xxRound < xx:
-        raise "0,0"
-    w = xxRound//b
-    if y % 2 > 0:
-        zx = z * w
-        if (w != 0 and (z*w)//w != z):
-            raise "0,0"
-        zxRound = zx + half
-        if zxRound < zx:
-            raise "0,0"
-        z = zxRound //b
-    #7
-    y = y//2
-    xx = w * w
-    if xx//w != w:
-        raise "0,0"
-    xxRound = xx + half
-    if xxRound < xx:
-        raise "0,0"
-    w = xxRound//b
-    if y % 2 > 0:
-        zx = z * w
-        if (w != 0 and (z*w)//w != z):
-            raise "0,0"
-        zxRound = zx + half
-        if zxRound < zx:
-            raise "0,0"
-        z = zxRound //b
-    #8
-    y = y//2
-    xx = w * w
-    if xx//w != w:
-        raise "0,0"
-    xxRound = xx + half
-    if xxRound < xx:
-        raise "0,0"
-    w = xxRound//b
-    if y % 2 > 0:
-        zx = z * w
-        if (w != 0 and (z*w)//w != z):
-            raise "0,0"
-        zxRound = zx + half
-        if zxRound < zx:
-            raise "0,0"
-        z = zxRound //b
-        
-    return z    
-#
-@internal
-@view
-def my_exp_uint256(x: uint256, n: uint256, b: uint256) -> uint256:  
-    y: uint256 = n
-    w: uint256 = x
-    z: uint256 = 0
-    
-    if x == 0:
-        if n == 0:
-            z = b
-            
-    if n % 2 == 0:
-        z = b
-    else:
-        z = x
-    half: uint256 = b//2
-    zx: uint256 = 0
-    xxRound: uint256 = 0
-    zxRound: uint256 = 0
-    xx: uint256 = 0
-
-    #1
-    y = y//2
-    xx = w * w
-    if xx//w != w:
-        raise "0,0"
-    xxRound = xx + half
-    if xxRound < xx:
-        raise "0,0"
-    w = xxRound//b
-    if y % 2 > 0:
-        zx = z * w
-        if (w != 0 and (z*w)//w != z):
-            raise "0,0"
-        zxRound = zx + half
-        if zxRound < zx:
-            raise "0,0"
-        z = zxRound //b
-    #2
-    y = y//2
-    xx = w * w
-    if xx//w != w:
-        raise "0,0"
-    xxRound = xx + half
-    if xxRound < xx:
-        raise "0,0"
-    w = xxRound//b
-    if y % 2 > 0:
-        zx = z * w
-        if (w != 0 and (z*w)//w != z):
-            raise "0,0"
-        zxRound = zx + half
-        if zxRound < zx:
-            raise "0,0"
-        z = zxRound //b
-    #3
-    y = y//2
-    xx = w * w
-    if xx//w != w:
-        raise "0,0"
-    xxRound = xx + half
-    if xxRound < xx:
-        raise "0,0"
-    w = xxRound//b
-    if y % 2 > 0:
-        zx = z * w
-        if (w != 0 and (z*w)//w != z):
-            raise "0,0"
-        zxRound = zx + half
-        if zxRound < zx:
-            raise "0,0"
-        z = zxRound //b
-    #4
-    y = y//2
-    xx = w * w
-    if xx//w != w:
-        raise "0,0"
-    xxRound = xx + half
-    if xxRound < xx:
-        raise "0,0"
-    w = xxRound//b
-    if y % 2 > 0:
-        zx = z * w
-        if (w != 0 and (z*w)//w != z):
-            raise "0,0"
-        zxRound = zx + half
-        if zxRound < zx:
-            raise "0,0"
-        z = zxRound //b
-    #5
-    y = y//2
-    xx = w * w
-    if xx//w != w:
-        raise "0,0"
-    xxRound = xx + half
-    if xxRound < xx:
-        raise "0,0"
-    w = xxRound//b
-    if y % 2 > 0:
-        zx = z * w
-        if (w != 0 and (z*w)//w != z):
-            raise "0,0"
-        zxRound = zx + half
-        if zxRound < zx:
-            raise "0,0"
-        z = zxRound //b
-    #6
-    y = y//2
-    xx = w * w
-    if xx//w != w:
-        raise "0,0"
-    xxRound = xx + half
-    if xxRound < xx:
-        raise "0,0"
-    w = xxRound//b
-    if y % 2 > 0:
-        zx = z * w
-        if (w != 0 and (z*w)//w != z):
-            raise "0,0"
-        zxRound = zx + half
-        if zxRound < zx:
-            raise "0,0"
-        z = zxRound //b
-    #7
-    y = y//2
-    xx = w * w
-    if xx//w != w:
-        raise "0,0"
-    xxRound = xx + half
-    if xxRound < xx:
-        raise "0,0"
-    w = xxRound//b
-    if y % 2 > 0:
-        zx = z * w
-        if (w != 0 and (z*w)//w != z):
-            raise "0,0"
-        zxRound = zx + half
-        if zxRound < zx:
-            raise "0,0"
-        z = zxRound //b
-    #8
-    y = y//2
-    xx = w * w
-    if xx//w != w:
-        raise "0,0"
-    xxRound = xx + half
-    if xxRound < xx:
-        raise "0,0"
-    w = xxRound//b
-    if y % 2 > 0:
-        zx = z * w
-        if (w != 0 and (z*w)//w != z):
-            raise "0,0"
-        zxRound = zx + half
-        if zxRound < zx:
-            raise "0,0"
-        z = zxRound //b
-        
-    return z                  
+RAY: public(constant(uint256)) = pi_math.RAY
 
+# New state after every update, enough to rebuild the history from logs alone
+event UpdateEvent:
+    error: int256
+    error_integral: int256
+    p_output: int256
+    i_output: int256
+    # last_output (high 128 bits, int128) and last_update_time (low 64 bits), as stored
+    output_and_time: uint256
 
-@internal
-@view
-def exp_uint256(a: uint256, b: uint256) -> uint256:
-    #if a < 2 or b < 2:
-    #    # Default to EVM in these special cases
-    #    return a ** b  # dev: Vyper Would Revert
+# An update within the output deadband, which leaves last_output, last_p_output and
+# last_i_output as they were
+event DeadbandUpdateEvent:
+    error: int256
+    error_integral: int256
+    output_and_time: uint256
 
-    x: uint256 = a
-    n: uint256 = b
-    y: uint256 = 1
+event ModifyParametersAddr:
+    parameter: String[32]
+    addr: address
 
-    # NOTE: Do this at most 8 times... e.g. log_2(256)
+event ModifyParametersUint:
+    parameter: String[32]
+    val: uint256
 
-    # 1/8
-    if n % 2 == 0:
-        x *= x  # dev: SafeMath Check
-        n //= 2
-    else:
-        y *= x  # dev: SafeMath Check
-        x *= x  # dev: SafeMath Check
-        n -= 1
-        n //= 2
-
-    # 2/8
-    if n <= 1:
-        return x * y
-
-    if n % 2 == 0:
-        x *= x  # dev: SafeMath Check
-        n //= 2
-    else:
-        y *= x  # dev: SafeMath Check
-        x *= x  # dev: SafeMath Check
-        n -= 1
-        n //= 2
-
-    # 3/8
-    if n <= 1:
-        return x * y
-
-    if n % 2 == 0:
-        x *= x  # dev: SafeMath Check
-        n //= 2
-    else:
-        y *= x  # dev: SafeMath Check
-        x *= x  # dev: SafeMath Check
-        n -= 1
-        n //= 2
-
-    # 4/8
-    if n <= 1:
-        return x * y
-
-    if n % 2 == 0:
-        x *= x  # dev: SafeMath Check
-        n //= 2
-    else:
-        y *= x  # dev: SafeMath Check
-        x *= x  # dev: SafeMath Check
-        n -= 1
-        n //= 2
-
-    # 5/8
-    if n <= 1:
-        return x * y
-    if n % 2 == 0:
-        x *= x  # dev: SafeMath Check
-        n //= 2
-    else:
-        y *= x  # dev: SafeMath Check
-        x *= x  # dev: SafeMath Check
-        n -= 1
-        n //= 2
-
-    # 6/8
-    if n <= 1:
-        return x * y
-
-    if n % 2 == 0:
-        x *= x  # dev: SafeMath Check
-        n //= 2
-    else:
-        y *= x  # dev: SafeMath Check
-        x *= x  # dev: SafeMath Check
-        n -= 1
-        n //= 2
-
-    # 7/8
-    if n <= 1:
-        return x * y
-
-    if n % 2 == 0:
-        x *= x  # dev: SafeMath Check
-        n //= 2
-    else:
-        y *= x  # dev: SafeMath Check
-        x *= x  # dev: SafeMath Check
-        n -= 1
-        n //= 2
-
-    # 8/8
-    if n <= 1:
-        return x * y
-
-    if n % 2 == 0:
-        x *= x  # dev: SafeMath Check
-        n //= 2
-    else:
-        y *= x  # dev: SafeMath Check
-        x *= x  # dev: SafeMath Check
-        n -= 1
-        n //= 2
+event ModifyParametersInt:
+    parameter: String[32]
+    val: int256
 
-    assert n <= 1, UNREACHABLE  # dev: exceeded expected number of iterations
+event SetParameters:
+    parameters: pi_math.Parameters
+    mask: uint256
 
-    return x * y  # dev: SafeMath Check
-@deploy
-def __init__(_control_variable: bytes32, _kp: int256, _ki: int256, _co_bias: int256,
-_per_second_integral_leak: uint256, _output_upper_bound: int256,
-_output_lower_bound: int256, imported_state: int256[3]):
-    #
-    assert _output_upper_bound >= _output_lower_bound, "PIController/invalid-bounds"
+@external
+@pure
+def rpower(x: uint256, n: uint256, base: uint256) -> uint256:
+    return pi_math._rpower(x, n, base)
+
+@internal
+def _initialize(_control_variable: bytes32, _kp: int256, _ki: int256, _co_bias: int256,
+                _per_second_integral_leak: uint256, _output_upper_bound: int256,
+                _output_lower_bound: int256, imported_state: int256[3], owner: address):
+    # the same rule as set_parameters() and the bound setters: the upper bound above the lower
+    assert _output_upper_bound > _output_lower_bound, "PIController/invalid-bounds"
+    assert _per_second_integral_leak <= pi_math.TWENTY_SEVEN_DECIMAL_NUMBER, "PIController/invalid-per_second_integral_leak"
     assert convert(imported_state[0], uint256) <= block.timestamp, "PIController/invalid-imported-time"
-    self.authorities[msg.sender] = 1
+    self.authorities[owner] = 1
     self.control_variable = _control_variable
     self.kp = _kp
     self.ki = _ki
     self.co_bias = _co_bias
-    self.per_second_integral_leak = _per_second_integral_leak
-    self.output_upper_bound = _output_upper_bound
-    self.output_lower_bound = _output_lower_bound
-    self.last_update_time = convert(imported_state[0], uint256)
+    self.leak_and_cache = pi_math._pack_leak_and_cache(_per_second_integral_leak, 0)
+    self.output_bounds = pi_math._pack_bounds(_output_upper_bound, _output_lower_bound)
+    self.last_output_and_time = pi_math._pack_last_output_and_time(0, convert(imported_state[0], uint256))
     self.last_error = imported_state[1]
     self.error_integral = imported_state[2]
 
+@deploy
+def __init__(_control_variable: bytes32, _kp: int256, _ki: int256, _co_bias: int256,
+_per_second_integral_leak: uint256, _output_upper_bound: int256,
+_output_lower_bound: int256, imported_state: int256[3]):
+    self._initialize(_control_variable, _kp, _ki, _co_bias, _per_second_integral_leak, _output_upper_bound,
+                     _output_lower_bound, imported_state, msg.sender)
+
+@external
+def initialize(_control_variable: bytes32, _kp: int256, _ki: int256, _co_bias: int256,
+               _per_second_integral_leak: uint256, _output_upper_bound: int256,
+               _output_lower_bound: int256, imported_state: int256[3], owner: address):
+    # __init__ for a clone, which starts from empty storage; `owner` gets the authority
+    # __init__ gives its deployer. leak_and_cache is never 0 once initialized: with the
+    # cadence at 0 its cached factor is RAY.
+    assert self.leak_and_cache == 0, "PIController/already-initialized"
+    self._initialize(_control_variable, _kp, _ki, _co_bias, _per_second_integral_leak, _output_upper_bound,
+                     _output_lower_bound, imported_state, owner)
+
 @external
 def add_authority(account: address):
     self.authorities[account] = 1
@@ -490,26 +116,95 @@ def remove_authority(account: address):
 @external
 def modify_parameters_addr(parameter: String[32], addr: address):
     if (parameter == "updater"):
-        self.updater = addr
+        self.updater_and_deadband = (self.updater_and_deadband & ~pi_math.LOW_160_MASK) | convert(addr, uint256)
     else:
         raise "PIController/modify-unrecognized-param"
+    log ModifyParametersAddr(parameter, addr)
 
 @external
 def modify_parameters_uint(parameter: String[32], val: uint256):
     if (parameter == "per_second_integral_leak"):
-        assert val <= TWENTY_SEVEN_DECIMAL_NUMBER, "PIController/invalid-per_second_integral_leak"
-        self.per_second_integral_leak = val
+        assert val <= pi_math.TWENTY_SEVEN_DECIMAL_NUMBER, "PIController/invalid-per_second_integral_leak"
+        self.leak_and_cache = pi_math._pack_leak_and_cache(val, (self.leak_and_cache >> 96) & pi_math.LOW_32_MASK)
+    elif (parameter == "output_deadband"):
+        # updates that would move the output by less than this leave it, and the p and i
+        # outputs, where they are; 0 turns the deadband off
+        assert val <= pi_math.LOW_96_MASK, "PIController/invalid-output_deadband"
+        self.updater_and_deadband = ((val << 160)
+                                     | (self.updater_and_deadband & pi_math.LOW_160_MASK))
+    elif (parameter == "observation_cardinality"):
+        # Keeps the last `val` updates from now on, 0 for none. The ring starts over from
+        # an observation at the last update, so any previous observations are dropped.
+        assert val <= pi_math.MAX_OBSERVATIONS, "PIController/invalid-observation_cardinality"
+        last_output_and_time: uint256 = self.last_output_and_time
+        ring: uint256 = 0
+        if val != 0:
+            self.observations[0] = pi_math.Observation(output_cumulative_and_time=last_output_and_time & pi_math.LOW_64_MASK,
+                                                       error_cumulative=0)
+            ring = pi_math._pack_ring(0, val, 1)
+        self.last_output_and_time = (last_output_and_time & ~pi_math.RING_MASK) | ring
+    elif (parameter == "leak_cadence"):
+        # elapsed time whose accumulated leak is precomputed, normally the keeper's update delay
+        self.leak_and_cache = pi_math._pack_leak_and_cache(self.leak_and_cache & pi_math.LOW_96_MASK, val)
     else:
         raise "PIController/modify-unrecognized-param"
+    log ModifyParametersUint(parameter, val)
+
+@external
+def set_parameters(parameters: pi_math.Parameters, mask: uint256):
+    # Applies the fields of `parameters` whose pi_math.SET_* bit is in `mask`, all or none.
+    # The bounds are validated once, against each other, after both are applied.
+    assert mask <= pi_math.SET_ALL, "PIController/modify-unrecognized-param"
+    if mask & pi_math.SET_KP != 0:
+        self.kp = parameters.kp
+    if mask & pi_math.SET_KI != 0:
+        self.ki = parameters.ki
+    if mask & pi_math.SET_CO_BIAS != 0:
+        self.co_bias = parameters.co_bias
+    if mask & pi_math.SET_ERROR_INTEGRAL != 0:
+        self.error_integral = parameters.error_integral
+    if mask & pi_math.SET_OUTPUT_DEADBAND != 0:
+        assert parameters.output_deadband <= pi_math.LOW_96_MASK, "PIController/invalid-output_deadband"
+        self.updater_and_deadband = ((parameters.output_deadband << 160)
+                                     | (self.updater_and_deadband & pi_math.LOW_160_MASK))
+
+    if mask & (pi_math.SET_OUTPUT_UPPER_BOUND | pi_math.SET_OUTPUT_LOWER_BOUND) != 0:
+        bounds: uint256 = self.output_bounds
+        upper: int256 = pi_math._high_int128(bounds)
+        lower: int256 = pi_math._low_int128(bounds)
+        if mask & pi_math.SET_OUTPUT_UPPER_BOUND != 0:
+            upper = parameters.output_upper_bound
+        if mask & pi_math.SET_OUTPUT_LOWER_BOUND != 0:
+            lower = parameters.output_lower_bound
+        assert upper > lower, "PIController/invalid-bounds"
+        self.output_bounds = pi_math._pack_bounds(upper, lower)
+
+    if mask & (pi_math.SET_PER_SECOND_INTEGRAL_LEAK | pi_math.SET_LEAK_CADENCE) != 0:
+        # the cached leak factor is recomputed once for the new leak and cadence
+        leak_and_cache: uint256 = self.leak_and_cache
+        leak: uint256 = leak_and_cache & pi_math.LOW_96_MASK
+        cadence: uint256 = (leak_and_cache >> 96) & pi_math.LOW_32_MASK
+        if mask & pi_math.SET_PER_SECOND_INTEGRAL_LEAK != 0:
+            leak = parameters.per_second_integral_leak
+            assert leak <= pi_math.TWENTY_SEVEN_DECIMAL_NUMBER, "PIController/invalid-per_second_integral_leak"
+        if mask & pi_math.SET_LEAK_CADENCE != 0:
+            cadence = parameters.leak_cadence
+        self.leak_and_cache = pi_math._pack_leak_and_cache(leak, cadence)
+
+    log SetParameters(parameters, mask)
 
 @external
 def modify_parameters_int(parameter: String[32], val: int256):
     if (parameter == "output_upper_bound"):
-        assert val > self.output_lower_bound, "PIController/invalid-output_upper_bound"
-        self.output_upper_bound = val
+        bounds: uint256 = self.output_bounds
+        lower: int256 = pi_math._low_int128(bounds)
+        assert val > lower, "PIController/invalid-output_upper_bound"
+        self.output_bounds = pi_math._pack_bounds(val, lower)
     elif (parameter == "output_lower_bound"):
-        assert val < self.output_upper_bound, "PIController/invalid-output_lower_bound"
-        self.output_lower_bound = val
+        bounds: uint256 = self.output_bounds
+        upper: int256 = pi_math._high_int128(bounds)
+        assert val < upper, "PIController/invalid-output_lower_bound"
+        self.output_bounds = pi_math._pack_bounds(upper, val)
     elif (parameter == "kp"):
         self.kp = val
     elif (parameter == "ki"):
@@ -520,122 +215,289 @@ def modify_parameters_int(parameter: String[32], val: int256):
         self.error_integral = val
     else:
         raise "PIController/modify-unrecognized-param"
+    log ModifyParametersInt(parameter, val)
 
-@internal
+@external
 @view
-def _riemann_sum(x: int256, y: int256)-> int256:
-    return (x + y) // 2
+def per_second_integral_leak() -> uint256:
+    return self.leak_and_cache & pi_math.LOW_96_MASK
 
-@internal
+@external
 @view
-def _bound_pi_output(pi_output: int256) -> int256:
-    bounded_pi_output: int256 = pi_output
-    if pi_output < self.output_lower_bound:
-        bounded_pi_output = self.output_lower_bound
-    elif pi_output > self.output_upper_bound:
-        bounded_pi_output = self.output_upper_bound
-
-    return bounded_pi_output
+def leak_cadence() -> uint256:
+    return (self.leak_and_cache >> 96) & pi_math.LOW_32_MASK
 
 @external
 @view
-def bound_pi_output(pi_output: int256) -> int256:
-    return self._bound_pi_output(pi_output)
+def updater() -> address:
+    return convert(self.updater_and_deadband & pi_math.LOW_160_MASK, address)
 
-@internal
+@external
 @view
-def clamp_error_integral(bounded_pi_output:int256, new_error_integral: int256, new_area: int256) -> int256:
-    clamped_error_integral: int256 = new_error_integral
-    if (bounded_pi_output == self.output_lower_bound and new_area < 0 and self.error_integral < 0):
-        clamped_error_integral = clamped_error_integral - new_area
-    elif (bounded_pi_output == self.output_upper_bound and new_area > 0 and self.error_integral > 0):
-        clamped_error_integral = clamped_error_integral - new_area
-    return clamped_error_integral
+def output_deadband() -> uint256:
+    return self.updater_and_deadband >> 160
 
-@internal
+@external
 @view
-def _get_new_error_integral(error: int256) -> (int256, int256):
-    elapsed: uint256 = 0 if (self.last_update_time == 0) else block.timestamp - self.last_update_time
-    
-    new_time_adjusted_error: int256 = self._riemann_sum(error, self.last_error) * convert(elapsed, int256)
+def output_upper_bound() -> int256:
+    return pi_math._high_int128(self.output_bounds)
 
-    #accumulated_leak: uint256 = RAY if self.per_second_integral_leak == convert(1E27, uint256) else self.my_exp_uint256(self.per_second_integral_leak, elapsed, RAY)
+@external
+@view
+def output_lower_bound() -> int256:
+    return pi_math._low_int128(self.output_bounds)
 
-    accumulated_leak: uint256 = RAY
-    leaked_error_integral: int256 = (convert(accumulated_leak, int256) * self.error_integral) // convert(TWENTY_SEVEN_DECIMAL_NUMBER, int256)
-    
-    return (leaked_error_integral + new_time_adjusted_error, new_time_adjusted_error)
+@external
+@view
+def last_output() -> int256:
+    return pi_math._high_int128(self.last_output_and_time)
 
 @external
 @view
-def get_new_error_integral(error: int256) -> (int256, int256):
-    return self._get_new_error_integral(error)
+def last_update_time() -> uint256:
+    return self.last_output_and_time & pi_math.LOW_64_MASK
 
-@internal
+@external
 @view
-def _get_raw_pi_output(error: int256, errorI: int256) -> (int256, int256, int256):
-    # // output = P + I = Kp * error + Ki * errorI
-    p_output: int256 = (error * self.kp) // EIGHTEEN_DECIMAL_NUMBER
-    i_output: int256 = (errorI * self.ki) // EIGHTEEN_DECIMAL_NUMBER
+def bound_pi_output(pi_output: int256) -> int256:
+    return pi_math._bound_pi_output(pi_output, self.output_bounds)
 
-    return (self.co_bias + p_output + i_output, p_output, i_output)
+@external
+@view
+def get_new_error_integral(error: int256) -> (int256, int256):
+    return pi_math._get_new_error_integral(error, self.last_error, self.error_integral,
+                                           pi_math._elapsed(self.last_output_and_time & pi_math.LOW_64_MASK),
+                                           self.leak_and_cache)
 
 @external
 @view
 def get_raw_pi_output(error: int256, errorI: int256) -> (int256, int256, int256):
-    return self._get_raw_pi_output(error, errorI)
+    return pi_math._get_raw_pi_output(error, errorI, self.kp, self.ki, self.co_bias)
     
+@internal
+def _record_observation(ring: uint256, last_output: int256, last_error: int256) -> uint256:
+    # Appends the observation at this update, the previous output and error having held
+    # since the last one; returns the ring's new bits
+    index: uint256 = 0
+    cardinality: uint256 = 0
+    count: uint256 = 0
+    (index, cardinality, count) = pi_math._unpack_ring(ring)
+    next: uint256 = unsafe_add(index, 1) % cardinality
+    self.observations[next] = pi_math._observe(self.observations[index], last_output, last_error, block.timestamp)
+    return pi_math._pack_ring(next, cardinality, min(count + 1, cardinality))
+
 @external
 def update(error: int256) -> (int256, int256, int256):
-    assert self.updater == msg.sender, "PIController/invalid-msg-sender"
-
-    assert block.timestamp > self.last_update_time, "PIController/wait-longer"
+    """
+    @notice Apply `error` at the current block and store the new outputs
+    @return The bounded output, p_output and i_output. Within output_deadband the
+            bounded output is the stored last_output, which is kept, while p_output
+            and i_output are the ones computed for `error` and are not stored; that
+            triple is neither last_update() before nor after the call.
+    """
+    updater_and_deadband: uint256 = self.updater_and_deadband
+    assert updater_and_deadband & pi_math.LOW_160_MASK == convert(msg.sender, uint256), "PIController/invalid-msg-sender"
+
+    last_output_and_time: uint256 = self.last_output_and_time
+    last_update_time: uint256 = last_output_and_time & pi_math.LOW_64_MASK
+    assert block.timestamp > last_update_time, "PIController/wait-longer"
+
+    # Every slot below is read exactly once per update
+    error_integral: int256 = self.error_integral
+    last_error: int256 = self.last_error
+    bounds: uint256 = self.output_bounds
+    elapsed: uint256 = pi_math._elapsed(last_update_time)
 
     new_error_integral: int256 = 0
     new_area: int256 = 0
-    (new_error_integral, new_area) = self._get_new_error_integral(error)
-
     pi_output: int256 = 0
     p_output: int256 = 0
     i_output: int256 = 0
-    (pi_output, p_output, i_output) = self._get_raw_pi_output(error, new_error_integral)
-
-    bounded_pi_output: int256 = self._bound_pi_output(pi_output)
+    (new_error_integral, new_area) = pi_math._get_new_error_integral(error, last_error, error_integral,
+                                                                     elapsed, self.leak_and_cache)
+    (pi_output, p_output, i_output) = pi_math._get_raw_pi_output(error, new_error_integral, self.kp,
+                                                                 self.ki, self.co_bias)
 
-    self.error_integral = self.clamp_error_integral(bounded_pi_output, new_error_integral, new_area)
+    bounded_pi_output: int256 = pi_math._bound_pi_output(pi_output, bounds)
 
-    self.last_update_time = block.timestamp
+    clamped_error_integral: int256 = pi_math.clamp_error_integral(bounded_pi_output, new_error_integral, new_area,
+                                                                  error_integral, bounds)
+    self.error_integral = clamped_error_integral
     self.last_error = error
 
-    self.last_output = bounded_pi_output
+    last_output: int256 = pi_math._high_int128(last_output_and_time)
+    ring: uint256 = last_output_and_time & pi_math.RING_MASK
+    if ring != 0:
+        ring = self._record_observation(ring, last_output, last_error)
+
+    # Within the deadband only the time moves in the output slot, and the p and i slots
+    # are not written at all
+    if pi_math._within_deadband(bounded_pi_output, last_output, updater_and_deadband >> 160):
+        deadband_output_and_time: uint256 = ((last_output_and_time & ~(pi_math.LOW_64_MASK | pi_math.RING_MASK))
+                                             | ring | block.timestamp)
+        self.last_output_and_time = deadband_output_and_time
+        log DeadbandUpdateEvent(error, clamped_error_integral, deadband_output_and_time)
+        return (last_output, p_output, i_output)
+
+    output_and_time: uint256 = pi_math._pack_last_output_and_time(bounded_pi_output, block.timestamp) | ring
+    self.last_output_and_time = output_and_time
     self.last_p_output = p_output
     self.last_i_output = i_output
 
+    log UpdateEvent(error, clamped_error_integral, p_output, i_output, output_and_time)
+
     return (bounded_pi_output, p_output, i_output)
 
 @external
 @view
 def last_update() -> (uint256, int256, int256, int256):
-    return (self.last_update_time, self.last_output, self.last_p_output, self.last_i_output)
+    last_output_and_time: uint256 = self.last_output_and_time
+    return (last_output_and_time & pi_math.LOW_64_MASK, pi_math._high_int128(last_output_and_time),
+            self.last_p_output, self.last_i_output)
 
 @external
 @view
 def get_new_pi_output(error: int256) -> (int256, int256, int256):
     new_error_integral: int256 = 0
     tmp: int256 = 0
-    (new_error_integral, tmp) = self._get_new_error_integral(error)
+    (new_error_integral, tmp) = pi_math._get_new_error_integral(error, self.last_error, self.error_integral,
+                                                                pi_math._elapsed(self.last_output_and_time & pi_math.LOW_64_MASK),
+                                                                self.leak_and_cache)
 
     pi_output: int256 = 0
     p_output: int256 = 0
     i_output: int256 = 0
-    (pi_output, p_output, i_output) = self._get_raw_pi_output(error, new_error_integral)
+    (pi_output, p_output, i_output) = pi_math._get_raw_pi_output(error, new_error_integral, self.kp, self.ki, self.co_bias)
 
-    bounded_pi_output: int256 = self._bound_pi_output(pi_output)
+    bounded_pi_output: int256 = pi_math._bound_pi_output(pi_output, self.output_bounds)
 
     return (bounded_pi_output, p_output, i_output)
 
+@external
+@view
+def get_new_pi_outputs(queries: DynArray[pi_math.ErrorAt, pi_math.MAX_WHAT_IFS]) -> DynArray[pi_math.PIOutput, pi_math.MAX_WHAT_IFS]:
+    # get_new_pi_output() for up to MAX_WHAT_IFS (error, timestamp) pairs, all from the
+    # stored state; reverts if a timestamp is before the last update
+    return pi_math._get_new_pi_outputs(queries, self.last_error, self.error_integral,
+                                       self.last_output_and_time & pi_math.LOW_64_MASK, self.leak_and_cache,
+                                       self.kp, self.ki, self.co_bias, self.output_bounds)
+
+@external
+@view
+def fast_forward(error: int256, timestamp: uint256) -> pi_math.UpdateState:
+    # the state update(error) would store if mined at `timestamp`; reverts like update()
+    # unless the timestamp is after the last update
+    return pi_math._fast_forward(error, timestamp, self.last_error, self.error_integral, self.last_output_and_time,
+                                 self.last_p_output, self.last_i_output, self.leak_and_cache, self.kp, self.ki,
+                                 self.co_bias, self.output_bounds, self.updater_and_deadband >> 160)
+
+@external
+@view
+def should_update(error: int256, timestamp: uint256) -> bool:
+    # whether update(error) mined at `timestamp` would move the output by output_deadband
+    # or more, so it is worth a full update; False if it could not be mined then
+    last_output_and_time: uint256 = self.last_output_and_time
+    if timestamp <= last_output_and_time & pi_math.LOW_64_MASK:
+        return False
+    state: pi_math.UpdateState = pi_math._fast_forward(error, timestamp, self.last_error, self.error_integral,
+                                                       last_output_and_time, 0, 0, self.leak_and_cache, self.kp,
+                                                       self.ki, self.co_bias, self.output_bounds, 0)
+    return not pi_math._within_deadband(state.last_output, pi_math._high_int128(last_output_and_time),
+                                        self.updater_and_deadband >> 160)
+
+@external
+@view
+def get_state() -> pi_math.Snapshot:
+    # every parameter and state variable in one call
+    updater_and_deadband: uint256 = self.updater_and_deadband
+    return pi_math._snapshot(self.control_variable, self.kp, self.ki, self.co_bias, self.output_bounds,
+                             self.leak_and_cache, updater_and_deadband >> 160, self.error_integral, self.last_error,
+                             self.last_output_and_time, self.last_p_output, self.last_i_output,
+                             convert(updater_and_deadband & pi_math.LOW_160_MASK, address))
+
 @external
 @view
 def elapsed() -> uint256:
-    return 0 if self.last_update_time == 0 else block.timestamp - self.last_update_time
+    return pi_math._elapsed(self.last_output_and_time & pi_math.LOW_64_MASK)
 
+@external
+@view
+def observation_cardinality() -> uint256:
+    return (self.last_output_and_time >> (pi_math.RING_SHIFT + 16)) & pi_math.LOW_16_MASK
+
+@external
+@view
+def observation(age: uint256) -> (uint256, int256, int256):
+    # (timestamp, bounded output, error) of an update in the ring, `age` 0 for the latest.
+    # The output and error of older ones are exact: each held until the next observation.
+    last_output_and_time: uint256 = self.last_output_and_time
+    index: uint256 = 0
+    cardinality: uint256 = 0
+    count: uint256 = 0
+    (index, cardinality, count) = pi_math._unpack_ring(last_output_and_time)
+    assert age < count, "PIController/observation-too-old"
+    position: uint256 = (index + cardinality - age) % cardinality
+    observation: pi_math.Observation = self.observations[position]
+    if age == 0:
+        return (observation.output_cumulative_and_time & pi_math.LOW_64_MASK,
+                pi_math._high_int128(last_output_and_time), self.last_error)
+    output: int256 = 0
+    error: int256 = 0
+    (output, error) = pi_math._average(observation, self.observations[unsafe_add(position, 1) % cardinality])
+    return (observation.output_cumulative_and_time & pi_math.LOW_64_MASK, output, error)
+
+@external
+@view
+def average_over_updates(updates: uint256) -> (int256, int256):
+    # Time-weighted average output and error from the update `updates` back to the
+    # latest one; two reads whatever the window
+    index: uint256 = 0
+    cardinality: uint256 = 0
+    count: uint256 = 0
+    (index, cardinality, count) = pi_math._unpack_ring(self.last_output_and_time)
+    assert updates != 0 and updates < count, "PIController/observation-too-old"
+    return pi_math._average(self.observations[(index + cardinality - updates) % cardinality],
+                            self.observations[index])
+
+@external
+@view
+def average_over(seconds: uint256) -> (int256, int256):
+    # Time-weighted average output and error over the last `seconds` up to this block,
+    # the time since the latest update included. The start of the window is found by a
+    # binary search of the ring, at most MAX_OBSERVATION_PROBES reads whatever the window.
+    last_output_and_time: uint256 = self.last_output_and_time
+    index: uint256 = 0
+    cardinality: uint256 = 0
+    count: uint256 = 0
+    (index, cardinality, count) = pi_math._unpack_ring(last_output_and_time)
+    assert seconds != 0 and count != 0 and seconds <= block.timestamp, "PIController/observation-too-old"
+
+    last_output: int256 = pi_math._high_int128(last_output_and_time)
+    last_error: int256 = self.last_error
+    latest: pi_math.Observation = self.observations[index]
+    start: uint256 = block.timestamp - seconds
+    if start >= latest.output_cumulative_and_time & pi_math.LOW_64_MASK:
+        return (last_output, last_error)
+
+    # Positions from the oldest observation (0) to the latest (count - 1); the window
+    # starts in [time(low), time(high)), and the search ends with high == low + 1
+    oldest: uint256 = index + cardinality + 1 - count
+    low: uint256 = 0
+    high: uint256 = count - 1
+    assert self.observations[oldest % cardinality].output_cumulative_and_time & pi_math.LOW_64_MASK <= start, \
+        "PIController/observation-too-old"
+    for _: uint256 in range(pi_math.MAX_OBSERVATION_PROBES):
+        if high - low <= 1:
+            break
+        middle: uint256 = unsafe_div(low + high, 2)
+        if self.observations[(oldest + middle) % cardinality].output_cumulative_and_time & pi_math.LOW_64_MASK <= start:
+            low = middle
+        else:
+            high = middle
+
+    before: pi_math.Observation = self.observations[(oldest + low) % cardinality]
+    output: int256 = 0
+    error: int256 = 0
+    (output, error) = pi_math._average(before, self.observations[(oldest + high) % cardinality])
+    return pi_math._average(pi_math._observe(before, output, error, start),
+                            pi_math._observe(latest, last_output, last_error, block.timestamp))
@@ -0,0 +1,34 @@
+#pragma version >0.3.10
+
+# Deploys PIControllers as EIP-1167 minimal proxies of one deployed PIController.vy.
+# A clone is 45 bytes of code delegating every call to the implementation, so a new
+# controller costs its storage writes rather than a full code deposit. The clone is
+# initialized in the same transaction with the constructor's arguments and checks,
+# and the caller gets the authority the constructor gives its deployer.
+
+interface PIController:
+    def initialize(_control_variable: bytes32, _kp: int256, _ki: int256, _co_bias: int256,
+                   _per_second_integral_leak: uint256, _output_upper_bound: int256,
+                   _output_lower_bound: int256, imported_state: int256[3], owner: address): nonpayable
+
+event ControllerCreated:
+    control_variable: indexed(bytes32)
+    controller: address
+    owner: address
+
+implementation: public(immutable(address))
+
+@deploy
+def __init__(_implementation: address):
+    implementation = _implementation
+
+@external
+def create_controller(control_variable: bytes32, _kp: int256, _ki: int256, _co_bias: int256,
+                      _per_second_integral_leak: uint256, _output_upper_bound: int256,
+                      _output_lower_bound: int256, imported_state: int256[3]) -> address:
+    controller: address = create_minimal_proxy_to(implementation)
+    extcall PIController(controller).initialize(control_variable, _kp, _ki, _co_bias, _per_second_integral_leak,
+                                                _output_upper_bound, _output_lower_bound, imported_state,
+                                                msg.sender)
+    log ControllerCreated(control_variable, controller, msg.sender)
+    return controller
@@ -0,0 +1,337 @@
+#pragma version >0.3.10
+
+import pi_math
+
+# Many PIControllers in one contract, keyed by control variable. Each controller
+# keeps its own authorities, updater, gains, bounds and state, packed as in
+# PIController.vy except for the updater, which has a slot of its own.
+# update_many() steps several of them in one transaction so keepers pay the base
+# transaction cost once. Only the admin registers controllers. Entries have no
+# output deadband, observation ring, set_parameters() or fast_forward().
+
+struct ControllerState:
+    kp: int256
+    ki: int256
+    co_bias: int256
+    # output_upper_bound (high 128 bits) and output_lower_bound (low 128 bits), both int128
+    output_bounds: uint256
+    error_integral: int256
+    last_error: int256
+    # per_second_integral_leak (low 96 bits), leak_cadence (next 32 bits) and the cached
+    # rpower(per_second_integral_leak, leak_cadence, RAY) (high 128 bits)
+    leak_and_cache: uint256
+    # last_output (high 128 bits, int128) and last_update_time (low 64 bits)
+    last_output_and_time: uint256
+    last_p_output: int256
+    last_i_output: int256
+    updater: address
+
+MAX_UPDATES: constant(uint256) = 64
+
+RAY: public(constant(uint256)) = pi_math.RAY
+
+# registers controllers, and can hand that over with set_admin()
+admin: public(address)
+authorities: public(HashMap[bytes32, HashMap[address, uint256]])
+registered: public(HashMap[bytes32, bool])
+controllers: HashMap[bytes32, ControllerState]
+
+# The events of PIController.vy, keyed by the controller's id
+event AddController:
+    id: indexed(bytes32)
+    authority: address
+
+event UpdateEvent:
+    id: indexed(bytes32)
+    error: int256
+    error_integral: int256
+    p_output: int256
+    i_output: int256
+    # last_output (high 128 bits, int128) and last_update_time (low 64 bits), as stored
+    output_and_time: uint256
+
+event ModifyParametersAddr:
+    id: indexed(bytes32)
+    parameter: String[32]
+    addr: address
+
+event ModifyParametersUint:
+    id: indexed(bytes32)
+    parameter: String[32]
+    val: uint256
+
+event ModifyParametersInt:
+    id: indexed(bytes32)
+    parameter: String[32]
+    val: int256
+
+@deploy
+def __init__():
+    self.admin = msg.sender
+
+@external
+def set_admin(new_admin: address):
+    assert msg.sender == self.admin, "PIControllerRegistry/not-the-admin"
+    self.admin = new_admin
+
+@external
+def add_controller(control_variable: bytes32, _kp: int256, _ki: int256, _co_bias: int256,
+                   _per_second_integral_leak: uint256, _output_upper_bound: int256,
+                   _output_lower_bound: int256, imported_state: int256[3]):
+    # Same checks as the PIController.vy constructor; the admin becomes the first authority
+    assert msg.sender == self.admin, "PIControllerRegistry/not-the-admin"
+    assert not self.registered[control_variable], "PIControllerRegistry/already-registered"
+    assert _output_upper_bound > _output_lower_bound, "PIController/invalid-bounds"
+    assert _per_second_integral_leak <= pi_math.TWENTY_SEVEN_DECIMAL_NUMBER, "PIController/invalid-per_second_integral_leak"
+    assert convert(imported_state[0], uint256) <= block.timestamp, "PIController/invalid-imported-time"
+    self.registered[control_variable] = True
+    self.authorities[control_variable][msg.sender] = 1
+    self.controllers[control_variable] = ControllerState(
+        kp=_kp,
+        ki=_ki,
+        co_bias=_co_bias,
+        output_bounds=pi_math._pack_bounds(_output_upper_bound, _output_lower_bound),
+        error_integral=imported_state[2],
+        last_error=imported_state[1],
+        leak_and_cache=pi_math._pack_leak_and_cache(_per_second_integral_leak, 0),
+        last_output_and_time=pi_math._pack_last_output_and_time(0, convert(imported_state[0], uint256)),
+        last_p_output=0,
+        last_i_output=0,
+        updater=empty(address),
+    )
+    log AddController(control_variable, msg.sender)
+
+@internal
+@view
+def _check_authority(id: bytes32):
+    assert self.authorities[id][msg.sender] == 1, "PIControllerRegistry/not-an-authority"
+
+@external
+def add_authority(id: bytes32, account: address):
+    self._check_authority(id)
+    self.authorities[id][account] = 1
+
+@external
+def remove_authority(id: bytes32, account: address):
+    self._check_authority(id)
+    self.authorities[id][account] = 0
+
+@external
+def modify_parameters_addr(id: bytes32, parameter: String[32], addr: address):
+    self._check_authority(id)
+    if (parameter == "updater"):
+        self.controllers[id].updater = addr
+    else:
+        raise "PIController/modify-unrecognized-param"
+    log ModifyParametersAddr(id, parameter, addr)
+
+@external
+def modify_parameters_uint(id: bytes32, parameter: String[32], val: uint256):
+    self._check_authority(id)
+    leak_and_cache: uint256 = self.controllers[id].leak_and_cache
+    if (parameter == "per_second_integral_leak"):
+        assert val <= pi_math.TWENTY_SEVEN_DECIMAL_NUMBER, "PIController/invalid-per_second_integral_leak"
+        self.controllers[id].leak_and_cache = pi_math._pack_leak_and_cache(val, (leak_and_cache >> 96) & pi_math.LOW_32_MASK)
+    elif (parameter == "leak_cadence"):
+        self.controllers[id].leak_and_cache = pi_math._pack_leak_and_cache(leak_and_cache & pi_math.LOW_96_MASK, val)
+    else:
+        raise "PIController/modify-unrecognized-param"
+    log ModifyParametersUint(id, parameter, val)
+
+@external
+def modify_parameters_int(id: bytes32, parameter: String[32], val: int256):
+    self._check_authority(id)
+    if (parameter == "output_upper_bound"):
+        lower: int256 = pi_math._low_int128(self.controllers[id].output_bounds)
+        assert val > lower, "PIController/invalid-output_upper_bound"
+        self.controllers[id].output_bounds = pi_math._pack_bounds(val, lower)
+    elif (parameter == "output_lower_bound"):
+        upper: int256 = pi_math._high_int128(self.controllers[id].output_bounds)
+        assert val < upper, "PIController/invalid-output_lower_bound"
+        self.controllers[id].output_bounds = pi_math._pack_bounds(upper, val)
+    elif (parameter == "kp"):
+        self.controllers[id].kp = val
+    elif (parameter == "ki"):
+        self.controllers[id].ki = val
+    elif (parameter == "co_bias"):
+        self.controllers[id].co_bias = val
+    elif (parameter == "error_integral"):
+        self.controllers[id].error_integral = val
+    else:
+        raise "PIController/modify-unrecognized-param"
+    log ModifyParametersInt(id, parameter, val)
+
+@external
+@view
+def kp(id: bytes32) -> int256:
+    return self.controllers[id].kp
+
+@external
+@view
+def ki(id: bytes32) -> int256:
+    return self.controllers[id].ki
+
+@external
+@view
+def co_bias(id: bytes32) -> int256:
+    return self.controllers[id].co_bias
+
+@external
+@view
+def error_integral(id: bytes32) -> int256:
+    return self.controllers[id].error_integral
+
+@external
+@view
+def last_error(id: bytes32) -> int256:
+    return self.controllers[id].last_error
+
+@external
+@view
+def updater(id: bytes32) -> address:
+    return self.controllers[id].updater
+
+@external
+@view
+def per_second_integral_leak(id: bytes32) -> uint256:
+    return self.controllers[id].leak_and_cache & pi_math.LOW_96_MASK
+
+@external
+@view
+def leak_cadence(id: bytes32) -> uint256:
+    return (self.controllers[id].leak_and_cache >> 96) & pi_math.LOW_32_MASK
+
+@external
+@view
+def output_upper_bound(id: bytes32) -> int256:
+    return pi_math._high_int128(self.controllers[id].output_bounds)
+
+@external
+@view
+def output_lower_bound(id: bytes32) -> int256:
+    return pi_math._low_int128(self.controllers[id].output_bounds)
+
+@external
+@view
+def last_update_time(id: bytes32) -> uint256:
+    return self.controllers[id].last_output_and_time & pi_math.LOW_64_MASK
+
+@external
+@view
+def last_update(id: bytes32) -> (uint256, int256, int256, int256):
+    last_output_and_time: uint256 = self.controllers[id].last_output_and_time
+    return (last_output_and_time & pi_math.LOW_64_MASK, pi_math._high_int128(last_output_and_time),
+            self.controllers[id].last_p_output, self.controllers[id].last_i_output)
+
+@external
+@view
+def elapsed(id: bytes32) -> uint256:
+    return pi_math._elapsed(self.controllers[id].last_output_and_time & pi_math.LOW_64_MASK)
+
+@external
+@view
+def get_state(id: bytes32) -> pi_math.Snapshot:
+    c: ControllerState = self.controllers[id]
+    # registry controllers have no output deadband
+    return pi_math._snapshot(id, c.kp, c.ki, c.co_bias, c.output_bounds, c.leak_and_cache, 0,
+                             c.error_integral, c.last_error, c.last_output_and_time,
+                             c.last_p_output, c.last_i_output, c.updater)
+
+@external
+@view
+def get_new_error_integral(id: bytes32, error: int256) -> (int256, int256):
+    return pi_math._get_new_error_integral(error, self.controllers[id].last_error,
+                                           self.controllers[id].error_integral,
+                                           pi_math._elapsed(self.controllers[id].last_output_and_time & pi_math.LOW_64_MASK),
+                                           self.controllers[id].leak_and_cache)
+
+@external
+@view
+def get_new_pi_output(id: bytes32, error: int256) -> (int256, int256, int256):
+    new_error_integral: int256 = 0
+    tmp: int256 = 0
+    (new_error_integral, tmp) = pi_math._get_new_error_integral(error, self.controllers[id].last_error,
+                                                                self.controllers[id].error_integral,
+                                                                pi_math._elapsed(self.controllers[id].last_output_and_time & pi_math.LOW_64_MASK),
+                                                                self.controllers[id].leak_and_cache)
+
+    pi_output: int256 = 0
+    p_output: int256 = 0
+    i_output: int256 = 0
+    (pi_output, p_output, i_output) = pi_math._get_raw_pi_output(error, new_error_integral, self.controllers[id].kp,
+                                                                 self.controllers[id].ki, self.controllers[id].co_bias)
+
+    return (pi_math._bound_pi_output(pi_output, self.controllers[id].output_bounds), p_output, i_output)
+
+@external
+@view
+def get_new_pi_outputs(id: bytes32, queries: DynArray[pi_math.ErrorAt, pi_math.MAX_WHAT_IFS]) -> DynArray[pi_math.PIOutput, pi_math.MAX_WHAT_IFS]:
+    return pi_math._get_new_pi_outputs(queries, self.controllers[id].last_error, self.controllers[id].error_integral,
+                                       self.controllers[id].last_output_and_time & pi_math.LOW_64_MASK,
+                                       self.controllers[id].leak_and_cache, self.controllers[id].kp,
+                                       self.controllers[id].ki, self.controllers[id].co_bias,
+                                       self.controllers[id].output_bounds)
+
+@internal
+def _update(id: bytes32, error: int256) -> (int256, int256, int256):
+    # update() of PIController.vy for one entry of the registry
+    assert self.controllers[id].updater == msg.sender, "PIController/invalid-msg-sender"
+
+    last_update_time: uint256 = self.controllers[id].last_output_and_time & pi_math.LOW_64_MASK
+    assert block.timestamp > last_update_time, "PIController/wait-longer"
+
+    # Every slot below is read exactly once per update
+    error_integral: int256 = self.controllers[id].error_integral
+    bounds: uint256 = self.controllers[id].output_bounds
+
+    new_error_integral: int256 = 0
+    new_area: int256 = 0
+    (new_error_integral, new_area) = pi_math._get_new_error_integral(error, self.controllers[id].last_error,
+                                                                     error_integral,
+                                                                     pi_math._elapsed(last_update_time),
+                                                                     self.controllers[id].leak_and_cache)
+
+    pi_output: int256 = 0
+    p_output: int256 = 0
+    i_output: int256 = 0
+    (pi_output, p_output, i_output) = pi_math._get_raw_pi_output(error, new_error_integral, self.controllers[id].kp,
+                                                                 self.controllers[id].ki, self.controllers[id].co_bias)
+
+    bounded_pi_output: int256 = pi_math._bound_pi_output(pi_output, bounds)
+
+    clamped_error_integral: int256 = pi_math.clamp_error_integral(bounded_pi_output, new_error_integral,
+                                                                  new_area, error_integral, bounds)
+    self.controllers[id].error_integral = clamped_error_integral
+    self.controllers[id].last_error = error
+
+    output_and_time: uint256 = pi_math._pack_last_output_and_time(bounded_pi_output, block.timestamp)
+    self.controllers[id].last_output_and_time = output_and_time
+    self.controllers[id].last_p_output = p_output
+    self.controllers[id].last_i_output = i_output
+
+    log UpdateEvent(id, error, clamped_error_integral, p_output, i_output, output_and_time)
+
+    return (bounded_pi_output, p_output, i_output)
+
+@external
+def update(id: bytes32, error: int256) -> (int256, int256, int256):
+    return self._update(id, error)
+
+@external
+def update_many(ids: DynArray[bytes32, MAX_UPDATES],
+                errors: DynArray[int256, MAX_UPDATES]) -> DynArray[int256, MAX_UPDATES]:
+    # Reverts as a whole if any single update would
+    assert len(ids) == len(errors), "PIControllerRegistry/length-mismatch"
+    outputs: DynArray[int256, MAX_UPDATES] = []
+    for i: uint256 in range(len(ids), bound=MAX_UPDATES):
+        bounded_pi_output: int256 = 0
+        p_output: int256 = 0
+        i_output: int256 = 0
+        (bounded_pi_output, p_output, i_output) = self._update(ids[i], errors[i])
+        outputs.append(bounded_pi_output)
+    return outputs
+
+@external
+@pure
+def rpower(x: uint256, n: uint256, base: uint256) -> uint256:
+    return pi_math._rpower(x, n, base)
@@ -0,0 +1,370 @@
+#pragma version >0.3.10
+# Controller math shared by PIController.vy and PIControllerRegistry.vy. Every
+# function is pure (or only reads the block), so importing contracts pass in the
+# storage they have already loaded.
+
+TWENTY_SEVEN_DECIMAL_NUMBER: constant(uint256) = 10 ** 27
+EIGHTEEN_DECIMAL_NUMBER: constant(int256) = 10**18
+RAY: constant(uint256) = 10 ** 27
+
+LOW_128_MASK: constant(uint256) = 2**128 - 1
+LOW_64_MASK: constant(uint256) = 2**64 - 1
+LOW_96_MASK: constant(uint256) = 2**96 - 1
+LOW_32_MASK: constant(uint256) = 2**32 - 1
+LOW_160_MASK: constant(uint256) = 2**160 - 1
+
+MAX_WHAT_IFS: constant(uint256) = 256
+
+# Ring of observations kept by update() once observation_cardinality is set (see
+# Observation). Its index, cardinality and count, 16 bits each, are bits 64-111 of
+# last_output_and_time; all zero while no ring is kept.
+MAX_OBSERVATIONS: constant(uint256) = 1024
+RING_SHIFT: constant(uint256) = 64
+RING_MASK: constant(uint256) = (2**48 - 1) << RING_SHIFT
+LOW_16_MASK: constant(uint256) = 2**16 - 1
+# Probes of the binary search over a full ring, log2(MAX_OBSERVATIONS) + 1
+MAX_OBSERVATION_PROBES: constant(uint256) = 11
+
+# Bits of the mask passed to set_parameters(), one per field of Parameters
+SET_KP: constant(uint256) = 1
+SET_KI: constant(uint256) = 2
+SET_CO_BIAS: constant(uint256) = 4
+SET_OUTPUT_UPPER_BOUND: constant(uint256) = 8
+SET_OUTPUT_LOWER_BOUND: constant(uint256) = 16
+SET_PER_SECOND_INTEGRAL_LEAK: constant(uint256) = 32
+SET_LEAK_CADENCE: constant(uint256) = 64
+SET_ERROR_INTEGRAL: constant(uint256) = 128
+SET_OUTPUT_DEADBAND: constant(uint256) = 256
+SET_ALL: constant(uint256) = 511
+
+# An error reported to update() at a given timestamp
+struct ErrorAt:
+    error: int256
+    timestamp: uint256
+
+struct PIOutput:
+    bounded_pi_output: int256
+    p_output: int256
+    i_output: int256
+
+# Values for set_parameters(); only the fields selected by its mask are applied
+struct Parameters:
+    kp: int256
+    ki: int256
+    co_bias: int256
+    output_upper_bound: int256
+    output_lower_bound: int256
+    per_second_integral_leak: uint256
+    leak_cadence: uint256
+    error_integral: int256
+    output_deadband: uint256
+
+# Time integrals of the bounded output and of the error up to one update, as in a
+# Uniswap oracle. Both wrap, the output's at 192 bits, so a difference over a window
+# is exact whenever the true integral over that window fits.
+struct Observation:
+    # output integral in the high 192 bits, timestamp in the low 64
+    output_cumulative_and_time: uint256
+    error_cumulative: int256
+
+# The state update() stores
+struct UpdateState:
+    error_integral: int256
+    last_error: int256
+    last_update_time: uint256
+    last_output: int256
+    last_p_output: int256
+    last_i_output: int256
+
+# Every parameter and state variable of one controller, as returned by get_state()
+struct Snapshot:
+    control_variable: bytes32
+    kp: int256
+    ki: int256
+    co_bias: int256
+    output_upper_bound: int256
+    output_lower_bound: int256
+    per_second_integral_leak: uint256
+    leak_cadence: uint256
+    output_deadband: uint256
+    error_integral: int256
+    last_error: int256
+    last_update_time: uint256
+    last_output: int256
+    last_p_output: int256
+    last_i_output: int256
+    elapsed: uint256
+    updater: address
+
+@internal
+@pure
+def _to_word(x: int256) -> uint256:
+    # two's-complement bits of an int128 value; reverts if x is out of int128 range
+    return convert(convert(convert(x, int128), bytes32), uint256)
+
+@internal
+@pure
+def _high_int128(word: uint256) -> int256:
+    return convert(convert(word, bytes32), int256) >> 128
+
+@internal
+@pure
+def _low_int128(word: uint256) -> int256:
+    return convert(convert(word << 128, bytes32), int256) >> 128
+
+@internal
+@pure
+def _pack_bounds(upper: int256, lower: int256) -> uint256:
+    return (self._to_word(upper) << 128) | (self._to_word(lower) & LOW_128_MASK)
+
+@internal
+@pure
+def _pack_last_output_and_time(last_output: int256, last_update_time: uint256) -> uint256:
+    return (self._to_word(last_output) << 128) | convert(convert(last_update_time, uint64), uint256)
+
+@internal
+@pure
+def _rpower(x: uint256, n: uint256, base: uint256) -> uint256:
+    # Same result and reverts as rpower() in orig/src/PIController.sol: exponentiation
+    # by squaring with rounding to `base`, stopping as soon as the exponent runs out.
+    # The overflow checks are spelled out as in the assembly, which is cheaper here
+    # than Vyper's checked arithmetic.
+    if x == 0:
+        return base if n == 0 else 0
+
+    z: uint256 = base if n & 1 == 0 else x
+    half: uint256 = base >> 1
+    w: uint256 = x
+    m: uint256 = n >> 1
+    # at most one iteration per bit of n
+    for i: uint256 in range(256):
+        if m == 0:
+            break
+        ww: uint256 = unsafe_mul(w, w)
+        assert unsafe_div(ww, w) == w
+        ww_round: uint256 = unsafe_add(ww, half)
+        assert ww_round >= ww
+        w = unsafe_div(ww_round, base)
+        if m & 1 != 0:
+            zw: uint256 = unsafe_mul(z, w)
+            assert w == 0 or unsafe_div(zw, w) == z
+            zw_round: uint256 = unsafe_add(zw, half)
+            assert zw_round >= zw
+            z = unsafe_div(zw_round, base)
+        m = m >> 1
+    return z
+
+@internal
+@pure
+def _pack_leak_and_cache(leak: uint256, cadence: uint256) -> uint256:
+    # leak <= RAY < 2**96, so the cached factor is <= RAY as well
+    cached_leak: uint256 = RAY if leak == RAY else self._rpower(leak, cadence, RAY)
+    return (cached_leak << 128) | (convert(convert(cadence, uint32), uint256) << 96) | leak
+
+@internal
+@view
+def _elapsed(last_update_time: uint256) -> uint256:
+    return 0 if last_update_time == 0 else block.timestamp - last_update_time
+
+@internal
+@pure
+def _elapsed_at(last_update_time: uint256, timestamp: uint256) -> uint256:
+    # reverts for a timestamp before the last update
+    return 0 if last_update_time == 0 else timestamp - last_update_time
+
+@internal
+@pure
+def _riemann_sum(x: int256, y: int256)-> int256:
+    return (x + y) // 2
+
+@internal
+@pure
+def _accumulated_leak(leak_and_cache: uint256, elapsed: uint256) -> uint256:
+    leak: uint256 = leak_and_cache & LOW_96_MASK
+    if leak == RAY:
+        return RAY
+    if elapsed == (leak_and_cache >> 96) & LOW_32_MASK:
+        return leak_and_cache >> 128
+    return self._rpower(leak, elapsed, RAY)
+
+@internal
+@pure
+def _get_new_error_integral(error: int256, last_error: int256, error_integral: int256,
+                            elapsed: uint256, leak_and_cache: uint256) -> (int256, int256):
+    new_time_adjusted_error: int256 = self._riemann_sum(error, last_error) * convert(elapsed, int256)
+
+    accumulated_leak: uint256 = self._accumulated_leak(leak_and_cache, elapsed)
+    leaked_error_integral: int256 = (convert(accumulated_leak, int256) * error_integral) // convert(TWENTY_SEVEN_DECIMAL_NUMBER, int256)
+    
+    return (leaked_error_integral + new_time_adjusted_error, new_time_adjusted_error)
+
+@internal
+@pure
+def _get_raw_pi_output(error: int256, errorI: int256, kp: int256, ki: int256, co_bias: int256) -> (int256, int256, int256):
+    # // output = P + I = Kp * error + Ki * errorI
+    p_output: int256 = (error * kp) // EIGHTEEN_DECIMAL_NUMBER
+    i_output: int256 = (errorI * ki) // EIGHTEEN_DECIMAL_NUMBER
+
+    return (co_bias + p_output + i_output, p_output, i_output)
+
+@internal
+@pure
+def _bound_pi_output(pi_output: int256, bounds: uint256) -> int256:
+    bounded_pi_output: int256 = pi_output
+    lower: int256 = self._low_int128(bounds)
+    if pi_output < lower:
+        bounded_pi_output = lower
+    else:
+        upper: int256 = self._high_int128(bounds)
+        if pi_output > upper:
+            bounded_pi_output = upper
+
+    return bounded_pi_output
+
+@internal
+@pure
+def clamp_error_integral(bounded_pi_output:int256, new_error_integral: int256, new_area: int256,
+                         error_integral: int256, bounds: uint256) -> int256:
+    clamped_error_integral: int256 = new_error_integral
+    if (new_area < 0 and error_integral < 0 and bounded_pi_output == self._low_int128(bounds)):
+        clamped_error_integral = clamped_error_integral - new_area
+    elif (new_area > 0 and error_integral > 0 and bounded_pi_output == self._high_int128(bounds)):
+        clamped_error_integral = clamped_error_integral - new_area
+    return clamped_error_integral
+
+@internal
+@pure
+def _get_new_pi_outputs(queries: DynArray[ErrorAt, MAX_WHAT_IFS], last_error: int256, error_integral: int256,
+                        last_update_time: uint256, leak_and_cache: uint256, kp: int256, ki: int256,
+                        co_bias: int256, bounds: uint256) -> DynArray[PIOutput, MAX_WHAT_IFS]:
+    # get_new_pi_output() for each query, as if update() ran next at its timestamp
+    outputs: DynArray[PIOutput, MAX_WHAT_IFS] = []
+    for query: ErrorAt in queries:
+        new_error_integral: int256 = 0
+        tmp: int256 = 0
+        (new_error_integral, tmp) = self._get_new_error_integral(query.error, last_error, error_integral,
+                                                                 self._elapsed_at(last_update_time, query.timestamp),
+                                                                 leak_and_cache)
+
+        pi_output: int256 = 0
+        p_output: int256 = 0
+        i_output: int256 = 0
+        (pi_output, p_output, i_output) = self._get_raw_pi_output(query.error, new_error_integral, kp, ki, co_bias)
+
+        outputs.append(PIOutput(bounded_pi_output=self._bound_pi_output(pi_output, bounds),
+                                p_output=p_output, i_output=i_output))
+    return outputs
+
+@internal
+@pure
+def _within_deadband(bounded_pi_output: int256, last_output: int256, deadband: uint256) -> bool:
+    # both outputs are int128 and deadband < 2**96, so nothing can overflow; 0 never matches
+    return abs(unsafe_sub(bounded_pi_output, last_output)) < convert(deadband, int256)
+
+@internal
+@pure
+def _fast_forward(error: int256, timestamp: uint256, last_error: int256, error_integral: int256,
+                  last_output_and_time: uint256, last_p_output: int256, last_i_output: int256,
+                  leak_and_cache: uint256, kp: int256, ki: int256, co_bias: int256, bounds: uint256,
+                  deadband: uint256) -> UpdateState:
+    # The state update(error) would store at `timestamp`, however long after the last
+    # update: the leak is one _rpower over the whole gap and the area one product
+    last_update_time: uint256 = last_output_and_time & LOW_64_MASK
+    assert timestamp > last_update_time, "PIController/wait-longer"
+
+    new_error_integral: int256 = 0
+    new_area: int256 = 0
+    (new_error_integral, new_area) = self._get_new_error_integral(error, last_error, error_integral,
+                                                                  self._elapsed_at(last_update_time, timestamp),
+                                                                  leak_and_cache)
+
+    pi_output: int256 = 0
+    p_output: int256 = 0
+    i_output: int256 = 0
+    (pi_output, p_output, i_output) = self._get_raw_pi_output(error, new_error_integral, kp, ki, co_bias)
+
+    bounded_pi_output: int256 = self._bound_pi_output(pi_output, bounds)
+    state: UpdateState = UpdateState(
+        error_integral=self.clamp_error_integral(bounded_pi_output, new_error_integral, new_area,
+                                                 error_integral, bounds),
+        last_error=error,
+        last_update_time=timestamp,
+        last_output=bounded_pi_output,
+        last_p_output=p_output,
+        last_i_output=i_output,
+    )
+    # Within the deadband update() leaves the output slots as they are
+    last_output: int256 = self._high_int128(last_output_and_time)
+    if self._within_deadband(bounded_pi_output, last_output, deadband):
+        state.last_output = last_output
+        state.last_p_output = last_p_output
+        state.last_i_output = last_i_output
+    return state
+
+@internal
+@view
+def _snapshot(control_variable: bytes32, kp: int256, ki: int256, co_bias: int256, bounds: uint256,
+              leak_and_cache: uint256, deadband: uint256, error_integral: int256, last_error: int256,
+              last_output_and_time: uint256, last_p_output: int256, last_i_output: int256,
+              updater: address) -> Snapshot:
+    last_update_time: uint256 = last_output_and_time & LOW_64_MASK
+    return Snapshot(
+        control_variable=control_variable,
+        kp=kp,
+        ki=ki,
+        co_bias=co_bias,
+        output_upper_bound=self._high_int128(bounds),
+        output_lower_bound=self._low_int128(bounds),
+        per_second_integral_leak=leak_and_cache & LOW_96_MASK,
+        leak_cadence=(leak_and_cache >> 96) & LOW_32_MASK,
+        output_deadband=deadband,
+        error_integral=error_integral,
+        last_error=last_error,
+        last_update_time=last_update_time,
+        last_output=self._high_int128(last_output_and_time),
+        last_p_output=last_p_output,
+        last_i_output=last_i_output,
+        elapsed=self._elapsed(last_update_time),
+        updater=updater,
+    )
+
+@internal
+@pure
+def _pack_ring(index: uint256, cardinality: uint256, count: uint256) -> uint256:
+    # the ring's bits of last_output_and_time
+    return (index | (cardinality << 16) | (count << 32)) << RING_SHIFT
+
+@internal
+@pure
+def _unpack_ring(word: uint256) -> (uint256, uint256, uint256):
+    # (index of the latest observation, cardinality, observations recorded)
+    ring: uint256 = word >> RING_SHIFT
+    return (ring & LOW_16_MASK, (ring >> 16) & LOW_16_MASK, (ring >> 32) & LOW_16_MASK)
+
+@internal
+@pure
+def _as_word(x: int256) -> uint256:
+    return convert(convert(x, bytes32), uint256)
+
+@internal
+@pure
+def _observe(previous: Observation, output: int256, error: int256, timestamp: uint256) -> Observation:
+    # The observation at `timestamp` when `output` and `error` held since `previous`.
+    # |output| < 2**127 and elapsed < 2**64, so the output's product is exact.
+    elapsed: int256 = convert(unsafe_sub(timestamp, previous.output_cumulative_and_time & LOW_64_MASK), int256)
+    output_cumulative: uint256 = unsafe_add(previous.output_cumulative_and_time >> 64,
+                                            self._as_word(unsafe_mul(output, elapsed)))
+    return Observation(output_cumulative_and_time=(output_cumulative << 64) | timestamp,
+                       error_cumulative=unsafe_add(previous.error_cumulative, unsafe_mul(error, elapsed)))
+
+@internal
+@pure
+def _average(old: Observation, new: Observation) -> (int256, int256):
+    # Time-weighted averages of the output and the error between two observations,
+    # rounded toward zero
+    elapsed: int256 = convert(unsafe_sub(new.output_cumulative_and_time & LOW_64_MASK,
+                                         old.output_cumulative_and_time & LOW_64_MASK), int256)
+    output_integral: uint256 = unsafe_sub(new.output_cumulative_and_time >> 64, old.output_cumulative_and_time >> 64)
+    # sign-extended from 192 bits
+    output: int256 = convert(convert(output_integral << 64, bytes32), int256) >> 64
+    return (output // elapsed, unsafe_sub(new.error_cumulative, old.error_cumulative) // elapsed)
@@ -0,0 +1,6 @@
+from picontroller.model import ControllerState, PIControllerModel, Revert, parameters_and_mask
+from picontroller.snapshot import ControllerSnapshot, decode_snapshot, read_snapshot
+from picontroller.trace import Trace, TraceWriter
+
+__all__ = ["ControllerSnapshot", "ControllerState", "PIControllerModel", "Revert", "Trace", "TraceWriter",
+           "decode_snapshot", "read_snapshot"]
@@ -0,0 +1,242 @@
+"""
+Vectorized model that steps many independent PIController states at once.
+
+Each lane of the batch is one controller with its own gains, bounds and state.
+Lanes are stepped with NumPy int64 arrays while every intermediate value of the
+step provably fits in 62 bits; as soon as a step could leave that range the
+batch is promoted, permanently, to object arrays of Python ints, which are
+exact at any width. NumPy has no int128 dtype, so there is no middle tier.
+
+Each lane is a controller with output_deadband = 0: the batch has no deadband,
+no leak cadence and no observation ring. The cached leak factor and the ring
+never change an output, so for such controllers results are bit-identical to
+picontroller.model and therefore to the contract: a lane whose step would
+revert keeps its previous state and is reported in the `reverted` mask returned
+by `update`. As in the contract's packed output_bounds slot, bounds must fit
+int128.
+"""
+from functools import lru_cache
+
+import numpy as np
+
+from picontroller.model import (
+    EIGHTEEN_DECIMAL_NUMBER,
+    MAX_INT256,
+    MAX_UINT256,
+    MIN_INT256,
+    MAX_INT128,
+    MIN_INT128,
+    RAY,
+    TWENTY_SEVEN_DECIMAL_NUMBER,
+    Revert,
+    rpower,
+)
+
+# Headroom kept below 2**63 so float64 magnitude estimates can't misjudge a lane.
+MAX_FAST = 2 ** 62
+MIN_FAST = -(2 ** 62)
+FAST_PATH_LIMIT = float(MAX_FAST)
+
+_PARAMS = ("kp", "ki", "co_bias", "output_upper_bound", "output_lower_bound", "per_second_integral_leak")
+_STATE = ("error_integral", "last_error", "last_output", "last_p_output", "last_i_output")
+
+
+def _tdiv(x, d):
+    """Truncating division of a signed array by a positive constant."""
+    q = np.abs(x) // d
+    return np.where(x < 0, -q, q)
+
+
+@lru_cache(maxsize=1024)
+def _shared_leak(leak, elapsed):
+    """Accumulated leak when every lane has the same leak and elapsed time; None on overflow."""
+    try:
+        return rpower(leak, elapsed, RAY)
+    except Revert:
+        return None
+
+
+def _rpower(x, n, base, bad):
+    """
+    Lane-wise model.rpower over object arrays `x` and int64 exponents `n`;
+    lanes whose intermediate products overflow uint256 are marked in `bad`.
+    """
+    z = np.where(n % 2 == 0, base, x)
+    z = np.where(x == 0, np.where(n == 0, base, 0), z).astype(object)
+    half = base // 2
+    n = n // 2
+    while np.any(n):
+        active = n > 0
+        xx = x * x + half
+        bad |= active & (xx > MAX_UINT256)
+        x = np.where(active, xx // base, x)
+        odd = active & (n % 2 == 1)
+        zx = z * x + half
+        bad |= odd & (zx > MAX_UINT256)
+        z = np.where(odd, zx // base, z)
+        n = n // 2
+    return z
+
+
+def _as_array(value, n):
+    """Signed int64 array when NumPy picks one, object array of Python ints otherwise."""
+    if np.ndim(value) == 0:
+        return np.full(n, int(value), dtype=object)
+    arr = np.asarray(value)
+    if arr.dtype.kind not in "iO":
+        arr = np.array([int(v) for v in arr], dtype=object)
+    if arr.shape != (n,):
+        raise ValueError(f"expected {n} values, got shape {arr.shape}")
+    return arr
+
+
+def _fits_int64(arr):
+    return bool(np.all((arr <= MAX_FAST) & (arr >= MIN_FAST)))
+
+
+class BatchPIController:
+    """
+    `n` independent controllers. Constructor arguments are either scalars,
+    shared by every lane, or sequences of length `n`.
+    """
+
+    def __init__(self, n, kp, ki, co_bias, per_second_integral_leak,
+                 output_upper_bound, output_lower_bound, imported_state=(0, 0, 0)):
+        self.n = n
+        values = dict(
+            kp=kp, ki=ki, co_bias=co_bias,
+            per_second_integral_leak=per_second_integral_leak,
+            output_upper_bound=output_upper_bound,
+            output_lower_bound=output_lower_bound,
+            last_update_time=imported_state[0],
+            last_error=imported_state[1],
+            error_integral=imported_state[2],
+            last_output=0, last_p_output=0, last_i_output=0,
+        )
+        arrays = {k: _as_array(v, n) for k, v in values.items()}
+        if np.any(arrays["output_upper_bound"] <= arrays["output_lower_bound"]):
+            raise ValueError("PIController/invalid-bounds")
+        for name in ("output_upper_bound", "output_lower_bound"):
+            if np.any((arrays[name] > MAX_INT128) | (arrays[name] < MIN_INT128)):
+                raise ValueError(f"{name} must fit in int128")
+
+        self.last_update_time = arrays.pop("last_update_time").astype(np.int64)
+        self.per_second_integral_leak = arrays.pop("per_second_integral_leak")
+
+        self.wide = not all(_fits_int64(a) for a in arrays.values())
+        for name, arr in arrays.items():
+            setattr(self, name, arr if self.wide else arr.astype(np.int64))
+
+    def _widen(self):
+        for name in _PARAMS[:-1] + _STATE:
+            setattr(self, name, getattr(self, name).astype(object))
+        self.wide = True
+
+    def _fast_path_safe(self, errors, elapsed):
+        f = np.float64
+        e = np.abs(errors.astype(f))
+        area = (e + np.abs(self.last_error.astype(f))) * elapsed.astype(f)
+        integral = np.abs(self.error_integral.astype(f)) + area
+        p = e * np.abs(self.kp.astype(f))
+        i = integral * np.abs(self.ki.astype(f))
+        total = np.abs(self.co_bias.astype(f)) + p + i
+        return bool(
+            np.all(self.per_second_integral_leak == RAY)
+            and np.all(integral + area < FAST_PATH_LIMIT)
+            and np.all(p < FAST_PATH_LIMIT)
+            and np.all(i < FAST_PATH_LIMIT)
+            and np.all(total < FAST_PATH_LIMIT)
+        )
+
+    def _elapsed(self, timestamps):
+        return np.where(self.last_update_time == 0, 0, timestamps - self.last_update_time)
+
+    def _step(self, errors, elapsed, bad):
+        """Core of `update`; marks overflowing lanes in `bad` when running wide."""
+        wide = self.wide
+
+        def checked(x):
+            if wide:
+                bad[:] |= (x > MAX_INT256) | (x < MIN_INT256)
+            return x
+
+        riemann = _tdiv(checked(errors + self.last_error), 2)
+        new_area = checked(riemann * elapsed.astype(errors.dtype))
+
+        leak = self.per_second_integral_leak
+        if np.all(leak == RAY):
+            accumulated_leak = RAY
+        else:
+            accumulated_leak = None
+            if np.all(leak == leak[0]) and np.all(elapsed == elapsed[0]):
+                # Lanes stepped in lockstep share one factor, like the contract's leak cadence cache
+                accumulated_leak = _shared_leak(int(leak[0]), int(elapsed[0]))
+            if accumulated_leak is None:
+                # Lanes at RAY come out of rpower as exactly RAY
+                accumulated_leak = _rpower(leak, elapsed, RAY, bad)
+        if wide:
+            leaked = _tdiv(checked(accumulated_leak * self.error_integral), TWENTY_SEVEN_DECIMAL_NUMBER)
+        else:
+            # RAY * x // RAY == x for any x that fits in 62 bits.
+            leaked = self.error_integral
+        new_integral = checked(leaked + new_area)
+
+        p_output = _tdiv(checked(errors * self.kp), EIGHTEEN_DECIMAL_NUMBER)
+        i_output = _tdiv(checked(new_integral * self.ki), EIGHTEEN_DECIMAL_NUMBER)
+        pi_output = checked(checked(self.co_bias + p_output) + i_output)
+
+        lower, upper = self.output_lower_bound, self.output_upper_bound
+        bounded = np.where(pi_output < lower, lower, np.where(pi_output > upper, upper, pi_output))
+
+        clamp = (
+            ((bounded == lower) & (new_area < 0) & (self.error_integral < 0))
+            | ((bounded == upper) & (new_area > 0) & (self.error_integral > 0))
+        )
+        clamped = checked(np.where(clamp, new_integral - new_area, new_integral))
+        return clamped, bounded, p_output, i_output
+
+    def update(self, errors, timestamps):
+        """
+        Step every lane by `update(errors[k])` mined at `timestamps[k]`
+        (a scalar timestamp is shared by all lanes).
+
+        Returns (bounded_output, p_output, i_output, reverted); outputs of
+        reverted lanes are zero.
+        """
+        errors = _as_array(errors, self.n)
+        timestamps = np.broadcast_to(np.asarray(timestamps, dtype=np.int64), (self.n,))
+
+        bad = ~(timestamps > self.last_update_time)
+        elapsed = np.where(bad, 0, self._elapsed(timestamps))
+
+        if not self.wide:
+            if _fits_int64(errors) and self._fast_path_safe(errors.astype(np.int64), elapsed):
+                errors = errors.astype(np.int64)
+            else:
+                self._widen()
+        if self.wide:
+            errors = errors.astype(object)
+
+        bad = np.array(bad)
+        integral, bounded, p_output, i_output = self._step(errors, elapsed, bad)
+
+        ok = ~bad
+        self.error_integral = np.where(ok, integral, self.error_integral)
+        self.last_error = np.where(ok, errors, self.last_error)
+        self.last_update_time = np.where(ok, timestamps, self.last_update_time)
+        self.last_output = np.where(ok, bounded, self.last_output)
+        self.last_p_output = np.where(ok, p_output, self.last_p_output)
+        self.last_i_output = np.where(ok, i_output, self.last_i_output)
+
+        zero = self.last_output.dtype.type(0)
+        return (np.where(ok, bounded, zero), np.where(ok, p_output, zero),
+                np.where(ok, i_output, zero), bad)
+
+    def run(self, errors, timestamps):
+        """
+        Apply a (steps, n) block of errors at a (steps,) or (steps, n) block
+        of timestamps. Returns stacked (bounded_output, p_output, i_output,
+        reverted) arrays of shape (steps, n).
+        """
+        results = [self.update(e, t) for e, t in zip(errors, timestamps)]
+        return tuple(np.stack(col) for col in zip(*results))
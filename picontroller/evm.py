@@ -0,0 +1,277 @@
+"""
+In-process EVM for running the compiled controllers without a node.
+
+`LocalEVM` wraps a single py-evm Cancun state: contracts are deployed from their
+initcode and called with raw calldata, the block timestamp is set directly, and
+state can be snapshotted and reverted. Nothing goes through ape, web3 or RPC,
+so a process can own one and execute calls at py-evm speed.
+
+`PIControllerEVM` deploys the compiled PIController.vy into one and exposes the
+model's interface on the real bytecode. Every ABI function gets a `Method` with
+its selector and argument layout worked out once: calldata for integer-only
+arguments is packed word by word, and return data is decoded by slicing words
+or, for structs and dynamic types, with a decoder built once per method.
+"""
+import re
+from functools import lru_cache
+from pathlib import Path
+from typing import NamedTuple
+
+from eth.constants import BLANK_ROOT_HASH, CREATE_CONTRACT_ADDRESS
+from eth.db.atomic import AtomicDB
+from eth.vm.execution_context import ExecutionContext
+from eth.vm.forks.cancun.computation import CancunComputation
+from eth.vm.forks.cancun.state import CancunState
+from eth.vm.message import Message
+from eth_abi import decode, encode
+from eth_abi.decoding import ContextFramesBytesIO, TupleDecoder
+from eth_abi.registry import registry
+from eth_utils import keccak
+
+from picontroller.model import Revert
+
+OWNER = b'\x11' * 20
+CONTRACTS = Path(__file__).parent.parent / "contracts"
+ORIG = Path(__file__).parent.parent / "orig"
+
+DEFAULT_GAS = 30_000_000
+
+
+class CallResult(NamedTuple):
+    success: bool
+    output: bytes
+    gas_used: int
+
+
+def _split_types(types):
+    """Top-level comma split of an ABI type list, keeping tuple types whole."""
+    parts, depth, start = [], 0, 0
+    for i, char in enumerate(types):
+        if char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif char == "," and depth == 0:
+            parts.append(types[start:i])
+            start = i + 1
+    if types[start:]:
+        parts.append(types[start:])
+    return parts
+
+
+def encode_call(signature, *args):
+    """Calldata for `signature`, e.g. encode_call("update(int256)", -10**25)."""
+    types = _split_types(re.fullmatch(r"\w+\((.*)\)", signature).group(1))
+    return keccak(text=signature)[:4] + encode(types, args)
+
+
+@lru_cache
+def compile_vyper(path=CONTRACTS / "PIController.vy"):
+    """(initcode, abi) of a Vyper contract, resolving imports next to it."""
+    import vyper
+    from vyper.compiler.input_bundle import FilesystemInputBundle
+
+    path = Path(path).resolve()
+    bundle = FilesystemInputBundle([path.parent])
+    out = vyper.compile_from_file_input(bundle.load_file(path), input_bundle=bundle,
+                                        output_formats=["bytecode", "abi"])
+    return bytes.fromhex(out["bytecode"][2:]), out["abi"]
+
+
+def compile_solidity(path=ORIG / "src" / "PIController.sol", contract="PIController", version="0.6.7"):
+    """
+    (initcode, abi) of the original Solidity controller. Needs solc `version`
+    installed for py-solc-x; raises otherwise.
+    """
+    import solcx
+
+    path = Path(path).resolve()
+    root = path.parent.parent
+    out = solcx.compile_files([path], output_values=["abi", "bin"], solc_version=version,
+                              base_path=root, allow_paths=[root], import_remappings=[f"src/={root}/src/"])
+    (key,) = [k for k in out if k.endswith(f":{contract}")]
+    return bytes.fromhex(out[key]["bin"]), out[key]["abi"]
+
+
+class LocalEVM:
+    def __init__(self, timestamp=1_700_000_000, block_number=1, gas_limit=DEFAULT_GAS):
+        context = ExecutionContext(b'\0' * 20, timestamp, block_number, 0, b'\0' * 32, gas_limit,
+                                   [], 1, 0, 0)
+        self._db = AtomicDB()
+        self.state = CancunState(self._db, context, BLANK_ROOT_HASH)
+        self._deployed = 0
+
+    @property
+    def timestamp(self):
+        return self.state.timestamp
+
+    @timestamp.setter
+    def timestamp(self, value):
+        # py-evm has no setter; the context is otherwise immutable per block
+        self.state.execution_context._timestamp = value
+
+    def _transaction_context(self, sender):
+        return self.state.get_transaction_context_class()(gas_price=0, origin=sender)
+
+    def _begin_transaction(self, sender, to):
+        # A fresh access list, as at the start of a transaction
+        self.state.lock_changes()
+        self.state.mark_address_warm(sender)
+        self.state.mark_address_warm(to)
+
+    def deploy(self, initcode, args=b'', sender=OWNER, gas=DEFAULT_GAS):
+        """Deploy `initcode` with ABI-encoded constructor `args`; returns the address."""
+        self._deployed += 1
+        address = (0xC0DE << 144 | self._deployed).to_bytes(20, "big")
+        self._begin_transaction(sender, address)
+        message = Message(gas=gas, to=CREATE_CONTRACT_ADDRESS, sender=sender, value=0, data=b'',
+                          code=initcode + args, create_address=address)
+        computation = CancunComputation.apply_create_message(self.state, message,
+                                                             self._transaction_context(sender))
+        if not computation.is_success:
+            raise RuntimeError(f"deployment failed: {computation.error!r}")
+        return address
+
+    def call(self, to, data, sender=OWNER, gas=DEFAULT_GAS, computation_class=CancunComputation):
+        """
+        Execute `data` against `to` as a transaction: state changes persist
+        unless the call reverts. `gas_used` excludes the intrinsic cost. A
+        `computation_class` derived from CancunComputation can observe execution.
+        """
+        self._begin_transaction(sender, to)
+        message = Message(gas=gas, to=to, sender=sender, value=0, data=data, code=self.state.get_code(to))
+        computation = computation_class.apply_message(self.state, message, self._transaction_context(sender))
+        return CallResult(computation.is_success, computation.output, gas - computation.get_gas_remaining())
+
+    def snapshot(self):
+        """
+        State root to `revert` to. Every call starts a new transaction, which
+        drops py-evm's journal, so snapshots are persisted roots rather than
+        journal checkpoints.
+        """
+        self.state.persist()
+        return self.state.state_root
+
+    def revert(self, snapshot):
+        self.state = CancunState(self._db, self.state.execution_context, snapshot)
+
+
+# Revert data of `raise "reason"` / `assert ..., "reason"`: Error(string)
+ERROR_SELECTOR = keccak(text="Error(string)")[:4]
+
+_WORD = 2 ** 256
+
+
+def _abi_type(entry):
+    """Canonical type of an ABI input or output, with structs as tuples."""
+    if entry["type"].startswith("tuple"):
+        return f"({','.join(_abi_type(c) for c in entry['components'])}){entry['type'][5:]}"
+    return entry["type"]
+
+
+def _integer_layout(types):
+    """Per-type signedness if every type is int256 or uint256, else None."""
+    if all(t in ("int256", "uint256") for t in types):
+        return [t == "int256" for t in types]
+    return None
+
+
+def revert_reason(output):
+    """The reason string of revert data, or "" if it carries none."""
+    if output[:4] == ERROR_SELECTOR:
+        return decode(["string"], output[4:])[0]
+    return ""
+
+
+class Method:
+    """One ABI function: selector, calldata encoder and return data decoder."""
+
+    def __init__(self, abi):
+        self.name = abi["name"]
+        self.input_types = [_abi_type(i) for i in abi["inputs"]]
+        self.output_types = [_abi_type(o) for o in abi["outputs"]]
+        self.signature = f"{self.name}({','.join(self.input_types)})"
+        self.selector = keccak(text=self.signature)[:4]
+        self._inputs = _integer_layout(self.input_types)
+        self._outputs = _integer_layout(self.output_types)
+        self._decoder = TupleDecoder(decoders=[registry.get_decoder(t) for t in self.output_types])
+
+    def encode(self, *args):
+        if self._inputs is None or len(args) != len(self._inputs):
+            return self.selector + encode(self.input_types, args)
+        words = [self.selector]
+        for arg, signed in zip(args, self._inputs):
+            if not (-(_WORD >> 1) <= arg < _WORD >> 1 if signed else 0 <= arg < _WORD):
+                raise ValueError(f"{arg} does not fit the {'int' if signed else 'uint'}256 argument of {self.name}")
+            words.append((arg % _WORD).to_bytes(32, "big"))
+        return b"".join(words)
+
+    def decode(self, output):
+        """The return value; a tuple when the function returns several values."""
+        if self._outputs is not None and len(output) == 32 * len(self._outputs):
+            values = tuple(int.from_bytes(output[32 * k:32 * k + 32], "big", signed=signed)
+                           for k, signed in enumerate(self._outputs))
+        else:
+            values = self._decoder(ContextFramesBytesIO(output))
+        if not values:
+            return None
+        return values[0] if len(values) == 1 else values
+
+
+class PIControllerEVM:
+    """
+    PIController.vy deployed in a LocalEVM (a fresh one unless `evm` is given),
+    with OWNER as its updater. `update` and the timestamp-dependent views take
+    the block timestamp of the call, like PIControllerModel; a revert raises
+    model.Revert with the contract's reason. `call` reaches every other ABI
+    function. `gas_used` is the execution gas of the last call.
+    """
+
+    def __init__(self, kp, ki, co_bias, per_second_integral_leak, output_upper_bound, output_lower_bound,
+                 imported_state=(0, 0, 0), control_variable=b"PIControllerEVM", evm=None,
+                 path=CONTRACTS / "PIController.vy"):
+        initcode, abi = compile_vyper(path)
+        self.methods = {entry["name"]: Method(entry) for entry in abi if entry["type"] == "function"}
+        self._update = self.methods["update"]
+        self._get_new_pi_output = self.methods["get_new_pi_output"]
+        self._get_new_error_integral = self.methods["get_new_error_integral"]
+
+        self.evm = evm or LocalEVM()
+        args = encode(["bytes32", "int256", "int256", "int256", "uint256", "int256", "int256", "int256[3]"],
+                      [control_variable, kp, ki, co_bias, per_second_integral_leak, output_upper_bound,
+                       output_lower_bound, list(imported_state)])
+        self.address = self.evm.deploy(initcode, args)
+        self.gas_used = 0
+        self.call("modify_parameters_addr", "updater", OWNER)
+
+    def _execute(self, method, data, timestamp):
+        if timestamp is not None:
+            self.evm.timestamp = timestamp
+        result = self.evm.call(self.address, data)
+        self.gas_used = result.gas_used
+        if not result.success:
+            raise Revert(revert_reason(result.output))
+        return method.decode(result.output)
+
+    def call(self, name, *args, timestamp=None):
+        """Any ABI function by name, at `timestamp` if given."""
+        method = self.methods[name]
+        return self._execute(method, method.encode(*args), timestamp)
+
+    def update(self, error, timestamp):
+        return self._execute(self._update, self._update.encode(error), timestamp)
+
+    def get_new_pi_output(self, error, timestamp):
+        return self._execute(self._get_new_pi_output, self._get_new_pi_output.encode(error), timestamp)
+
+    def get_new_error_integral(self, error, timestamp):
+        return self._execute(self._get_new_error_integral, self._get_new_error_integral.encode(error), timestamp)
+
+    def last_update(self):
+        return self.call("last_update")
+
+    def snapshot(self):
+        return self.evm.snapshot()
+
+    def revert(self, snapshot):
+        self.evm.revert(snapshot)
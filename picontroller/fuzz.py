@@ -0,0 +1,465 @@
+"""
+Differential fuzzing of PIController.vy against orig/src/PIController.sol and
+the Python model.
+
+    python -m picontroller.fuzz --cases 1000000 --workers 16 --out fuzz-out
+
+Cases are generated from per-shard seeds, so any shard can be rerun exactly.
+Shards are spread over a process pool. Each worker deploys its own copies of
+the contracts into a LocalEVM, snapshots that state and reverts to it before
+every case. A case diverges when the implementations disagree on whether a call
+reverts or on any returned value; divergent cases are shrunk while they still
+diverge and written to the output directory as JSON.
+
+The Solidity lane needs solc 0.6.7 installed for py-solc-x; compiling or
+deploying it fails loudly. `--no-solidity` checks the Vyper contract against
+the model only.
+
+Known divergences between the two sources, which the generated cases are
+kept clear of:
+
+- orig/src/PIController.sol leaves its `seedProposer` check in `update()`
+  commented out, so anyone may update it; PIController.vy only takes updates
+  from its updater. Every lane calls from OWNER, the updater of both.
+- PIController.vy stores the output bounds as int128 and reverts on wider
+  ones; the Solidity controller takes any int256. Generated bounds fit int128,
+  and shrinking only moves them towards zero.
+- `getRawPiOutput` sums `coBias + (pOutput + iOutput)`, while
+  `pi_math._get_raw_pi_output` sums `(co_bias + p_output) + i_output`, so the
+  two overflow on different inputs when |co_bias| is near 2**255. |p_output|
+  and |i_output| are below 2**196, so the orders agree whenever
+  |co_bias| <= 2**253, and generated co_bias stays within that.
+"""
+import argparse
+import json
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+from eth_abi import decode, encode
+
+from picontroller.evm import OWNER, LocalEVM, compile_solidity, compile_vyper, encode_call
+from picontroller.model import (
+    MAX_INT128,
+    MAX_INT256,
+    MIN_INT128,
+    MIN_INT256,
+    RAY,
+    PIControllerModel,
+    Revert,
+    rpower,
+)
+
+BASE_TIMESTAMP = 1_700_000_000
+
+# Constructor arguments every lane is deployed with; cases then set their own
+# parameters through the setters, exactly like governance would
+DEPLOY_PARAMS = dict(kp=222002205862, ki=10 ** 18, co_bias=0, per_second_integral_leak=RAY,
+                     output_upper_bound=18640000000000000000, output_lower_bound=-51034000000000000000)
+CONSTRUCTOR_TYPES = ["bytes32", "int256", "int256", "int256", "uint256", "int256", "int256", "int256[3]"]
+# orig/src/PIController.sol takes the imported state as a dynamic `int256[] memory`
+SOLIDITY_CONSTRUCTOR_TYPES = CONSTRUCTOR_TYPES[:-1] + ["int256[]"]
+
+# Result of a call that reverted
+REVERTED = "revert"
+
+
+def _constructor_args(types=CONSTRUCTOR_TYPES):
+    p = DEPLOY_PARAMS
+    return encode(types, [b'fuzz', p["kp"], p["ki"], p["co_bias"], p["per_second_integral_leak"],
+                                      p["output_upper_bound"], p["output_lower_bound"], [0, 0, 0]])
+
+
+class _ContractLane:
+    """One deployed controller, called through raw calldata."""
+
+    # Signatures of the Vyper contract; the Solidity lane renames them
+    signatures = {
+        "set_int": "modify_parameters_int(string,int256)",
+        "set_uint": "modify_parameters_uint(string,uint256)",
+        "rpower": "rpower(uint256,uint256,uint256)",
+        "get_raw_pi_output": "get_raw_pi_output(int256,int256)",
+        "bound_pi_output": "bound_pi_output(int256)",
+        "update": "update(int256)",
+        "error_integral": "error_integral()",
+        "last_error": "last_error()",
+    }
+    parameters = {}
+
+    def __init__(self, name, evm, address):
+        self.name = name
+        self.evm = evm
+        self.address = address
+
+    def _call(self, fn, *args, types=None):
+        result = self.evm.call(self.address, encode_call(self.signatures[fn], *args))
+        if not result.success:
+            return REVERTED
+        values = decode(types, result.output) if types else ()
+        return values[0] if len(values) == 1 else tuple(values)
+
+    def _param(self, name):
+        return self.parameters.get(name, name)
+
+    def set_int(self, name, val):
+        return self._call("set_int", self._param(name), val) != REVERTED
+
+    def set_uint(self, name, val):
+        return self._call("set_uint", self._param(name), val) != REVERTED
+
+    def rpower(self, x, n, base):
+        return self._call("rpower", x, n, base, types=["uint256"])
+
+    def get_raw_pi_output(self, error, error_i):
+        return self._call("get_raw_pi_output", error, error_i, types=["int256"] * 3)
+
+    def bound_pi_output(self, value):
+        return self._call("bound_pi_output", value, types=["int256"])
+
+    def update(self, error, timestamp):
+        self.evm.timestamp = timestamp
+        return self._call("update", error, types=["int256"] * 3)
+
+    def state(self):
+        return (self._call("error_integral", types=["int256"]), self._call("last_error", types=["int256"]))
+
+
+class _SolidityLane(_ContractLane):
+    signatures = dict(
+        _ContractLane.signatures,
+        set_int="modifyParameters(bytes32,int256)",
+        set_uint="modifyParameters(bytes32,uint256)",
+        get_raw_pi_output="getRawPiOutput(int256,int256)",
+        bound_pi_output="boundPiOutput(int256)",
+        error_integral="errorIntegral()",
+        last_error="lastError()",
+    )
+    parameters = dict(co_bias="coBias", per_second_integral_leak="perSecondIntegralLeak",
+                      output_upper_bound="outputUpperBound", output_lower_bound="outputLowerBound",
+                      error_integral="errorIntegral")
+
+    def _param(self, name):
+        return super()._param(name).encode().ljust(32, b'\0')
+
+
+class _ModelLane:
+    """The Python model behind the same interface."""
+
+    name = "model"
+
+    def __init__(self):
+        self.model = PIControllerModel(**DEPLOY_PARAMS)
+
+    @staticmethod
+    def _call(fn, *args):
+        try:
+            return fn(*args)
+        except Revert:
+            return REVERTED
+
+    def set_int(self, name, val):
+        return self._call(self.model.modify_parameters_int, name, val) != REVERTED
+
+    def set_uint(self, name, val):
+        return self._call(self.model.modify_parameters_uint, name, val) != REVERTED
+
+    def rpower(self, x, n, base):
+        return self._call(rpower, x, n, base)
+
+    def get_raw_pi_output(self, error, error_i):
+        return self._call(self.model.get_raw_pi_output, error, error_i)
+
+    def bound_pi_output(self, value):
+        return self._call(self.model.bound_pi_output, value)
+
+    def update(self, error, timestamp):
+        return self._call(self.model.update, error, timestamp)
+
+    def state(self):
+        return (self.model.error_integral, self.model.last_error)
+
+
+# --- Case generation ---
+
+EDGES = [0, 1, -1, 2, MAX_INT128, MIN_INT128, MAX_INT256, MIN_INT256, RAY, -RAY]
+# Largest |co_bias| for which both summation orders of the raw output agree
+MAX_CO_BIAS = 2 ** 253
+
+
+def _signed(rng, max_bits):
+    """Signed value with a log-uniform bit length, or an edge value."""
+    if rng.random() < 0.1:
+        return rng.choice(EDGES)
+    value = rng.getrandbits(rng.randint(0, max_bits))
+    value = -value if rng.random() < 0.5 else value
+    return max(MIN_INT256, min(MAX_INT256, value))
+
+
+def _unsigned(rng, max_bits):
+    return rng.getrandbits(rng.randint(0, max_bits))
+
+
+def _bounds(rng):
+    # Both bounds fit int128, as PIController.vy stores them packed
+    lower, upper = sorted(max(MIN_INT128, min(MAX_INT128, _signed(rng, 127))) for _ in range(2))
+    if lower == upper:
+        upper = lower + 1 if upper < MAX_INT128 else upper
+        lower = upper - 1
+    return upper, lower
+
+
+def _params(rng):
+    upper, lower = _bounds(rng)
+    leak = RAY if rng.random() < 0.3 else max(0, RAY - _unsigned(rng, 90))
+    return dict(kp=_signed(rng, 140), ki=_signed(rng, 140), co_bias=max(-MAX_CO_BIAS, min(MAX_CO_BIAS, _signed(rng, 130))),
+                per_second_integral_leak=leak, output_upper_bound=upper, output_lower_bound=lower,
+                error_integral=0 if rng.random() < 0.5 else _signed(rng, 200))
+
+
+def _set_params(lane, params):
+    """Apply `params` through the setters; False if any of them reverts."""
+    ok = lane.set_int("output_upper_bound", MAX_INT128)
+    ok = ok and lane.set_int("output_lower_bound", params["output_lower_bound"])
+    ok = ok and lane.set_int("output_upper_bound", params["output_upper_bound"])
+    for name in ("kp", "ki", "co_bias", "error_integral"):
+        ok = ok and lane.set_int(name, params[name])
+    return ok and lane.set_uint("per_second_integral_leak", params["per_second_integral_leak"])
+
+
+def _gen_rpower(rng):
+    x = max(0, RAY - _unsigned(rng, 90)) if rng.random() < 0.5 else _unsigned(rng, 256)
+    n = _unsigned(rng, rng.choice([16, 32, 64, 256]))
+    base = RAY if rng.random() < 0.7 else _unsigned(rng, 128)
+    return dict(x=x, n=n, base=base)
+
+
+def _run_rpower(lane, case):
+    return lane.rpower(case["x"], case["n"], case["base"])
+
+
+def _gen_get_raw_pi_output(rng):
+    return dict(params=_params(rng), error=_signed(rng, 255), error_i=_signed(rng, 255))
+
+
+def _run_get_raw_pi_output(lane, case):
+    if not _set_params(lane, case["params"]):
+        return "invalid-params"
+    return lane.get_raw_pi_output(case["error"], case["error_i"])
+
+
+def _gen_bound_pi_output(rng):
+    return dict(params=_params(rng), value=_signed(rng, 255))
+
+
+def _run_bound_pi_output(lane, case):
+    if not _set_params(lane, case["params"]):
+        return "invalid-params"
+    return lane.bound_pi_output(case["value"])
+
+
+def _gen_update(rng):
+    steps = []
+    for _ in range(rng.randint(1, 12)):
+        dt = rng.choice([0, 1, 12, 3600, 86400, _unsigned(rng, 32), _unsigned(rng, 40)])
+        steps.append((dt, _signed(rng, rng.choice([64, 96, 128, 200, 255]))))
+    return dict(params=_params(rng), steps=steps)
+
+
+def _run_update(lane, case):
+    if not _set_params(lane, case["params"]):
+        return "invalid-params"
+    timestamp = BASE_TIMESTAMP
+    results = []
+    for dt, error in case["steps"]:
+        timestamp += dt
+        results.append(lane.update(error, timestamp))
+    return results, lane.state()
+
+
+TARGETS = {
+    "rpower": (_gen_rpower, _run_rpower),
+    "get_raw_pi_output": (_gen_get_raw_pi_output, _run_get_raw_pi_output),
+    "bound_pi_output": (_gen_bound_pi_output, _run_bound_pi_output),
+    "update": (_gen_update, _run_update),
+}
+
+
+# --- Shrinking ---
+
+def _shrink_candidates(value):
+    """Simpler versions of `value`, most aggressive first."""
+    if isinstance(value, int) and not isinstance(value, bool):
+        if value == 0:
+            return
+        yield 0
+        if value < 0:
+            yield -value
+        # Steps towards zero of half the distance, a quarter, ... down to 1
+        sign = 1 if value > 0 else -1
+        step = abs(value) // 2
+        while step:
+            yield value - sign * step
+            step //= 2
+    elif isinstance(value, (list, tuple)):
+        # Lists may lose items; tuples are fixed-size records
+        if isinstance(value, list):
+            for i in range(len(value)):
+                yield value[:i] + value[i + 1:]
+        for i, item in enumerate(value):
+            for candidate in _shrink_candidates(item):
+                yield value[:i] + type(value)([candidate]) + value[i + 1:]
+    elif isinstance(value, dict):
+        for key, item in value.items():
+            for candidate in _shrink_candidates(item):
+                yield dict(value, **{key: candidate})
+
+
+def minimize(case, diverges, budget=2000):
+    """
+    Greedily shrink `case` while `diverges(case)` holds, trying at most
+    `budget` candidates.
+    """
+    tries = 0
+    improved = True
+    while improved and tries < budget:
+        improved = False
+        for candidate in _shrink_candidates(case):
+            tries += 1
+            if diverges(candidate):
+                case = candidate
+                improved = True
+                break
+            if tries >= budget:
+                break
+    return case
+
+
+# --- Workers ---
+
+class Harness:
+    """Every lane of one worker, sharing a LocalEVM reset before each case."""
+
+    def __init__(self, vyper_initcode, solidity_initcode=None):
+        self.evm = LocalEVM(timestamp=BASE_TIMESTAMP)
+        vyper_address = self.evm.deploy(vyper_initcode, _constructor_args())
+        self._setup(vyper_address, encode_call("modify_parameters_addr(string,address)", "updater", OWNER))
+        self.contract_lanes = [_ContractLane("vyper", self.evm, vyper_address)]
+        if solidity_initcode is not None:
+            solidity_address = self.evm.deploy(solidity_initcode, _constructor_args(SOLIDITY_CONSTRUCTOR_TYPES))
+            self._setup(solidity_address, encode_call("modifyParameters(bytes32,address)",
+                                                      b'seedProposer'.ljust(32, b'\0'), OWNER))
+            self.contract_lanes.append(_SolidityLane("solidity", self.evm, solidity_address))
+        self.root = self.evm.snapshot()
+
+    def _setup(self, address, data):
+        if not self.evm.call(address, data).success:
+            raise RuntimeError(f"setting up the controller at 0x{address.hex()} reverted")
+
+    def run_case(self, target, case):
+        """{lane name: result} for one case."""
+        run = TARGETS[target][1]
+        results = {}
+        for lane in self.contract_lanes:
+            self.evm.revert(self.root)
+            self.evm.timestamp = BASE_TIMESTAMP
+            results[lane.name] = run(lane, case)
+        results["model"] = run(_ModelLane(), case)
+        return results
+
+    def diverges(self, target, case):
+        return len({repr(result) for result in self.run_case(target, case).values()}) > 1
+
+    def run_shard(self, target, seed, count, max_reports=5):
+        """Run `count` cases of `target` from `seed`; returns (count, minimized reports)."""
+        rng = random.Random(f"{target}-{seed}")
+        reports = []
+        for index in range(count):
+            case = TARGETS[target][0](rng)
+            if not self.diverges(target, case):
+                continue
+            if len(reports) < max_reports:
+                minimal = minimize(case, lambda c: self.diverges(target, c))
+                reports.append(dict(target=target, seed=seed, index=index, case=minimal,
+                                    results=self.run_case(target, minimal), original=case))
+        return count, reports
+
+
+_harness = None
+
+
+def _init_worker(vyper_initcode, solidity_initcode):
+    global _harness
+    _harness = Harness(vyper_initcode, solidity_initcode)
+
+
+def _run_shard(target, seed, count, max_reports):
+    return target, seed, *_harness.run_shard(target, seed, count, max_reports)
+
+
+def load_initcodes(solidity=True):
+    """(vyper initcode, solidity initcode or None unless `solidity`). Raises if solc 0.6.7 is unavailable."""
+    vyper_initcode, _ = compile_vyper()
+    solidity_initcode = compile_solidity()[0] if solidity else None
+    return vyper_initcode, solidity_initcode
+
+
+def _write_report(out, report):
+    path = out / f"{report['target']}-{report['seed']}-{report['index']}.json"
+    path.write_text(json.dumps(report, indent=1, default=repr) + "\n")
+    return path
+
+
+def fuzz(cases, workers=None, targets=tuple(TARGETS), shard_size=1000, seed=0, out=Path("fuzz-out"),
+         max_reports=5, solidity=True, progress=None):
+    """
+    Run `cases` cases split evenly over `targets`; returns the written report
+    paths. `progress(done, total, divergent, rate)` is called after each shard.
+    """
+    out = Path(out)
+    out.mkdir(parents=True, exist_ok=True)
+    initcodes = load_initcodes(solidity)
+
+    shards = []
+    per_target = cases // len(targets)
+    for target in targets:
+        for start in range(0, per_target, shard_size):
+            shards.append((target, seed + start // shard_size, min(shard_size, per_target - start)))
+
+    total = per_target * len(targets)
+    done, paths, started = 0, [], time.time()
+    with ProcessPoolExecutor(workers or os.cpu_count(), initializer=_init_worker, initargs=initcodes) as pool:
+        futures = [pool.submit(_run_shard, target, shard_seed, count, max_reports)
+                   for target, shard_seed, count in shards]
+        for future in as_completed(futures):
+            target, shard_seed, count, reports = future.result()
+            done += count
+            paths += [_write_report(out, report) for report in reports]
+            if progress is not None:
+                progress(done, total, len(paths), done / (time.time() - started))
+    return paths
+
+
+def _print_progress(done, total, divergent, rate):
+    print(f"{done}/{total} cases, {rate:.0f}/s, {divergent} divergent")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--cases", type=int, default=100_000)
+    parser.add_argument("--workers", type=int, default=None, help="default: one per CPU")
+    parser.add_argument("--targets", nargs="+", choices=list(TARGETS), default=list(TARGETS))
+    parser.add_argument("--shard-size", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0, help="seed of the first shard of every target")
+    parser.add_argument("--out", type=Path, default=Path("fuzz-out"))
+    parser.add_argument("--max-reports", type=int, default=5, help="divergences minimized per shard")
+    parser.add_argument("--no-solidity", action="store_true", help="check the Vyper contract against the model only")
+    args = parser.parse_args(argv)
+    paths = fuzz(args.cases, args.workers, args.targets, args.shard_size, args.seed, args.out,
+                 args.max_reports, solidity=not args.no_solidity, progress=_print_progress)
+    return 1 if paths else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,228 @@
+"""
+Opcode-level gas profile of PIController.vy by source line and function.
+
+    python -m picontroller.gas_profile --folded update.folded
+    flamegraph.pl update.folded > update.svg        # or load it in speedscope
+
+A call is traced opcode by opcode as evm-trace `TraceFrame`s, the frames geth's
+`debug_traceTransaction` returns, either from the in-process EVM (`trace_call`)
+or from a node. `SourceMap` maps every pc of the runtime code to its Vyper
+source line and function through the compiler's AST source map, pi_math.vy
+included; opcodes the compiler gives no position take the last one before
+them. `GasProfile` charges each opcode's gas to that line and to the stack of
+internal functions it runs under. The stack is followed from the functions
+themselves: Vyper has no recursion, so a function already on the stack means a
+return to it. SLOAD, SSTORE and LOG opcodes get a frame of their own under
+their function, so storage and events stand out in the flame graph.
+"""
+import argparse
+from collections import Counter
+from pathlib import Path
+from typing import NamedTuple
+
+from eth.vm.forks.cancun.computation import CancunComputation
+from eth.vm.opcode_values import PUSH0
+from evm_trace import TraceFrame
+
+from picontroller.evm import CONTRACTS, DEFAULT_GAS, OWNER, PIControllerEVM
+
+LEAF_OPCODES = frozenset({"SLOAD", "SSTORE", "LOG0", "LOG1", "LOG2", "LOG3", "LOG4"})
+
+kp = int(2.25 * 10 ** 11)
+ki = int(7.2 * 10 ** 4)
+per_second_integral_leak = 999997208243937652252849536
+output_upper_bound = 18640000000000000000
+output_lower_bound = -51034000000000000000
+
+
+class Location(NamedTuple):
+    file: str
+    line: int
+    # None for code outside any function, such as the selector dispatch
+    function: str
+
+
+class SourceMap:
+    """pc -> Location for the runtime code of a Vyper contract and the modules it imports."""
+
+    def __init__(self, path=CONTRACTS / "PIController.vy"):
+        from vyper import ast as vy_ast
+        from vyper.compiler.input_bundle import FilesystemInputBundle
+        from vyper.compiler.output import build_source_map_runtime_output
+        from vyper.compiler.phases import CompilerData
+
+        path = Path(path).resolve()
+        bundle = FilesystemInputBundle([path.parent])
+        data = CompilerData(bundle.load_file(path), input_bundle=bundle)
+        module = data.annotated_vyper_module
+        modules = [module] + [info.module_t._module for info in
+                              module._metadata["type"].imported_modules.values()]
+
+        nodes, self.sources = {}, {}
+        for m in modules:
+            name = Path(m.resolved_path).name
+            prefix = "" if m is module else f"{Path(name).stem}."
+            self.sources[name] = m.full_source_code.splitlines()
+            for node in [m] + m.get_descendants():
+                nodes[m.source_id, node.node_id] = (name, prefix, node)
+
+        self.contract = path.stem
+        self.runtime = data.bytecode_runtime
+        self.locations = {}
+        for pc, (source_id, node_id) in build_source_map_runtime_output(data)["pc_ast_map"].items():
+            name, prefix, node = nodes[source_id, node_id]
+            function = node if isinstance(node, vy_ast.FunctionDef) else node.get_ancestor(vy_ast.FunctionDef)
+            self.locations[int(pc)] = Location(name, node.lineno,
+                                               f"{prefix}{function.name}" if function else None)
+
+    def source_line(self, file, line):
+        return self.sources[file][line - 1].strip()
+
+
+def _traced_opcodes(frames):
+    """CancunComputation's opcode table with every opcode recording a frame dict."""
+
+    def traced(opcode_fn, mnemonic):
+        def run(computation):
+            pc = computation.code.program_counter - 1
+            gas = computation.get_gas_remaining()
+            try:
+                opcode_fn(computation=computation)
+            finally:
+                frames.append(dict(pc=pc, op=mnemonic, gas=gas, gasCost=gas - computation.get_gas_remaining(),
+                                   depth=computation.msg.depth + 1))
+        return run
+
+    opcodes = {}
+    for value, opcode_fn in CancunComputation.opcodes.items():
+        mnemonic = getattr(opcode_fn, "mnemonic", None) or opcode_fn.__wrapped__.mnemonic
+        opcodes[value] = traced(opcode_fn, "PUSH0" if value == PUSH0 else mnemonic)
+    return opcodes
+
+
+def trace_call(evm, to, data, sender=OWNER, gas=DEFAULT_GAS):
+    """(CallResult, [TraceFrame]) of one LocalEVM call, with depth 1 for the called contract as in geth."""
+    frames = []
+    computation_class = type("TracingComputation", (CancunComputation,), {"opcodes": _traced_opcodes(frames)})
+    result = evm.call(to, data, sender=sender, gas=gas, computation_class=computation_class)
+    return result, [TraceFrame.model_validate(frame) for frame in frames]
+
+
+class GasProfile:
+    """
+    Gas of any number of traced calls into the contract of `source_map`, by
+    line and by function stack. Only frames at the depth of each trace's first
+    frame are counted; gas spent in other contracts stays with the calling opcode.
+    """
+
+    def __init__(self, source_map):
+        self.source_map = source_map
+        self.stacks = Counter()
+        self.line_gas = Counter()
+        self.line_ops = Counter()
+        self.total = 0
+
+    def add(self, frames):
+        frames = list(frames)
+        if not frames:
+            return self
+        depth, stack, key = frames[0].depth, [], None
+        for frame in frames:
+            if frame.depth != depth:
+                continue
+            # Opcodes without a source position, SLOAD and SSTORE among them, belong
+            # to the last position before them
+            location = self.source_map.locations.get(frame.pc)
+            if location is not None:
+                key = (location.file, location.line)
+                if location.function is not None:
+                    if location.function in stack:
+                        del stack[stack.index(location.function) + 1:]
+                    else:
+                        stack.append(location.function)
+            self.line_gas[key] += frame.gas_cost
+            self.line_ops[key] += 1
+            leaf = (frame.op,) if frame.op in LEAF_OPCODES else ()
+            self.stacks[(self.source_map.contract, *stack, *leaf)] += frame.gas_cost
+            self.total += frame.gas_cost
+        return self
+
+    def folded(self):
+        """Folded stacks, one "frame;frame;frame gas" line each, for flamegraph.pl, inferno or speedscope."""
+        return "".join(f"{';'.join(stack)} {gas}\n" for stack, gas in sorted(self.stacks.items()) if gas)
+
+    def write_folded(self, path):
+        Path(path).write_text(self.folded())
+
+    def functions(self):
+        """{function: (self gas, inclusive gas)}, storage and log frames counted as their own."""
+        own, inclusive = Counter(), Counter()
+        for stack, gas in self.stacks.items():
+            own[stack[-1]] += gas
+            for frame in set(stack):
+                inclusive[frame] += gas
+        return {frame: (own[frame], inclusive[frame]) for frame in inclusive}
+
+    def line_table(self, limit=20):
+        lines = [f"{'gas':>8}  {'share':>6}  {'ops':>5}  {'location':<24}  source"]
+        for key, gas in self.line_gas.most_common(limit):
+            where, source = ("(no source)", "") if key is None else (f"{key[0]}:{key[1]}",
+                                                                     self.source_map.source_line(*key))
+            lines.append(f"{gas:>8}  {gas / self.total:>6.1%}  {self.line_ops[key]:>5}  {where:<24}  {source}")
+        return "\n".join(lines)
+
+    def function_table(self):
+        rows = sorted(self.functions().items(), key=lambda row: -row[1][1])
+        lines = [f"{'self':>8}  {'inclusive':>9}  {'share':>6}  function"]
+        for frame, (own, inclusive) in rows:
+            lines.append(f"{own:>8}  {inclusive:>9}  {inclusive / self.total:>6.1%}  {frame}")
+        return "\n".join(lines)
+
+
+def profile_updates(errors, delay=3600, leak_cadence=0, output_deadband=0, path=CONTRACTS / "PIController.vy",
+                    **parameters):
+    """
+    Apply `errors` to a fresh controller `delay` seconds apart and profile the
+    last update. `parameters` override the benchmark's gains and bounds.
+    """
+    parameters = dict(dict(kp=kp, ki=ki, co_bias=0, per_second_integral_leak=per_second_integral_leak,
+                           output_upper_bound=output_upper_bound, output_lower_bound=output_lower_bound),
+                      **parameters)
+    controller = PIControllerEVM(**parameters, path=path)
+    controller.call("modify_parameters_uint", "leak_cadence", leak_cadence)
+    controller.call("modify_parameters_uint", "output_deadband", output_deadband)
+    timestamp = controller.evm.timestamp
+    for error in errors[:-1]:
+        controller.update(error, timestamp)
+        timestamp += delay
+
+    controller.evm.timestamp = timestamp
+    result, frames = trace_call(controller.evm, controller.address, controller.methods["update"].encode(errors[-1]))
+    if not result.success:
+        raise RuntimeError("the profiled update reverted")
+    return GasProfile(SourceMap(path)).add(frames), result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--errors", nargs="+", type=int, default=[-10 ** 25, -10 ** 25, -5 * 10 ** 24],
+                        help="errors applied in turn; the last update is profiled")
+    parser.add_argument("--delay", type=int, default=3600, help="seconds between updates")
+    parser.add_argument("--leak-cadence", type=int, default=0)
+    parser.add_argument("--output-deadband", type=int, default=0)
+    parser.add_argument("--folded", help="write folded stacks here")
+    parser.add_argument("--top", type=int, default=20, help="lines in the per-line table")
+    args = parser.parse_args(argv)
+
+    profile, result = profile_updates(args.errors, args.delay, args.leak_cadence, args.output_deadband)
+    print(f"update: {result.gas_used} gas, {profile.total} in opcodes of the controller\n")
+    print(profile.function_table())
+    print()
+    print(profile.line_table(args.top))
+    if args.folded:
+        profile.write_folded(args.folded)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
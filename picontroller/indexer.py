@@ -0,0 +1,190 @@
+"""
+Rebuilds a PIController's history from its events.
+
+`update()` emits `UpdateEvent` with the new state, or `DeadbandUpdateEvent`
+within the output deadband, and every setter emits its `ModifyParameters*`
+event, so the full state after any transaction follows from one `get_state()`
+read at the start block and the logs after it. The indexer
+pulls those logs in ranges of `chunk_size` blocks, one `eth_getLogs` per range.
+It applies them to the snapshot and keeps a checkpoint per change, so
+`state_at(timestamp)` is a binary search. Checkpoints can be saved and loaded,
+and a later `backfill` resumes after the last indexed block.
+
+An entry of a `PIControllerRegistry` is indexed the same way, given its `id`:
+the registry emits the same events with the id as an indexed first field.
+"""
+import json
+from bisect import bisect_right
+from dataclasses import asdict, fields, replace
+
+from eth_abi import decode
+from eth_utils import keccak, to_checksum_address
+
+from picontroller.model import PARAMETER_BITS
+from picontroller.snapshot import ControllerSnapshot, decode_snapshot
+
+EVENTS = {
+    "UpdateEvent": ["int256", "int256", "int256", "int256", "uint256"],
+    "DeadbandUpdateEvent": ["int256", "int256", "uint256"],
+    "ModifyParametersAddr": ["string", "address"],
+    "ModifyParametersUint": ["string", "uint256"],
+    "ModifyParametersInt": ["string", "int256"],
+    "SetParameters": ["(int256,int256,int256,int256,int256,uint256,uint256,int256,uint256)", "uint256"],
+}
+SNAPSHOT_FIELDS = {field.name for field in fields(ControllerSnapshot)}
+TOPICS = {keccak(text=f"{name}({','.join(types)})"): name for name, types in EVENTS.items()}
+# The events PIControllerRegistry emits, each with an indexed bytes32 id in front
+REGISTRY_TOPICS = {keccak(text=f"{name}({','.join(['bytes32'] + EVENTS[name])})"): name
+                   for name in ("UpdateEvent", "ModifyParametersAddr", "ModifyParametersUint",
+                                "ModifyParametersInt")}
+
+
+def decode_log(log):
+    """(event name, decoded values) of a controller or registry log."""
+    topic = bytes(log["topics"][0])
+    name = TOPICS[topic] if topic in TOPICS else REGISTRY_TOPICS[topic]
+    return name, decode(EVENTS[name], bytes(log["data"]))
+
+
+def log_topics(id=None):
+    """eth_getLogs topics for a controller's events, or for those of registry entry `id`."""
+    if id is None:
+        return [list(TOPICS)]
+    return [list(REGISTRY_TOPICS), id.ljust(32, b"\0")]
+
+
+def is_controller_log(log, id=None):
+    """Whether `log` is one of the events `log_topics(id)` selects."""
+    topics = [bytes(topic) for topic in log["topics"]]
+    if id is None:
+        return topics[0] in TOPICS
+    return topics[0] in REGISTRY_TOPICS and topics[1] == id.ljust(32, b"\0")
+
+
+def get_state_call(id=None):
+    """Calldata of `get_state()`, or of the registry's `get_state(id)`."""
+    if id is None:
+        return keccak(text="get_state()")[:4]
+    return keccak(text="get_state(bytes32)")[:4] + id.ljust(32, b"\0")
+
+
+def unpack_output_and_time(output_and_time):
+    """(last_output, last_update_time) of the `output_and_time` word an update event carries."""
+    last_output = (output_and_time >> 128) - (1 << 128 if output_and_time >> 255 else 0)
+    return last_output, output_and_time & (2**64 - 1)
+
+
+def apply_event(state, name, values):
+    """The ControllerSnapshot after event `name` with `values`."""
+    if name == "UpdateEvent":
+        error, error_integral, p_output, i_output, output_and_time = values
+        last_output, last_update_time = unpack_output_and_time(output_and_time)
+        return replace(state, error_integral=error_integral, last_error=error, last_p_output=p_output,
+                       last_i_output=i_output, last_output=last_output,
+                       last_update_time=last_update_time, elapsed=0)
+    if name == "DeadbandUpdateEvent":
+        error, error_integral, output_and_time = values
+        return replace(state, error_integral=error_integral, last_error=error,
+                       last_update_time=unpack_output_and_time(output_and_time)[1], elapsed=0)
+    if name == "SetParameters":
+        parameters, mask = values
+        return replace(state, **{parameter: value for (parameter, bit), value
+                                 in zip(PARAMETER_BITS.items(), parameters) if mask & bit})
+    parameter, value = values
+    if parameter not in SNAPSHOT_FIELDS:
+        # observation_cardinality: the ring of observations is not part of get_state()
+        return state
+    if name == "ModifyParametersAddr":
+        value = to_checksum_address(value)
+    return replace(state, **{parameter: value})
+
+
+class ControllerIndexer:
+    def __init__(self, w3, address, start_block, chunk_size=10_000, id=None):
+        self.w3 = w3
+        self.address = to_checksum_address(address)
+        # the registry entry to index, None for a PIController
+        self.id = id
+        self.start_block = start_block
+        self.chunk_size = chunk_size
+        # Parallel lists, one entry per checkpoint, in chain order
+        self.timestamps = []
+        self.blocks = []
+        self.states = []
+        self.next_block = start_block
+
+    def __len__(self):
+        return len(self.states)
+
+    def _block_timestamp(self, number, cache):
+        if number not in cache:
+            cache[number] = self.w3.eth.get_block(number)["timestamp"]
+        return cache[number]
+
+    def _checkpoint(self, timestamp, block, state):
+        self.timestamps.append(timestamp)
+        self.blocks.append(block)
+        self.states.append(state)
+
+    def backfill(self, to_block="latest"):
+        """Index up to and including `to_block`; returns the number of logs applied."""
+        if to_block == "latest":
+            to_block = self.w3.eth.block_number
+        if not self.states:
+            raw = self.w3.eth.call({"to": self.address, "data": get_state_call(self.id)}, self.start_block)
+            state = replace(decode_snapshot(raw), elapsed=0)
+            self._checkpoint(self.w3.eth.get_block(self.start_block)["timestamp"], self.start_block, state)
+            self.next_block = self.start_block + 1
+
+        applied = 0
+        timestamps = {}
+        while self.next_block <= to_block:
+            last = min(self.next_block + self.chunk_size - 1, to_block)
+            logs = self.w3.eth.get_logs({"address": self.address, "fromBlock": self.next_block, "toBlock": last,
+                                         "topics": log_topics(self.id)})
+            for log in logs:
+                name, values = decode_log(log)
+                state = apply_event(self.states[-1], name, values)
+                # Updates carry their own timestamp; only setters need the block's
+                if name in ("UpdateEvent", "DeadbandUpdateEvent"):
+                    timestamp = state.last_update_time
+                else:
+                    timestamp = self._block_timestamp(log["blockNumber"], timestamps)
+                self._checkpoint(timestamp, log["blockNumber"], state)
+            applied += len(logs)
+            self.next_block = last + 1
+        return applied
+
+    def state_at(self, timestamp):
+        """State after the last change at or before `timestamp`; None before the start block."""
+        k = bisect_right(self.timestamps, timestamp)
+        return self.states[k - 1] if k else None
+
+    def state_at_block(self, block):
+        k = bisect_right(self.blocks, block)
+        return self.states[k - 1] if k else None
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(dict(address=self.address, start_block=self.start_block, next_block=self.next_block,
+                           id=None if self.id is None else self.id.hex()), f)
+            f.write("\n")
+            for timestamp, block, state in zip(self.timestamps, self.blocks, self.states):
+                record = dict(asdict(state), control_variable=state.control_variable.hex())
+                json.dump(dict(timestamp=timestamp, block=block, state=record), f)
+                f.write("\n")
+
+    @classmethod
+    def load(cls, w3, path, chunk_size=10_000):
+        with open(path) as f:
+            header = json.loads(f.readline())
+            id = header.get("id")
+            indexer = cls(w3, header["address"], header["start_block"], chunk_size,
+                          None if id is None else bytes.fromhex(id))
+            for line in f:
+                record = json.loads(line)
+                state = record["state"]
+                state["control_variable"] = bytes.fromhex(state["control_variable"])
+                indexer._checkpoint(record["timestamp"], record["block"], ControllerSnapshot(**state))
+        indexer.next_block = header["next_block"]
+        return indexer
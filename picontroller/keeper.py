@@ -0,0 +1,257 @@
+"""
+Asyncio keeper that calls `update(error)` on many controllers as their updater.
+
+    python -m picontroller.keeper --rpc http://127.0.0.1:8545 --controllers 0x.. 0x.. --interval 12
+
+Every tick the keeper reads the latest block once, asks an error source for each
+controller's error and submits the updates. Transactions are signed locally
+with locally tracked nonces and sent back to back; receipts are awaited in
+background tasks, so a slow inclusion never holds up the next submission. All
+controllers share one AsyncWeb3 provider and so one pooled HTTP session.
+
+`MockRelayerSource` stands in for the oracle and the relayer: it computes the
+error from a market price and a redemption price exactly as
+orig/test/utils/mock/MockPIRateSetterNew.sol does, and feeds the controller's
+output back into the redemption rate like MockOracleRelayer.
+
+The output handed to `on_update` is the stored one, read from the update's
+`UpdateEvent` or `DeadbandUpdateEvent` in the receipt.
+"""
+import argparse
+import asyncio
+import os
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from dataclasses import dataclass, field
+
+from eth_abi import encode
+from eth_account import Account
+from eth_utils import keccak
+from web3 import AsyncHTTPProvider, AsyncWeb3
+
+from picontroller.indexer import TOPICS, decode_log, unpack_output_and_time
+from picontroller.model import RAY, redemption_rate, rpower, sdiv
+
+UPDATE_GAS = 200_000
+UPDATE_SELECTOR = keccak(text="update(int256)")[:4]
+# Latency percentiles are taken over this many of the most recent included updates
+LATENCY_WINDOW = 10_000
+
+
+@dataclass
+class Metrics:
+    submitted: int = 0
+    included: int = 0
+    failed: int = 0
+    skipped: int = 0
+    latencies: deque = field(default_factory=lambda: deque(maxlen=LATENCY_WINDOW))
+    # summed over every included update, for the mean
+    gas_used: int = 0
+
+    def summary(self):
+        latencies = sorted(self.latencies)
+
+        def percentile(q):
+            return latencies[min(len(latencies) - 1, int(q * len(latencies)))] if latencies else None
+
+        return dict(submitted=self.submitted, included=self.included, failed=self.failed,
+                    skipped=self.skipped, latency_p50=percentile(0.5), latency_p95=percentile(0.95),
+                    mean_gas=self.gas_used / self.included if self.included else None)
+
+
+class ErrorSource(ABC):
+    """
+    Where errors come from. `error` returns the error to submit for a
+    controller at `timestamp`, or None to skip it this tick. `on_update` is
+    called with the controller's output once its update is included; if it
+    raises, the update counts as failed.
+    """
+
+    @abstractmethod
+    async def error(self, controller, timestamp):
+        ...
+
+    async def on_update(self, controller, timestamp, output):
+        pass
+
+
+class MockRelayerSource(ErrorSource):
+    """
+    One redemption price per controller, drifting at the redemption rate that
+    MockPIRateSetterNew relays for the last output (`model.redemption_rate`).
+    `market_price(controller, timestamp)` returns the market price as a WAD.
+    """
+
+    def __init__(self, market_price, noise_barrier=0):
+        self.market_price = market_price
+        self.noise_barrier = noise_barrier
+        self.relayers = {}
+
+    def _relayer(self, controller, timestamp):
+        # [redemption_price, redemption_rate, redemption_price_update_time]
+        return self.relayers.setdefault(controller, [RAY, RAY, timestamp])
+
+    def redemption_price(self, controller, timestamp):
+        relayer = self._relayer(controller, timestamp)
+        price, rate, updated = relayer
+        if timestamp > updated:
+            relayer[0] = max(rpower(rate, timestamp - updated, RAY) * price // RAY, 1)
+            relayer[2] = timestamp
+        return relayer[0]
+
+    async def error(self, controller, timestamp):
+        redemption_price = self.redemption_price(controller, timestamp)
+        market_price = self.market_price(controller, timestamp)
+        if market_price <= 0:
+            return None
+        return sdiv((redemption_price - market_price * 10**9) * RAY, redemption_price)
+
+    async def on_update(self, controller, timestamp, output):
+        self.redemption_price(controller, timestamp)
+        self.relayers[controller][1] = redemption_rate(output, self.noise_barrier)
+
+
+class Keeper:
+    """
+    Drives `controllers` (addresses) from `account`, which must be their
+    updater. `tick` submits one round; `run` ticks every `interval` seconds.
+    """
+
+    def __init__(self, w3, account, controllers, source, gas=UPDATE_GAS, receipt_timeout=120, poll_latency=0.1):
+        self.w3 = w3
+        self.account = account
+        self.controllers = [AsyncWeb3.to_checksum_address(c) for c in controllers]
+        self.source = source
+        self.gas = gas
+        self.receipt_timeout = receipt_timeout
+        self.poll_latency = poll_latency
+        self.metrics = Metrics()
+        self._nonce = None
+        self._chain_id = None
+        self._send_lock = asyncio.Lock()
+        # controller -> receipt task of its in-flight update
+        self._in_flight = {}
+
+    async def _sync_nonce(self):
+        self._nonce = await self.w3.eth.get_transaction_count(self.account.address, "pending")
+
+    async def tick(self):
+        if self._chain_id is None:
+            self._chain_id = await self.w3.eth.chain_id
+            await self._sync_nonce()
+        block, gas_price = await asyncio.gather(self.w3.eth.get_block("latest"), self.w3.eth.gas_price)
+        await asyncio.gather(*(self._submit(c, block["timestamp"], gas_price) for c in self.controllers))
+
+    async def _submit(self, controller, timestamp, gas_price):
+        if controller in self._in_flight:
+            self.metrics.skipped += 1
+            return
+        error = await self.source.error(controller, timestamp)
+        if error is None:
+            self.metrics.skipped += 1
+            return
+
+        # Nonces are handed out and sent in order. A failed send resyncs at once and an
+        # update whose receipt never comes resyncs in _await_receipt, so a dropped
+        # transaction's nonce is reused instead of leaving a gap later updates queue behind
+        async with self._send_lock:
+            tx = dict(to=controller, data=UPDATE_SELECTOR + encode(["int256"], [error]), value=0, gas=self.gas,
+                      gasPrice=gas_price, nonce=self._nonce, chainId=self._chain_id)
+            signed = self.account.sign_transaction(tx)
+            try:
+                tx_hash = await self.w3.eth.send_raw_transaction(signed.raw_transaction)
+            except Exception:
+                self.metrics.failed += 1
+                await self._sync_nonce()
+                return
+            self._nonce += 1
+            sent = time.monotonic()
+        self.metrics.submitted += 1
+        self._in_flight[controller] = asyncio.create_task(self._await_receipt(controller, tx_hash, sent))
+
+    async def _await_receipt(self, controller, tx_hash, sent):
+        try:
+            receipt = await self.w3.eth.wait_for_transaction_receipt(tx_hash, timeout=self.receipt_timeout,
+                                                                     poll_latency=self.poll_latency)
+        except Exception:
+            self.metrics.failed += 1
+            # The node's pending count no longer includes the nonce if the transaction was dropped
+            async with self._send_lock:
+                await self._sync_nonce()
+            return
+        finally:
+            self._in_flight.pop(controller, None)
+        if receipt["status"] != 1:
+            self.metrics.failed += 1
+            return
+        latency = time.monotonic() - sent
+        try:
+            (output, update_time) = update_output(receipt, controller)
+            await self.source.on_update(controller, update_time, output)
+        except Exception:
+            # Mined, but its output could not be read or taken by the source; the other
+            # controllers keep running
+            self.metrics.failed += 1
+            return
+        self.metrics.included += 1
+        self.metrics.latencies.append(latency)
+        self.metrics.gas_used += receipt["gasUsed"]
+
+    async def drain(self):
+        """Wait for every in-flight update to be included or fail."""
+        while self._in_flight:
+            await asyncio.gather(*list(self._in_flight.values()))
+
+    async def run(self, interval, ticks=None):
+        count = 0
+        while ticks is None or count < ticks:
+            started = time.monotonic()
+            await self.tick()
+            count += 1
+            await asyncio.sleep(max(0, interval - (time.monotonic() - started)))
+        await self.drain()
+        return self.metrics
+
+
+def update_output(receipt, controller):
+    """
+    (last_output, last_update_time) stored by the update in `receipt`, from
+    its UpdateEvent, or its DeadbandUpdateEvent when the output was held.
+    """
+    for log in receipt["logs"]:
+        if (AsyncWeb3.to_checksum_address(log["address"]) == controller
+                and TOPICS.get(bytes(log["topics"][0])) in ("UpdateEvent", "DeadbandUpdateEvent")):
+            _, values = decode_log(log)
+            return unpack_output_and_time(values[-1])
+    raise ValueError(f"no update event of {controller} in the receipt")
+
+
+def connect(rpc):
+    """AsyncWeb3 over one pooled HTTP session, shared by every controller."""
+    return AsyncWeb3(AsyncHTTPProvider(rpc))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--rpc", default="http://127.0.0.1:8545")
+    parser.add_argument("--controllers", nargs="+", required=True)
+    parser.add_argument("--key-env", default="KEEPER_PRIVATE_KEY", help="variable holding the updater's key")
+    parser.add_argument("--interval", type=float, default=12)
+    parser.add_argument("--ticks", type=int, default=None)
+    parser.add_argument("--market-price", type=int, default=10**18, help="WAD, for the mock relayer")
+    args = parser.parse_args(argv)
+
+    account = Account.from_key(os.environ[args.key_env])
+    source = MockRelayerSource(lambda controller, timestamp: args.market_price)
+    keeper = Keeper(connect(args.rpc), account, args.controllers, source)
+    try:
+        metrics = asyncio.run(keeper.run(args.interval, args.ticks))
+    except KeyboardInterrupt:
+        metrics = keeper.metrics
+    print(metrics.summary())
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
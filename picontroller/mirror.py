@@ -0,0 +1,100 @@
+"""
+Local mirror of a deployed controller for previews without RPC.
+
+`get_new_pi_output` and friends only depend on the stored state and the block
+timestamp. `ControllerMirror` reads the state once with `get_state()` and then
+follows the controller's events, either from receipts the caller already holds
+(`apply_receipt`) or by polling logs (`poll`). Its views evaluate the Python
+model, which has the contract's exact semantics, for any timestamp.
+`check_drift` compares the mirror against the chain and resyncs if they
+disagree; `poll` runs it every `check_every` polls. Given an `id`, it mirrors
+that entry of a `PIControllerRegistry` instead.
+"""
+from dataclasses import replace
+
+from eth_utils import to_checksum_address
+
+from picontroller.indexer import apply_event, decode_log, get_state_call, is_controller_log, log_topics
+from picontroller.model import PIControllerModel
+from picontroller.snapshot import decode_snapshot
+
+
+class ControllerMirror:
+    def __init__(self, w3, address, check_every=100, id=None):
+        self.w3 = w3
+        self.address = to_checksum_address(address)
+        self.id = id
+        self.check_every = check_every
+        self.drifts = 0
+        self._polls = 0
+        self.sync()
+
+    def _read_state(self, block):
+        raw = self.w3.eth.call({"to": self.address, "data": get_state_call(self.id)}, block)
+        return replace(decode_snapshot(raw), elapsed=0)
+
+    def _set_state(self, state):
+        self.state = state
+        self.model = PIControllerModel.from_snapshot(state)
+
+    def sync(self):
+        """(Re)seed from `get_state()` at the latest block."""
+        block = self.w3.eth.block_number
+        self._set_state(self._read_state(block))
+        # (block, log index) of the last change applied
+        self._position = (block, float("inf"))
+
+    def apply_log(self, log):
+        """Apply one log unless it is not the controller's or was already applied."""
+        position = (log["blockNumber"], log["logIndex"])
+        if (to_checksum_address(log["address"]) != self.address or not is_controller_log(log, self.id)
+                or position <= self._position):
+            return
+        self._set_state(apply_event(self.state, *decode_log(log)))
+        self._position = position
+
+    def apply_receipt(self, receipt):
+        """Follow a mined transaction. Receipts must come in chain order."""
+        for log in receipt["logs"]:
+            self.apply_log(log)
+
+    def poll(self):
+        """Apply every controller event since the last sync, receipt or poll."""
+        latest = self.w3.eth.block_number
+        logs = self.w3.eth.get_logs({"address": self.address, "fromBlock": self._position[0], "toBlock": latest,
+                                     "topics": log_topics(self.id)})
+        for log in logs:
+            self.apply_log(log)
+        self._position = max(self._position, (latest, float("inf")))
+        self._polls += 1
+        if self.check_every and self._polls % self.check_every == 0:
+            self.check_drift()
+
+    def check_drift(self):
+        """True, after resyncing, if the chain no longer matches the mirror."""
+        if self._read_state("latest") == self.state:
+            return False
+        self.drifts += 1
+        self.sync()
+        return True
+
+    def elapsed(self, timestamp):
+        return self.model.elapsed(timestamp)
+
+    def bound_pi_output(self, pi_output):
+        return self.model.bound_pi_output(pi_output)
+
+    def get_new_error_integral(self, error, timestamp):
+        return self.model.get_new_error_integral(error, timestamp)
+
+    def get_new_pi_output(self, error, timestamp):
+        return self.model.get_new_pi_output(error, timestamp)
+
+    def get_new_pi_outputs(self, queries):
+        return self.model.get_new_pi_outputs(queries)
+
+    def fast_forward(self, error, timestamp):
+        return self.model.fast_forward(error, timestamp)
+
+    def should_update(self, error, timestamp):
+        return self.model.should_update(error, timestamp)
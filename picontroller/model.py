@@ -0,0 +1,427 @@
+"""
+Exact pure-Python model of contracts/PIController.vy.
+
+Every arithmetic step follows the contract: int256/uint256 range checks revert
+exactly where Vyper's checked math would, and signed `//` truncates toward zero
+like the EVM's SDIV (Python's `//` floors, so it is never used on signed values
+directly).
+"""
+from dataclasses import dataclass
+
+MAX_INT256 = 2 ** 255 - 1
+MIN_INT256 = -(2 ** 255)
+MAX_UINT256 = 2 ** 256 - 1
+MAX_INT128 = 2 ** 127 - 1
+MIN_INT128 = -(2 ** 127)
+MAX_UINT32 = 2 ** 32 - 1
+MAX_UINT96 = 2 ** 96 - 1
+
+TWENTY_SEVEN_DECIMAL_NUMBER = 10 ** 27
+EIGHTEEN_DECIMAL_NUMBER = 10 ** 18
+RAY = 10 ** 27
+
+MAX_OBSERVATIONS = 1024
+
+# Mask bits of set_parameters(), pi_math.SET_*, in the order of pi_math.Parameters
+PARAMETER_BITS = {
+    "kp": 1,
+    "ki": 2,
+    "co_bias": 4,
+    "output_upper_bound": 8,
+    "output_lower_bound": 16,
+    "per_second_integral_leak": 32,
+    "leak_cadence": 64,
+    "error_integral": 128,
+    "output_deadband": 256,
+}
+
+
+class Revert(Exception):
+    """Raised wherever the contract would revert."""
+
+    def __init__(self, reason=""):
+        super().__init__(reason)
+        self.reason = reason
+
+
+def int256(x):
+    if x < MIN_INT256 or x > MAX_INT256:
+        raise Revert()
+    return x
+
+
+def int128(x):
+    if x < MIN_INT128 or x > MAX_INT128:
+        raise Revert()
+    return x
+
+
+def uint256(x):
+    if x < 0 or x > MAX_UINT256:
+        raise Revert()
+    return x
+
+
+def sdiv(x, y):
+    """Signed division truncating toward zero, as Vyper's `//` on int256."""
+    if y == 0:
+        raise Revert()
+    q = abs(x) // abs(y)
+    return int256(q if (x < 0) == (y < 0) else -q)
+
+
+def rpower(x, n, base):
+    """
+    `_rpower` from the contract, itself a port of the assembly rpower in
+    orig/src/PIController.sol: x**n scaled by `base`, rounding every step.
+    """
+    if x == 0:
+        return base if n == 0 else 0
+    z = base if n % 2 == 0 else x
+    half = base // 2
+    n //= 2
+    while n:
+        # Overflow reverts even when base is 0 and the EVM division returns 0
+        xx = uint256(uint256(x * x) + half)
+        x = xx // base if base else 0
+        if n % 2:
+            zx = uint256(uint256(z * x) + half)
+            z = zx // base if base else 0
+        n //= 2
+    return z
+
+
+def parameters_and_mask(**values):
+    """The (parameters, mask) arguments of `set_parameters` that set exactly `values`."""
+    for name in values:
+        if name not in PARAMETER_BITS:
+            raise ValueError(f"unknown parameter {name!r}")
+    parameters = tuple(values.get(name, 0) for name in PARAMETER_BITS)
+    return parameters, sum(PARAMETER_BITS[name] for name in values)
+
+
+# MockPIRateSetterNew.NEGATIVE_RATE_LIMIT
+NEGATIVE_RATE_LIMIT = RAY - 1
+
+
+def redemption_rate(output, noise_barrier=0):
+    """
+    The redemption rate orig/test/utils/mock/MockPIRateSetterNew.sol relays for
+    a controller output: RAY within the noise barrier, otherwise its
+    getBoundedRedemptionRate, branch for branch and in the same order.
+    """
+    if abs(output) <= noise_barrier or output == 0:
+        return RAY
+    # defaultRedemptionRate is RAY, so this is any output at or below -RAY
+    if output < 0 and -output >= RAY:
+        return NEGATIVE_RATE_LIMIT
+    if output < 0 and output <= -NEGATIVE_RATE_LIMIT:
+        return RAY - NEGATIVE_RATE_LIMIT
+    return RAY + output
+
+
+def _observe(previous, output, error, timestamp):
+    """pi_math._observe on (timestamp, output integral, error integral) tuples."""
+    elapsed = timestamp - previous[0]
+    return (timestamp, (previous[1] + output * elapsed) % 2**192, (previous[2] + error * elapsed) % 2**256)
+
+
+def _signed(x, bits):
+    return x - 2**bits if x >> (bits - 1) else x
+
+
+def _average(old, new):
+    """pi_math._average: (output, error) averages between two observations, truncated toward zero."""
+    elapsed = new[0] - old[0]
+    return (sdiv(_signed((new[1] - old[1]) % 2**192, 192), elapsed),
+            sdiv(_signed((new[2] - old[2]) % 2**256, 256), elapsed))
+
+
+@dataclass
+class ControllerState:
+    error_integral: int = 0
+    last_error: int = 0
+    last_update_time: int = 0
+    last_output: int = 0
+    last_p_output: int = 0
+    last_i_output: int = 0
+
+
+class PIControllerModel:
+    """
+    Mirrors the storage and entry points of PIController.vy.
+
+    Views take the block timestamp explicitly instead of reading it from a chain.
+    """
+
+    def __init__(self, kp, ki, co_bias, per_second_integral_leak,
+                 output_upper_bound, output_lower_bound, imported_state=(0, 0, 0),
+                 timestamp=None):
+        if not output_upper_bound > output_lower_bound:
+            raise Revert("PIController/invalid-bounds")
+        if per_second_integral_leak > TWENTY_SEVEN_DECIMAL_NUMBER:
+            raise Revert("PIController/invalid-per_second_integral_leak")
+        if timestamp is not None and imported_state[0] > timestamp:
+            raise Revert("PIController/invalid-imported-time")
+        self.kp = kp
+        self.ki = ki
+        self.co_bias = co_bias
+        self.per_second_integral_leak = per_second_integral_leak
+        # The contract caches rpower(leak, leak_cadence, RAY); the cache only
+        # saves gas, so the model recomputes and just tracks the parameter
+        self.leak_cadence = 0
+        # Updates that would move the output by less than this leave the outputs as they are
+        self.output_deadband = 0
+        # Ring of (timestamp, output integral mod 2**192, error integral mod 2**256) kept
+        # by update() once observation_cardinality is set; the latest is at ring_index
+        self.observation_cardinality = 0
+        self.observations = []
+        self.ring_index = 0
+        # Bounds are stored packed as two int128 halves of one slot
+        self.output_upper_bound = int128(output_upper_bound)
+        self.output_lower_bound = int128(output_lower_bound)
+        self.state = ControllerState(
+            last_update_time=imported_state[0],
+            last_error=imported_state[1],
+            error_integral=imported_state[2],
+        )
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        """A model in the state of a `ControllerSnapshot`, e.g. from `read_snapshot`."""
+        model = cls(snapshot.kp, snapshot.ki, snapshot.co_bias, snapshot.per_second_integral_leak,
+                    snapshot.output_upper_bound, snapshot.output_lower_bound)
+        model.leak_cadence = snapshot.leak_cadence
+        model.output_deadband = snapshot.output_deadband
+        model.state = ControllerState(
+            error_integral=snapshot.error_integral,
+            last_error=snapshot.last_error,
+            last_update_time=snapshot.last_update_time,
+            last_output=snapshot.last_output,
+            last_p_output=snapshot.last_p_output,
+            last_i_output=snapshot.last_i_output,
+        )
+        return model
+
+    @property
+    def error_integral(self):
+        return self.state.error_integral
+
+    @property
+    def last_error(self):
+        return self.state.last_error
+
+    @property
+    def last_update_time(self):
+        return self.state.last_update_time
+
+    def modify_parameters_uint(self, parameter, val):
+        if parameter == "per_second_integral_leak":
+            if val > TWENTY_SEVEN_DECIMAL_NUMBER:
+                raise Revert("PIController/invalid-per_second_integral_leak")
+            self.per_second_integral_leak = val
+        elif parameter == "leak_cadence":
+            if val > MAX_UINT32:
+                raise Revert()
+            self.leak_cadence = val
+        elif parameter == "observation_cardinality":
+            if val > MAX_OBSERVATIONS:
+                raise Revert("PIController/invalid-observation_cardinality")
+            self.observation_cardinality = val
+            self.observations = [(self.state.last_update_time, 0, 0)] if val else []
+            self.ring_index = 0
+        elif parameter == "output_deadband":
+            if val > MAX_UINT96:
+                raise Revert("PIController/invalid-output_deadband")
+            self.output_deadband = val
+        else:
+            raise Revert("PIController/modify-unrecognized-param")
+
+    def modify_parameters_int(self, parameter, val):
+        if parameter == "output_upper_bound":
+            if not val > self.output_lower_bound:
+                raise Revert("PIController/invalid-output_upper_bound")
+            self.output_upper_bound = int128(val)
+        elif parameter == "output_lower_bound":
+            if not val < self.output_upper_bound:
+                raise Revert("PIController/invalid-output_lower_bound")
+            self.output_lower_bound = int128(val)
+        elif parameter in ("kp", "ki", "co_bias"):
+            setattr(self, parameter, val)
+        elif parameter == "error_integral":
+            self.state.error_integral = val
+        else:
+            raise Revert("PIController/modify-unrecognized-param")
+
+    def set_parameters(self, parameters, mask):
+        """`set_parameters`: every field whose bit is in `mask`, or none if any check fails."""
+        if mask > sum(PARAMETER_BITS.values()):
+            raise Revert("PIController/modify-unrecognized-param")
+        new = {name: value for (name, bit), value in zip(PARAMETER_BITS.items(), parameters) if mask & bit}
+        upper = new.get("output_upper_bound", self.output_upper_bound)
+        lower = new.get("output_lower_bound", self.output_lower_bound)
+        if ("output_upper_bound" in new or "output_lower_bound" in new) and not upper > lower:
+            raise Revert("PIController/invalid-bounds")
+        int128(upper)
+        int128(lower)
+        if new.get("per_second_integral_leak", 0) > TWENTY_SEVEN_DECIMAL_NUMBER:
+            raise Revert("PIController/invalid-per_second_integral_leak")
+        if new.get("leak_cadence", 0) > MAX_UINT32:
+            raise Revert()
+        if new.get("output_deadband", 0) > MAX_UINT96:
+            raise Revert("PIController/invalid-output_deadband")
+
+        error_integral = new.pop("error_integral", self.state.error_integral)
+        for name, value in new.items():
+            setattr(self, name, value)
+        self.state.error_integral = error_integral
+
+    def elapsed(self, timestamp):
+        if self.state.last_update_time == 0:
+            return 0
+        return uint256(timestamp - self.state.last_update_time)
+
+    def riemann_sum(self, x, y):
+        return sdiv(int256(x + y), 2)
+
+    def bound_pi_output(self, pi_output):
+        if pi_output < self.output_lower_bound:
+            return self.output_lower_bound
+        elif pi_output > self.output_upper_bound:
+            return self.output_upper_bound
+        return pi_output
+
+    def clamp_error_integral(self, bounded_pi_output, new_error_integral, new_area):
+        error_integral = self.state.error_integral
+        if bounded_pi_output == self.output_lower_bound and new_area < 0 and error_integral < 0:
+            return int256(new_error_integral - new_area)
+        elif bounded_pi_output == self.output_upper_bound and new_area > 0 and error_integral > 0:
+            return int256(new_error_integral - new_area)
+        return new_error_integral
+
+    def get_new_error_integral(self, error, timestamp):
+        elapsed = self.elapsed(timestamp)
+        new_time_adjusted_error = int256(self.riemann_sum(error, self.state.last_error) * int256(elapsed))
+
+        leak = self.per_second_integral_leak
+        accumulated_leak = RAY if leak == RAY else rpower(leak, elapsed, RAY)
+        leaked_error_integral = sdiv(int256(accumulated_leak * self.state.error_integral),
+                                     TWENTY_SEVEN_DECIMAL_NUMBER)
+
+        return (int256(leaked_error_integral + new_time_adjusted_error), new_time_adjusted_error)
+
+    def get_raw_pi_output(self, error, error_i):
+        p_output = sdiv(int256(error * self.kp), EIGHTEEN_DECIMAL_NUMBER)
+        i_output = sdiv(int256(error_i * self.ki), EIGHTEEN_DECIMAL_NUMBER)
+        return (int256(int256(self.co_bias + p_output) + i_output), p_output, i_output)
+
+    def get_new_pi_output(self, error, timestamp):
+        new_error_integral, _ = self.get_new_error_integral(error, timestamp)
+        pi_output, p_output, i_output = self.get_raw_pi_output(error, new_error_integral)
+        return (self.bound_pi_output(pi_output), p_output, i_output)
+
+    def get_new_pi_outputs(self, queries):
+        """`get_new_pi_outputs`: get_new_pi_output for each (error, timestamp) pair."""
+        return [self.get_new_pi_output(error, timestamp) for error, timestamp in queries]
+
+    def within_deadband(self, bounded_pi_output):
+        """Whether update() would leave the outputs as they are for `bounded_pi_output`."""
+        return abs(bounded_pi_output - self.state.last_output) < self.output_deadband
+
+    def _step(self, error, timestamp):
+        """(state update(error) would store at `timestamp`, the outputs it would return)."""
+        if not timestamp > self.state.last_update_time:
+            raise Revert("PIController/wait-longer")
+
+        new_error_integral, new_area = self.get_new_error_integral(error, timestamp)
+        pi_output, p_output, i_output = self.get_raw_pi_output(error, new_error_integral)
+        bounded_pi_output = self.bound_pi_output(pi_output)
+
+        state = ControllerState(
+            error_integral=self.clamp_error_integral(bounded_pi_output, new_error_integral, new_area),
+            last_error=error,
+            last_update_time=timestamp,
+            last_output=bounded_pi_output,
+            last_p_output=p_output,
+            last_i_output=i_output,
+        )
+        if self.within_deadband(bounded_pi_output):
+            s = self.state
+            state.last_output, state.last_p_output, state.last_i_output = (s.last_output, s.last_p_output,
+                                                                           s.last_i_output)
+        return state, (state.last_output, p_output, i_output)
+
+    def fast_forward(self, error, timestamp):
+        """
+        The ControllerState `update(error)` would store at `timestamp`, without
+        storing it. However long the gap since the last update, the leak is one
+        `rpower` (O(log elapsed)) and the area one product.
+        """
+        return self._step(error, timestamp)[0]
+
+    def should_update(self, error, timestamp):
+        """`should_update`: whether update(error) at `timestamp` would move the output at all."""
+        if not timestamp > self.state.last_update_time:
+            return False
+        return not self.within_deadband(self.get_new_pi_output(error, timestamp)[0])
+
+    def update(self, error, timestamp):
+        """
+        Apply `update(error)` mined at `timestamp`. State is left untouched
+        when the call reverts. Within the output deadband the result pairs the
+        kept `last_output` with the p and i outputs computed for `error`, as
+        the contract returns them.
+        """
+        state, outputs = self._step(error, timestamp)
+        if self.observation_cardinality:
+            self._record_observation(timestamp)
+        self.state = state
+        return outputs
+
+    def _record_observation(self, timestamp):
+        s = self.state
+        observation = _observe(self.observations[self.ring_index], s.last_output, s.last_error, timestamp)
+        self.ring_index = (self.ring_index + 1) % self.observation_cardinality
+        if len(self.observations) < self.observation_cardinality:
+            self.observations.append(observation)
+        else:
+            self.observations[self.ring_index] = observation
+
+    def _observation(self, age):
+        """The observation `age` updates back in the ring."""
+        if not age < len(self.observations):
+            raise Revert("PIController/observation-too-old")
+        return self.observations[(self.ring_index - age) % self.observation_cardinality]
+
+    def observation(self, age):
+        """`observation`: (timestamp, bounded output, error) of an update in the ring, 0 the latest."""
+        old = self._observation(age)
+        if age == 0:
+            return (old[0], self.state.last_output, self.state.last_error)
+        return (old[0], *_average(old, self._observation(age - 1)))
+
+    def average_over_updates(self, updates):
+        """`average_over_updates`: time-weighted (output, error) from `updates` back to the latest update."""
+        if updates == 0:
+            raise Revert("PIController/observation-too-old")
+        return _average(self._observation(updates), self._observation(0))
+
+    def average_over(self, seconds, timestamp):
+        """`average_over`: time-weighted (output, error) over the `seconds` up to `timestamp`."""
+        s = self.state
+        if seconds == 0 or not self.observations or seconds > timestamp:
+            raise Revert("PIController/observation-too-old")
+        start = timestamp - seconds
+        if start >= self._observation(0)[0]:
+            return (s.last_output, s.last_error)
+        ages = [age for age in range(len(self.observations)) if self._observation(age)[0] <= start]
+        if not ages:
+            raise Revert("PIController/observation-too-old")
+        before = self._observation(ages[0])
+        output, error = _average(before, self._observation(ages[0] - 1))
+        return _average(_observe(before, output, error, start),
+                        _observe(self._observation(0), s.last_output, s.last_error, timestamp))
+
+    def last_update(self):
+        s = self.state
+        return (s.last_update_time, s.last_output, s.last_p_output, s.last_i_output)
@@ -0,0 +1,297 @@
+"""
+Replays a recorded error series through a deployed controller on a local node.
+
+    python -m picontroller.replay --rpc http://127.0.0.1:8545 --controller 0x.. --errors errors.csv \
+        --output replay.trace
+
+The series is a text file of "timestamp,error" lines, read as a stream. The
+node's automine is turned off, and every update is mined in a block of its
+own at its recorded timestamp (`evm_mine`, as anvil and hardhat take it).
+That makes the replay serial: each update is sent and then mined before the
+next is sent, two awaited round trips, so its rate is bounded by the node's
+round-trip and mining time. Everything else is kept off that path.
+Transactions are signed a batch at a time with locally tracked nonces, and a
+batch's receipts are fetched concurrently in a background task while the next
+batch is sent and mined. Each update's outputs are decoded from its
+`UpdateEvent` or `DeadbandUpdateEvent` and appended to a `TraceWriter` file in
+input order.
+
+After every batch the trace is flushed and a checkpoint is written next to it.
+Running again with the same output resumes: the trace is cut back to the
+checkpoint, updates mined after it are recovered from the controller's logs,
+and the series continues after the last recorded timestamp on the chain. An
+output that is missing, not a trace or shorter than the checkpoint says stops
+the resume with a ValueError instead.
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+
+from eth_abi import decode
+from eth_account import Account
+from web3 import AsyncWeb3
+
+from picontroller.evm import encode_call
+from picontroller.indexer import TOPICS, decode_log
+from picontroller.keeper import UPDATE_GAS, connect
+from picontroller.trace import HEADER, MAGIC, RECORD, TraceWriter
+
+UPDATE_EVENTS = ("UpdateEvent", "DeadbandUpdateEvent")
+
+
+def read_errors(path):
+    """
+    (timestamp, error) of every "timestamp,error" line of `path`, lazily.
+    Blank lines, lines starting with # and a header line are skipped.
+    """
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            timestamp, error = line.split(",")[:2]
+            if not timestamp.strip().isdigit():
+                continue
+            yield int(timestamp), int(error)
+
+
+class RPCNode:
+    """anvil or hardhat: `evm_setAutomine` and `evm_mine` with the block's timestamp."""
+
+    def __init__(self, w3):
+        self.w3 = w3
+
+    async def _request(self, method, params):
+        response = await self.w3.provider.make_request(method, params)
+        if response.get("error"):
+            raise RuntimeError(f"{method}: {response['error']}")
+        return response.get("result")
+
+    async def set_automine(self, enabled):
+        await self._request("evm_setAutomine", [enabled])
+
+    async def mine(self, timestamp):
+        await self._request("evm_mine", [timestamp])
+
+
+class EthTesterNode:
+    """The eth-tester chain behind an `AsyncEthereumTesterProvider`."""
+
+    def __init__(self, w3):
+        self.tester = w3.provider.ethereum_tester
+
+    async def set_automine(self, enabled):
+        if enabled:
+            self.tester.enable_auto_mine_transactions()
+        else:
+            self.tester.disable_auto_mine_transactions()
+
+    async def mine(self, timestamp):
+        # time_travel mines an empty block a second earlier, unless the pending block is already there
+        self.tester.time_travel(timestamp)
+        self.tester.mine_blocks()
+
+
+class Replay:
+    """
+    Drives `controller` (an address) from `account`, which must be its
+    updater, writing one trace record per update to `output`.
+    """
+
+    def __init__(self, w3, node, account, controller, output, checkpoint=None, batch_size=256, gas=UPDATE_GAS):
+        self.w3 = w3
+        self.node = node
+        self.account = account
+        self.controller = AsyncWeb3.to_checksum_address(controller)
+        self.output = output
+        self.checkpoint = checkpoint or f"{output}.checkpoint"
+        self.batch_size = batch_size
+        self.gas = gas
+        # Outputs of the last update, which a deadband update leaves in place
+        self._last = None
+        self._last_time = None
+        self._block = None
+        self.recovered = 0
+
+    def _save_checkpoint(self, records):
+        last_output, last_p_output, last_i_output = self._last
+        temporary = f"{self.checkpoint}.tmp"
+        with open(temporary, "w") as f:
+            json.dump(dict(controller=self.controller, records=records, block=self._block,
+                           last_update_time=self._last_time, last_output=last_output,
+                           last_p_output=last_p_output, last_i_output=last_i_output), f)
+        os.replace(temporary, self.checkpoint)
+
+    def _record(self, log):
+        """The trace record of an update log, or None for any other log."""
+        if (AsyncWeb3.to_checksum_address(log["address"]) != self.controller
+                or TOPICS.get(bytes(log["topics"][0])) not in UPDATE_EVENTS):
+            return None
+        name, values = decode_log(log)
+        if name == "UpdateEvent":
+            error, error_integral, p_output, i_output, output_and_time = values
+            output = (output_and_time >> 128) - (1 << 128 if output_and_time >> 255 else 0)
+            self._last = (output, p_output, i_output)
+        else:
+            error, error_integral, output_and_time = values
+        self._last_time = output_and_time & (2**64 - 1)
+        return (self._last_time, error, error_integral, *self._last)
+
+    def _cut_back(self, records):
+        """
+        Truncate the output to the `records` the checkpoint covers; records
+        flushed after it are recovered from the logs again. Raises unless the
+        output is a trace holding at least that many.
+        """
+        size = HEADER.size + records * RECORD.itemsize
+        if not os.path.exists(self.output):
+            raise ValueError(f"{self.checkpoint} covers {records} records but {self.output} does not exist")
+        with open(self.output, "rb") as f:
+            magic, record_size = HEADER.unpack(f.read(HEADER.size).ljust(HEADER.size, b'\0'))
+            if magic != MAGIC or record_size != RECORD.itemsize:
+                raise ValueError(f"{self.output} is not a trace file")
+            length = os.fstat(f.fileno()).st_size
+        if length < size:
+            raise ValueError(f"{self.checkpoint} covers {records} records but {self.output} holds only "
+                             f"{(length - HEADER.size) // RECORD.itemsize}")
+        os.truncate(self.output, size)
+
+    async def _start(self, writer, checkpoint):
+        if checkpoint is not None:
+            self._block = checkpoint["block"]
+            self._last_time = checkpoint["last_update_time"]
+            self._last = (checkpoint["last_output"], checkpoint["last_p_output"], checkpoint["last_i_output"])
+            await self._recover(writer)
+        else:
+            if len(writer):
+                raise ValueError(f"{self.output} has records but no checkpoint to resume from")
+            self._block = await self.w3.eth.block_number
+            raw = await self.w3.eth.call(dict(to=self.controller, data=encode_call("last_update()")))
+            (self._last_time, *self._last) = decode(["uint256", "int256", "int256", "int256"], raw)
+            self._save_checkpoint(0)
+
+    async def _recover(self, writer):
+        """Append the updates mined after the checkpoint, which a stopped replay never wrote."""
+        latest = await self.w3.eth.block_number
+        logs = await self.w3.eth.get_logs({"address": self.controller, "fromBlock": self._block + 1,
+                                           "toBlock": latest, "topics": [list(TOPICS)]})
+        for log in logs:
+            record = self._record(log)
+            if record is not None:
+                writer.append(*record)
+                self.recovered += 1
+        self._block = latest
+        writer.flush()
+        self._save_checkpoint(len(writer))
+
+    def _sign(self, batch, nonce, gas_price, chain_id):
+        # EIP-1559 transactions: the base fee only falls over blocks of one update, and eth-tester
+        # refuses to queue legacy EIP-155 signatures while automine is off
+        return [self.account.sign_transaction(dict(to=self.controller, data=encode_call("update(int256)", error),
+                                                   value=0, gas=self.gas, maxFeePerGas=2 * gas_price,
+                                                   maxPriorityFeePerGas=gas_price, nonce=nonce + k,
+                                                   chainId=chain_id)).raw_transaction
+                for k, (_, error) in enumerate(batch)]
+
+    async def _receipts(self, hashes):
+        return await asyncio.gather(*(self.w3.eth.get_transaction_receipt(tx_hash) for tx_hash in hashes))
+
+    def _write(self, writer, batch, receipts):
+        for (timestamp, _), receipt in zip(batch, receipts):
+            if receipt["status"] != 1:
+                raise RuntimeError(f"update at {timestamp} reverted in block {receipt['blockNumber']}")
+            records = [record for record in map(self._record, receipt["logs"]) if record is not None]
+            writer.append(*records[0])
+            self._block = receipt["blockNumber"]
+        writer.flush()
+        self._save_checkpoint(len(writer))
+
+    def _batches(self, records):
+        batch, previous = [], self._last_time
+        for timestamp, error in records:
+            # Already on the chain, from the checkpoint or recovered after it
+            if timestamp <= self._last_time:
+                continue
+            if timestamp <= previous:
+                raise ValueError(f"timestamps must increase: {timestamp} after {previous}")
+            previous = timestamp
+            batch.append((timestamp, error))
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    async def run(self, records):
+        """
+        Replay `records`, (timestamp, error) pairs in order, skipping those at
+        or before the controller's last update. Returns a summary dict.
+        """
+        started = time.monotonic()
+        replayed = 0
+        checkpoint = None
+        if os.path.exists(self.checkpoint):
+            with open(self.checkpoint) as f:
+                checkpoint = json.load(f)
+            if checkpoint["controller"] != self.controller:
+                raise ValueError(f"{self.checkpoint} belongs to {checkpoint['controller']}")
+            self._cut_back(checkpoint["records"])
+
+        with TraceWriter(self.output) as writer:
+            await self._start(writer, checkpoint)
+
+            address = self.account.address
+            nonce, pending = await asyncio.gather(self.w3.eth.get_transaction_count(address, "latest"),
+                                                  self.w3.eth.get_transaction_count(address, "pending"))
+            if pending != nonce:
+                raise RuntimeError(f"{address} has {pending - nonce} pending transactions")
+            chain_id, gas_price = await asyncio.gather(self.w3.eth.chain_id, self.w3.eth.gas_price)
+
+            await self.node.set_automine(False)
+            previous = None
+            try:
+                for batch in self._batches(records):
+                    signed = self._sign(batch, nonce, gas_price, chain_id)
+                    hashes = []
+                    for (timestamp, _), raw in zip(batch, signed):
+                        hashes.append(await self.w3.eth.send_raw_transaction(raw))
+                        await self.node.mine(timestamp)
+                    nonce += len(batch)
+                    # The previous batch's receipts were fetched while this one was sent
+                    if previous is not None:
+                        self._write(writer, previous[0], await previous[1])
+                    previous = (batch, asyncio.create_task(self._receipts(hashes)))
+                    replayed += len(batch)
+                if previous is not None:
+                    self._write(writer, previous[0], await previous[1])
+            finally:
+                await self.node.set_automine(True)
+            records = len(writer)
+
+        seconds = time.monotonic() - started
+        return dict(replayed=replayed, recovered=self.recovered, records=records, seconds=seconds,
+                    per_second=replayed / seconds if seconds else None)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--rpc", default="http://127.0.0.1:8545")
+    parser.add_argument("--controller", required=True)
+    parser.add_argument("--errors", required=True, help='recorded series, "timestamp,error" per line')
+    parser.add_argument("--output", required=True, help="trace file; resumed if its checkpoint exists")
+    parser.add_argument("--checkpoint", default=None, help="default: the output path + .checkpoint")
+    parser.add_argument("--key-env", default="KEEPER_PRIVATE_KEY", help="variable holding the updater's key")
+    parser.add_argument("--batch-size", type=int, default=256)
+    args = parser.parse_args(argv)
+
+    w3 = connect(args.rpc)
+    replay = Replay(w3, RPCNode(w3), Account.from_key(os.environ[args.key_env]), args.controller, args.output,
+                    args.checkpoint, args.batch_size)
+    print(asyncio.run(replay.run(read_errors(args.errors))))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
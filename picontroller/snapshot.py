@@ -0,0 +1,61 @@
+"""
+Typed decoding of `get_state()`, the single-call snapshot of a controller.
+
+`decode_snapshot` accepts whatever the caller has at hand: the raw ABI-encoded
+return data of an `eth_call`, or the already-decoded tuple/struct that ape or
+web3 hand back.
+"""
+from dataclasses import dataclass, fields
+
+from eth_abi import decode
+from eth_utils import to_checksum_address
+
+
+@dataclass(frozen=True)
+class ControllerSnapshot:
+    control_variable: bytes
+    kp: int
+    ki: int
+    co_bias: int
+    output_upper_bound: int
+    output_lower_bound: int
+    per_second_integral_leak: int
+    leak_cadence: int
+    output_deadband: int
+    error_integral: int
+    last_error: int
+    last_update_time: int
+    last_output: int
+    last_p_output: int
+    last_i_output: int
+    elapsed: int
+    updater: str
+
+    def last_update(self):
+        """Same tuple as the contract's `last_update()`."""
+        return (self.last_update_time, self.last_output, self.last_p_output, self.last_i_output)
+
+
+# ABI type of the returned struct, in field order
+SNAPSHOT_ABI = "(bytes32,int256,int256,int256,int256,int256,uint256,uint256,uint256,int256,int256,uint256,int256,int256,int256,uint256,address)"
+
+
+def decode_snapshot(value):
+    """ControllerSnapshot from raw `get_state()` return data or its decoded values."""
+    if isinstance(value, (bytes, bytearray)):
+        (value,) = decode([SNAPSHOT_ABI], bytes(value))
+    values = list(value)
+    if len(values) != len(fields(ControllerSnapshot)):
+        raise ValueError(f"expected {len(fields(ControllerSnapshot))} values, got {len(values)}")
+    values[0] = bytes(values[0])
+    values[-1] = to_checksum_address(values[-1])
+    return ControllerSnapshot(*values)
+
+
+def read_snapshot(controller, *args):
+    """
+    One `get_state()` call on an ape contract; pass the id as well for
+    PIControllerRegistry.
+    """
+    return decode_snapshot(controller.get_state(*args))
+
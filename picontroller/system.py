@@ -0,0 +1,269 @@
+"""
+Closed-loop simulation of the controller with a mock rate setter and relayer.
+
+This is the loop that orig/test/utils/mock/MockPIRateSetterNew.sol and
+MockOracleRelayer.sol close on chain. Every `update_every` blocks the rate
+setter computes the error between the redemption price and the market price
+and calls `update(error)`. It turns the output into a redemption rate of
+RAY + output, after the noise barrier and the negative rate limit. The relayer
+then compounds the redemption price at that rate with `rpower`.
+
+Many scenarios run side by side as lanes of a `BatchPIController`. The
+controller and relayer state are exact integers, as on chain, and change only at
+updates. Between updates the redemption rate is constant, so each update
+interval is handed to the market model as a whole block of per-block
+redemption prices. Only the market path is vectorized: the market model returns
+the market price for every block of the interval as one float array over
+scenarios and blocks. The relayer and rate setter arithmetic is exact uint256
+work on object arrays of Python ints, so each update costs Python-speed work per
+scenario. A year of 12-second blocks with hourly updates is 8,760 iterations of
+the loop, not 2.6 million.
+
+A lane whose redemption price overflows uint256 halts: MockOracleRelayer's
+`rpower` or `rmultiply` reverts, and so does every later update through it.
+Its price, rate and controller stay frozen and `LoopResult.halted` marks it.
+"""
+import math
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+
+import numpy as np
+
+from picontroller.batch import BatchPIController, _as_array, _rpower
+from picontroller.model import MAX_UINT256, RAY, redemption_rate
+
+BASE_TIMESTAMP = 1_700_000_000
+SECONDS_PER_YEAR = 365 * 24 * 3600
+
+# How far the scaled cumulative sum in MeanRevertingMarket may amplify values
+_MAX_AMPLIFICATION = 1e6
+
+
+class MarketModel(ABC):
+    """
+    Market price process. `reset` starts `n` scenarios; `path` receives the
+    natural log of the redemption price (in units of the reference asset) at
+    each block of the next interval, shape (n, blocks), and returns the log of
+    the market price at the same blocks.
+    """
+
+    def reset(self, n, block_time, rng):
+        self.n = n
+        self.block_time = block_time
+        self.rng = rng
+
+    @abstractmethod
+    def path(self, log_redemption):
+        ...
+
+
+class ConstantMarket(MarketModel):
+    def __init__(self, price=1.0):
+        self.price = price
+
+    def path(self, log_redemption):
+        return np.full(log_redemption.shape, math.log(self.price))
+
+
+class RecordedMarket(MarketModel):
+    """Replays recorded per-block market prices, the same path in every scenario."""
+
+    def __init__(self, prices):
+        self.log_prices = np.log(np.asarray(prices, dtype=float))
+
+    def reset(self, n, block_time, rng):
+        super().reset(n, block_time, rng)
+        self.block = 0
+
+    def path(self, log_redemption):
+        n, k = log_redemption.shape
+        if self.block + k > len(self.log_prices):
+            raise ValueError(f"recorded prices end at block {len(self.log_prices)}")
+        log_prices = self.log_prices[self.block:self.block + k]
+        self.block += k
+        return np.broadcast_to(log_prices, (n, k))
+
+
+def _shocks(model, sigma, shape):
+    """Normal shocks; with `common` every scenario draws the same ones."""
+    if model.common:
+        return np.broadcast_to(model.rng.normal(0, sigma, (1, shape[1])), shape)
+    return model.rng.normal(0, sigma, shape)
+
+
+class RandomWalkMarket(MarketModel):
+    """
+    Geometric random walk with annualized `volatility`, blind to the redemption
+    price. With `common`, every scenario follows the same path.
+    """
+
+    def __init__(self, volatility, start=1.0, common=False):
+        self.volatility = volatility
+        self.start = start
+        self.common = common
+
+    def reset(self, n, block_time, rng):
+        super().reset(n, block_time, rng)
+        self.log_price = np.full(n, math.log(self.start))
+
+    def path(self, log_redemption):
+        sigma = self.volatility * math.sqrt(self.block_time / SECONDS_PER_YEAR)
+        steps = _shocks(self, sigma, log_redemption.shape)
+        log_prices = self.log_price[:, None] + np.cumsum(steps, axis=1)
+        self.log_price = log_prices[:, -1]
+        return log_prices
+
+
+class MeanRevertingMarket(MarketModel):
+    """
+    Market price pulled toward the redemption price: the log deviation decays
+    with `half_life` seconds and takes annualized `volatility` noise. With
+    `common`, every scenario takes the same noise.
+
+    The deviation decays toward `premium + rate_sensitivity * rate`, where
+    `rate` is the annualized log redemption rate: a falling redemption price
+    makes holding less attractive and pulls the market down further. That
+    models a demand shock which only a redemption rate of
+    `-premium / rate_sensitivity` offsets.
+    """
+
+    def __init__(self, half_life, volatility, start=1.0, common=False, premium=0.0, rate_sensitivity=0.0):
+        self.half_life = half_life
+        self.volatility = volatility
+        self.start = start
+        self.common = common
+        self.premium = premium
+        self.rate_sensitivity = rate_sensitivity
+
+    def reset(self, n, block_time, rng):
+        super().reset(n, block_time, rng)
+        self.log_price = np.full(n, math.log(self.start))
+        self.last_log_redemption = np.zeros(n)
+
+    def path(self, log_redemption):
+        # x[t] = a x[t-1] + (1 - a) (m[t] + target[t]) + e[t]. The deviation
+        # d = x - m then follows d[t] = a d[t-1] - a (m[t] - m[t-1]) +
+        # (1 - a) target[t] + e[t], which is solved for a whole block at once
+        # as a scaled cumulative sum
+        a = 0.5 ** (self.block_time / self.half_life)
+        sigma = self.volatility * math.sqrt(self.block_time / SECONDS_PER_YEAR)
+        n, k = log_redemption.shape
+        drift = np.diff(log_redemption, axis=1, prepend=self.last_log_redemption[:, None])
+        target = self.premium + self.rate_sensitivity * drift * (SECONDS_PER_YEAR / self.block_time)
+        shocks = _shocks(self, sigma, (n, k)) - a * drift + (1 - a) * target
+        deviation = self.log_price - self.last_log_redemption
+
+        out = np.empty((n, k))
+        # Sub-blocks short enough that a**-length stays well inside float64
+        length = k if a == 1 else max(1, int(math.log(_MAX_AMPLIFICATION) / -math.log(a)))
+        for start in range(0, k, length):
+            u = shocks[:, start:start + length]
+            j = np.arange(1, u.shape[1] + 1)
+            scaled = np.cumsum(u * a ** -j, axis=1)
+            out[:, start:start + length] = a ** j * (deviation[:, None] + scaled)
+            deviation = out[:, start + u.shape[1] - 1]
+
+        log_prices = log_redemption + out
+        self.log_price = log_prices[:, -1]
+        self.last_log_redemption = log_redemption[:, -1]
+        return log_prices
+
+
+@dataclass
+class LoopResult:
+    """
+    Per recorded update: `timestamps` (updates,) and arrays of shape
+    (updates, scenarios) for the market and redemption prices (floats, in
+    units of the reference asset), the controller output, and `saturation`
+    (+1 at output_upper_bound, -1 at output_lower_bound, 0 otherwise).
+    A lane whose update reverted records its stored output. `max_deviation`
+    is the largest |log(market / redemption)| seen at any block, and `halted`
+    whether the relayer stopped on an overflow, per scenario.
+    """
+    timestamps: np.ndarray
+    market: np.ndarray
+    redemption: np.ndarray
+    output: np.ndarray
+    saturation: np.ndarray
+    max_deviation: np.ndarray
+    halted: np.ndarray
+
+    def saturated_fraction(self):
+        """Share of recorded updates at the (upper, lower) bound, per scenario."""
+        return (self.saturation == 1).mean(axis=0), (self.saturation == -1).mean(axis=0)
+
+
+class LoopSimulator:
+    """
+    `n` scenarios of the controller loop. Controller arguments are scalars or
+    per-scenario sequences, as for BatchPIController.
+    """
+
+    def __init__(self, n, kp, ki, co_bias, per_second_integral_leak, output_upper_bound, output_lower_bound,
+                 market, block_time=12, update_every=300, noise_barrier=0, seed=0):
+        self.n = n
+        self.controller = BatchPIController(n, kp, ki, co_bias, per_second_integral_leak,
+                                            output_upper_bound, output_lower_bound)
+        self.market = market
+        self.block_time = block_time
+        self.update_every = update_every
+        self.noise_barrier = noise_barrier
+        market.reset(n, block_time, np.random.default_rng(seed))
+
+        self.timestamp = BASE_TIMESTAMP
+        self.redemption_price = _as_array(RAY, n)
+        self.redemption_rate = _as_array(RAY, n)
+        self.max_deviation = np.zeros(n)
+        self.halted = np.zeros(n, dtype=bool)
+
+    def _relay(self, output):
+        """MockPIRateSetterNew: the redemption rate for each controller output."""
+        return np.array([redemption_rate(int(v), self.noise_barrier) for v in output], dtype=object)
+
+    def step(self):
+        """One update interval; returns (market, redemption, output, saturation) at its end."""
+        k, dt = self.update_every, self.block_time
+        log_price = np.log(self.redemption_price.astype(float) / float(RAY))
+        log_rate = np.log1p((self.redemption_rate - RAY).astype(float) / float(RAY))
+        log_redemption = log_price[:, None] + log_rate[:, None] * dt * np.arange(1, k + 1)
+
+        log_market = self.market.path(log_redemption)
+        np.maximum(self.max_deviation, np.abs(log_market - log_redemption).max(axis=1), out=self.max_deviation)
+
+        # MockOracleRelayer.updateRedemptionPrice, exactly; where rpower or the
+        # product overflows it reverts, and keeps reverting at every later update
+        bad = self.halted.copy()
+        price = _rpower(self.redemption_rate, np.full(self.n, k * dt), RAY, bad) * self.redemption_price
+        bad |= price > MAX_UINT256
+        self.halted = bad
+        self.redemption_price = np.where(bad, self.redemption_price, np.maximum(price // RAY, 1))
+        self.timestamp += k * dt
+
+        market = np.exp(log_market[:, -1])
+        market_wad = np.array([int(p * 10**18) for p in market], dtype=object)
+        numerator = (self.redemption_price - market_wad * 10**9) * RAY
+        quotient = np.abs(numerator) // self.redemption_price
+        error = np.where(numerator < 0, -quotient, quotient)
+
+        # Halted lanes pass their last update time, so the controller reverts them unchanged
+        c = self.controller
+        bounded, _, _, reverted = c.update(error, np.where(self.halted, c.last_update_time, self.timestamp))
+        self.redemption_rate = np.where(reverted, self.redemption_rate, self._relay(bounded))
+        bounded = np.where(reverted, c.last_output, bounded)
+
+        saturation = np.where(bounded == c.output_upper_bound, 1, np.where(bounded == c.output_lower_bound, -1, 0))
+        redemption = self.redemption_price.astype(float) / float(RAY)
+        return market, redemption, bounded.astype(float), saturation.astype(np.int8)
+
+    def run(self, blocks, record_every=1):
+        """Simulate `blocks` more blocks, recording every `record_every`-th update."""
+        columns = ([], [], [], [], [])
+        for u in range(blocks // self.update_every):
+            values = self.step()
+            if u % record_every == 0:
+                columns[0].append(self.timestamp)
+                for column, value in zip(columns[1:], values):
+                    column.append(value)
+        timestamps, market, redemption, output, saturation = columns
+        return LoopResult(np.array(timestamps), np.array(market), np.array(redemption), np.array(output),
+                          np.array(saturation), self.max_deviation.copy(), self.halted.copy())
@@ -0,0 +1,142 @@
+"""
+Append-only binary trace of controller updates.
+
+One record per update: `(timestamp, error, error_integral, bounded_output,
+p_output, i_output)`. The timestamp is a uint64 and every other field an int256
+stored as four little-endian uint64 limbs in two's complement, so a record is a
+fixed 168 bytes and the file is a flat array behind a 16-byte header.
+
+`TraceWriter` buffers records and appends them a chunk at a time, so a run
+never holds its history in memory. `Trace` memory-maps the file into a NumPy
+structured array: columns are views into the mapping, nothing is parsed, and
+two traces can be compared column by column directly on the limbs.
+"""
+import os
+import struct
+
+import numpy as np
+
+FIELDS = ("timestamp", "error", "error_integral", "bounded_output", "p_output", "i_output")
+LIMBS = 4
+
+RECORD = np.dtype([("timestamp", "<u8")] + [(name, "<u8", (LIMBS,)) for name in FIELDS[1:]])
+
+MAGIC = b"PITRACE\x01"
+HEADER = struct.Struct("<8sQ")
+
+
+def _check_header(f, path):
+    magic, record_size = HEADER.unpack(f.read(HEADER.size).ljust(HEADER.size, b'\0'))
+    if magic != MAGIC or record_size != RECORD.itemsize:
+        raise ValueError(f"{path} is not a trace file")
+    size = os.fstat(f.fileno()).st_size - HEADER.size
+    if size % RECORD.itemsize:
+        raise ValueError(f"{path} ends in a partial record")
+    return size // RECORD.itemsize
+
+
+class TraceWriter:
+    """
+    Appends records to `path`, creating it if needed. Records are written in
+    chunks of `chunk_size`; `flush` or `close` writes the remainder.
+    """
+
+    def __init__(self, path, chunk_size=16384):
+        self.path = path
+        self.chunk_size = chunk_size
+        self._buffer = bytearray()
+        self._pending = 0
+        if os.path.exists(path) and os.path.getsize(path):
+            with open(path, "rb") as f:
+                self._written = _check_header(f, path)
+            self._file = open(path, "ab")
+        else:
+            self._written = 0
+            self._file = open(path, "wb")
+            self._file.write(HEADER.pack(MAGIC, RECORD.itemsize))
+            self._file.flush()
+
+    def __len__(self):
+        return self._written + self._pending
+
+    def append(self, timestamp, error, error_integral, bounded_output, p_output, i_output):
+        buffer = self._buffer
+        buffer += timestamp.to_bytes(8, "little")
+        for value in (error, error_integral, bounded_output, p_output, i_output):
+            buffer += value.to_bytes(32, "little", signed=True)
+        self._pending += 1
+        if self._pending >= self.chunk_size:
+            self.flush()
+
+    def extend(self, records):
+        for record in records:
+            self.append(*record)
+
+    def flush(self):
+        self._file.write(self._buffer)
+        self._file.flush()
+        self._written += self._pending
+        self._buffer.clear()
+        self._pending = 0
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Trace:
+    """
+    Read-only, memory-mapped view of a trace file. `trace[name]` is the
+    column: uint64 timestamps, or an (n, 4) array of limbs for the int256
+    fields.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            length = _check_header(f, path)
+        if length:
+            self.records = np.memmap(path, dtype=RECORD, mode="r", offset=HEADER.size, shape=(length,))
+        else:
+            # mmap refuses empty mappings
+            self.records = np.zeros(0, dtype=RECORD)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, name):
+        return self.records[name]
+
+    def ints(self, name, start=0, stop=None):
+        """Python ints of one column over [start, stop)."""
+        column = self.records[name][start:stop]
+        if name == "timestamp":
+            return [int(value) for value in column]
+        return [int.from_bytes(row.tobytes(), "little", signed=True) for row in column]
+
+    def int64(self, name):
+        """
+        Zero-copy int64 view of an int256 column. Raises ValueError unless
+        every value fits, i.e. the upper limbs only sign-extend the lowest.
+        """
+        limbs = self.records[name]
+        low = limbs[:, 0].view("<i8")
+        extension = np.where(low < 0, np.uint64(2**64 - 1), np.uint64(0))
+        if not np.all(limbs[:, 1:] == extension[:, None]):
+            raise ValueError(f"{name} does not fit in int64")
+        return low
+
+    def mismatches(self, other, name):
+        """Indices where `name` differs between two traces, over their common length."""
+        n = min(len(self), len(other))
+        a, b = self.records[name][:n], other.records[name][:n]
+        differs = a != b
+        if differs.ndim > 1:
+            differs = differs.any(axis=1)
+        return np.flatnonzero(differs)
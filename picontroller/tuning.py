@@ -0,0 +1,189 @@
+"""
+Gain tuning: scores controller configurations in closed-loop scenarios.
+
+    python -m picontroller.tuning --kp 1e10 1e11 1e12 --ki 1e3 1e4 1e5 --workers 16
+
+Each scenario is a market model for `system.LoopSimulator`. The default
+scenarios are demand shocks of +5% and -5% on a market that follows the
+redemption price with a one-day half-life. Only a redemption rate of -/+5% a
+year brings the market back to the redemption price. Noisy markets should use
+`common=True`, so every candidate sees the same path.
+Candidates from the grid run as lanes of one simulator per chunk, and chunks
+are spread over a process pool. The controller is the exact model throughout.
+
+For every candidate and scenario the deviation d = log(market / redemption)
+is tracked at each update, and four metrics are kept:
+
+- overshoot: the largest deviation past zero, relative to the one at the
+  first update (or to `tolerance`, if that is larger)
+- settling: the share of the horizon until |d| stays within `tolerance`
+  (1 if it never settles)
+- saturated: the share of updates at output_upper_bound or output_lower_bound
+- windup: the largest |i_output| relative to the widest output bound
+
+The score is their weighted sum, averaged over scenarios; lower is better.
+"""
+import argparse
+import itertools
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from picontroller.model import parameters_and_mask
+from picontroller.system import LoopSimulator, MeanRevertingMarket
+
+PARAMETERS = ("kp", "ki", "per_second_integral_leak", "output_upper_bound", "output_lower_bound")
+METRICS = ("overshoot", "settling", "saturated", "windup")
+WEIGHTS = dict(overshoot=1.0, settling=1.0, saturated=1.0, windup=0.1)
+
+DEFAULTS = dict(kp=222002205862, ki=25000, per_second_integral_leak=999997208243937652252849536,
+                output_upper_bound=18640000000000000000, output_lower_bound=-51034000000000000000)
+
+
+def default_scenarios():
+    return [
+        MeanRevertingMarket(half_life=24 * 3600, volatility=0, premium=0.05, rate_sensitivity=1),
+        MeanRevertingMarket(half_life=24 * 3600, volatility=0, premium=-0.05, rate_sensitivity=1),
+    ]
+
+
+def grid(**values):
+    """Every combination of the given parameter values; unspecified ones keep DEFAULTS."""
+    names = [name for name in PARAMETERS if name in values]
+    configs = []
+    for combination in itertools.product(*(values[name] for name in names)):
+        config = dict(DEFAULTS, **{name: int(value) for name, value in zip(names, combination)})
+        if config["output_upper_bound"] > config["output_lower_bound"]:
+            configs.append(config)
+    return configs
+
+
+def evaluate(configs, market, blocks, update_every=300, tolerance=0.002, seed=0):
+    """{metric: array over configs} for one scenario."""
+    n = len(configs)
+    columns = {name: [config[name] for config in configs] for name in PARAMETERS}
+    sim = LoopSimulator(n, co_bias=0, market=market, update_every=update_every, seed=seed, **columns)
+    upper = np.array(columns["output_upper_bound"], dtype=float)
+    lower = np.array(columns["output_lower_bound"], dtype=float)
+    widest = np.maximum(np.abs(upper), np.abs(lower))
+
+    steps = blocks // update_every
+    initial = None
+    overshoot = np.zeros(n)
+    windup = np.zeros(n)
+    saturated = np.zeros(n)
+    last_outside = np.full(n, -1)
+    for u in range(steps):
+        market_price, redemption, _, saturation = sim.step()
+        deviation = np.log(market_price / redemption)
+        if initial is None:
+            # Overshoot is measured against the deviation at the first update
+            initial = deviation
+            sign = np.sign(initial)
+            scale = np.maximum(np.abs(initial), tolerance)
+        overshoot = np.maximum(overshoot, -sign * deviation / scale * (sign != 0))
+        windup = np.maximum(windup, np.abs(sim.controller.last_i_output.astype(float)) / widest)
+        saturated += saturation != 0
+        last_outside = np.where(np.abs(deviation) > tolerance, u, last_outside)
+
+    return dict(overshoot=overshoot, settling=(last_outside + 1) / steps, saturated=saturated / steps,
+                windup=windup)
+
+
+def score(metrics, weights=WEIGHTS):
+    return sum(weights[name] * metrics[name] for name in METRICS)
+
+
+def _evaluate_chunk(configs, scenarios, blocks, update_every, tolerance, weights):
+    """Metrics averaged over scenarios, and the score, for a chunk of configs."""
+    totals = {name: np.zeros(len(configs)) for name in METRICS}
+    for index, market in enumerate(scenarios):
+        metrics = evaluate(configs, market, blocks, update_every, tolerance, seed=index)
+        for name in METRICS:
+            totals[name] += metrics[name] / len(scenarios)
+    totals["score"] = score(totals, weights)
+    return configs, totals
+
+
+def tune(configs, scenarios=None, blocks=300 * 24 * 30, update_every=300, tolerance=0.002, weights=WEIGHTS,
+         workers=None, chunk_size=256, progress=None):
+    """
+    Rows {parameters, metrics, score} for every config, best first.
+    `progress(done, total, rate)` is called after each chunk.
+    """
+    scenarios = scenarios or default_scenarios()
+    chunks = [configs[k:k + chunk_size] for k in range(0, len(configs), chunk_size)]
+    rows, started = [], time.time()
+    with ProcessPoolExecutor(workers or os.cpu_count()) as pool:
+        futures = [pool.submit(_evaluate_chunk, chunk, scenarios, blocks, update_every, tolerance, weights)
+                   for chunk in chunks]
+        for future in as_completed(futures):
+            chunk, totals = future.result()
+            for k, config in enumerate(chunk):
+                rows.append(dict(config, **{name: float(totals[name][k]) for name in METRICS + ("score",)}))
+            if progress is not None:
+                progress(len(rows), len(configs), len(rows) / (time.time() - started))
+    rows.sort(key=lambda row: row["score"])
+    return rows
+
+
+def parameter_calls(config):
+    """
+    The calls that install `config`, as (function name, keyword arguments):
+    one `set_parameters` for the whole config.
+    """
+    parameters, mask = parameters_and_mask(**{name: config[name] for name in PARAMETERS})
+    return [("set_parameters", dict(parameters=parameters, mask=mask))]
+
+
+def format_call(name, kwargs):
+    return f"{name}({', '.join(f'{key}={value!r}' for key, value in kwargs.items())})"
+
+
+def format_table(rows, limit=20):
+    header = PARAMETERS + METRICS + ("score",)
+    lines = ["  ".join(f"{name:>26}" if name in PARAMETERS else f"{name:>9}" for name in header)]
+    for row in rows[:limit]:
+        lines.append("  ".join(f"{row[name]:>26}" if name in PARAMETERS else f"{row[name]:>9.4f}"
+                               for name in header))
+    return "\n".join(lines)
+
+
+def _print_progress(done, total, rate):
+    print(f"{done}/{total} configurations, {rate:.0f}/s")
+
+
+def _number(text):
+    """Exact int from "999997208243937652252849536" as well as "2.2e11"."""
+    try:
+        return int(text)
+    except ValueError:
+        return int(float(text))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    for name in PARAMETERS:
+        parser.add_argument(f"--{name.replace('_', '-')}", dest=name, nargs="+", type=_number,
+                            default=[DEFAULTS[name]])
+    parser.add_argument("--days", type=float, default=30, help="horizon of every scenario")
+    parser.add_argument("--update-every", type=int, default=300, help="blocks between updates")
+    parser.add_argument("--tolerance", type=float, default=0.002, help="settling band on |log(market/redemption)|")
+    parser.add_argument("--workers", type=int, default=None, help="default: one per CPU")
+    parser.add_argument("--top", type=int, default=20)
+    args = parser.parse_args(argv)
+
+    configs = grid(**{name: getattr(args, name) for name in PARAMETERS})
+    rows = tune(configs, blocks=int(args.days * 24 * 3600 / 12), update_every=args.update_every,
+                tolerance=args.tolerance, workers=args.workers, progress=_print_progress)
+    print(format_table(rows, args.top))
+    print("\nbest:")
+    for name, kwargs in parameter_calls(rows[0]):
+        print(f"  {format_call(name, kwargs)}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,402 @@
+"""
+Gas benchmark of PIController.vy, of its factory clones and, where solc 0.6.7
+is available, of the original Solidity controller.
+
+    ape run gas_benchmark                 # print every measurement
+    ape run gas_benchmark --save          # record them as the baseline
+    ape run gas_benchmark --check         # fail if any number regressed
+
+Each scenario deploys a fresh controller and records the gas used by `update`,
+`get_new_pi_output`, `get_new_error_integral` and the setters, keyed as
+`<implementation>/<scenario>/<entry point>`. Views are measured by sending them
+as transactions, so every number is the gas a keeper's transaction would use.
+
+orig/src/PIController.sol is benchmarked too when solc 0.6.7 is available; a
+missing solc skips it, any other failure of any implementation is raised.
+--check fails for any baseline measurement the run did not produce, so a
+scenario that is dropped or renamed, or a baseline with Solidity numbers
+checked without solc, does not pass unnoticed.
+
+The committed gas_baseline.json has no `solidity/*` rows, so it holds no
+Vyper-vs-Solidity comparison; `--save` with solc 0.6.7 installed adds them.
+"""
+import json
+import sys
+from pathlib import Path
+
+import click
+from ape import Project, accounts, chain, project
+from ape.cli import ConnectedProviderCommand
+from ape.contracts.base import ContractTransaction
+from ape_solidity.exceptions import SolcInstallError
+
+from picontroller.model import parameters_and_mask
+
+BASELINE = Path(__file__).parent / "gas_baseline.json"
+
+kp = int(2.25 * 10 ** 11)
+ki = int(7.2 * 10 ** 4)
+co_bias = 0
+per_second_integral_leak = 999997208243937652252849536
+output_upper_bound = 18640000000000000000
+output_lower_bound = -51034000000000000000
+update_delay = 3600
+
+error = -10 ** 25
+RAY = 10 ** 27
+
+rpower_exponents = [1, 12, update_delay, 86400, 365 * 86400, 2 ** 64 - 1]
+registry_size = 8
+
+
+class Vyper:
+    """contracts/PIController.vy, the entry points under their snake_case names."""
+
+    name = "vyper"
+
+    def __init__(self, owner):
+        self.owner = owner
+        self.contract = owner.deploy(project.PIController, b'test control variable',
+                                     kp, ki, co_bias, per_second_integral_leak,
+                                     output_upper_bound, output_lower_bound, [0] * 3,
+                                     sender=owner)
+        self.set_updater()
+
+    def deploy_gas(self):
+        return self.contract.creation_metadata.receipt.gas_used
+
+    def set_updater(self):
+        return self.contract.modify_parameters_addr("updater", self.owner, sender=self.owner)
+
+    def set_int(self, parameter, val):
+        return self.contract.modify_parameters_int(parameter, val, sender=self.owner)
+
+    def set_uint(self, parameter, val):
+        return self.contract.modify_parameters_uint(parameter, val, sender=self.owner)
+
+    def update(self, err):
+        return self.contract.update(err, sender=self.owner)
+
+    def get_new_pi_output(self, err):
+        return self.contract.get_new_pi_output.transact(err, sender=self.owner)
+
+    def get_new_error_integral(self, err):
+        return self.contract.get_new_error_integral.transact(err, sender=self.owner)
+
+    def rpower(self, x, n, base):
+        return self.contract.rpower.transact(x, n, base, sender=self.owner)
+
+    def last_update_time(self):
+        return self.contract.last_update_time()
+
+
+class VyperClone(Vyper):
+    """PIController.vy as an EIP-1167 clone created by contracts/PIControllerFactory.vy."""
+
+    name = "vyper-clone"
+
+    def __init__(self, owner):
+        self.owner = owner
+        implementation = owner.deploy(project.PIController, b'implementation',
+                                      kp, ki, co_bias, per_second_integral_leak,
+                                      output_upper_bound, output_lower_bound, [0] * 3,
+                                      sender=owner)
+        factory = owner.deploy(project.PIControllerFactory, implementation, sender=owner)
+        self.receipt = factory.create_controller(b'test control variable', kp, ki, co_bias,
+                                                 per_second_integral_leak, output_upper_bound,
+                                                 output_lower_bound, [0] * 3, sender=owner)
+        (event,) = self.receipt.decode_logs(factory.ControllerCreated)
+        self.contract = project.PIController.at(event.controller)
+        self.set_updater()
+
+    def deploy_gas(self):
+        return self.receipt.gas_used
+
+
+class Solidity(Vyper):
+    """orig/src/PIController.sol, translated to the Vyper names."""
+
+    name = "solidity"
+
+    # Vyper parameter names to their camelCase originals
+    parameters = {
+        "kp": "kp",
+        "ki": "ki",
+        "co_bias": "coBias",
+        "output_upper_bound": "outputUpperBound",
+        "output_lower_bound": "outputLowerBound",
+        "error_integral": "errorIntegral",
+        "per_second_integral_leak": "perSecondIntegralLeak",
+    }
+
+    def __init__(self, owner):
+        orig = Project(Path(__file__).parent.parent / "orig")
+        self.owner = owner
+        self.contract = owner.deploy(orig.PIController, b'test control variable',
+                                     kp, ki, co_bias, per_second_integral_leak,
+                                     output_upper_bound, output_lower_bound, [0] * 3,
+                                     sender=owner)
+        self.set_updater()
+
+    def _modify_parameters(self, value_type, parameter, val):
+        # ape picks among same-arity overloads by position, so select the ABI explicitly
+        abi = next(abi for abi in self.contract.contract_type.mutable_methods
+                   if abi.name == "modifyParameters" and abi.inputs[1].type == value_type)
+        return ContractTransaction(abi, self.contract.address)(parameter, val, sender=self.owner)
+
+    def set_updater(self):
+        return self._modify_parameters("address", "seedProposer", self.owner)
+
+    def set_int(self, parameter, val):
+        return self._modify_parameters("int256", self.parameters[parameter], val)
+
+    def set_uint(self, parameter, val):
+        return self._modify_parameters("uint256", self.parameters[parameter], val)
+
+    def get_new_pi_output(self, err):
+        return self.contract.getNextPiOutput.transact(err, sender=self.owner)
+
+    def get_new_error_integral(self, err):
+        return self.contract.getNextErrorIntegral.transact(err, sender=self.owner)
+
+    def last_update_time(self):
+        return self.contract.lastUpdateTime()
+
+
+def measure_updates(impl, errors, delay=update_delay):
+    """
+    Apply `errors` `delay` seconds apart, measuring the last update, then each
+    view `delay` seconds after it.
+    """
+    for err in errors[:-1]:
+        impl.update(err)
+        chain.pending_timestamp = impl.last_update_time() + delay
+    report = {"update": impl.update(errors[-1]).gas_used}
+    for view in (impl.get_new_pi_output, impl.get_new_error_integral):
+        # Each view runs at the same timestamp, on the same state
+        snapshot = chain.snapshot()
+        chain.pending_timestamp = impl.last_update_time() + delay
+        report[view.__name__] = view(errors[-1]).gas_used
+        chain.restore(snapshot)
+    return report
+
+
+def first_update(impl):
+    return {"update": impl.update(error).gas_used}
+
+
+def steady_state(impl):
+    return measure_updates(impl, [error, error, error // 2])
+
+
+def saturated_upper(impl):
+    # A bias above the upper bound pins the output there with no integral to clamp
+    impl.set_int("co_bias", 2 * output_upper_bound)
+    return measure_updates(impl, [0, 0])
+
+
+def saturated_lower(impl):
+    impl.set_int("co_bias", 2 * output_lower_bound)
+    return measure_updates(impl, [0, 0])
+
+
+def deadband(impl):
+    # Saturated updates within the output deadband write only the integral, the error and the time
+    if isinstance(impl, Solidity):
+        return {}
+    impl.set_uint("output_deadband", 10 ** 18)
+    impl.set_int("co_bias", 2 * output_upper_bound)
+    return measure_updates(impl, [0, 0])
+
+
+def clamping(impl):
+    # A persistent negative error keeps the output at the lower bound while the
+    # integral keeps growing, so every update undoes its new area
+    impl.set_uint("per_second_integral_leak", RAY)
+    return measure_updates(impl, [-10 ** 27] * 3)
+
+
+def idle_day(impl):
+    return measure_updates(impl, [error, error, error // 2], delay=86400)
+
+
+def idle_year(impl):
+    return measure_updates(impl, [error, error, error // 2], delay=365 * 86400)
+
+
+def modify_parameters(impl):
+    return {
+        "modify_parameters_addr(updater)": impl.set_updater().gas_used,
+        "modify_parameters_int(kp)": impl.set_int("kp", kp + 1).gas_used,
+        "modify_parameters_int(ki)": impl.set_int("ki", ki + 1).gas_used,
+        "modify_parameters_int(co_bias)": impl.set_int("co_bias", 1).gas_used,
+        "modify_parameters_int(output_upper_bound)": impl.set_int("output_upper_bound",
+                                                                  output_upper_bound + 1).gas_used,
+        "modify_parameters_int(output_lower_bound)": impl.set_int("output_lower_bound",
+                                                                  output_lower_bound - 1).gas_used,
+        "modify_parameters_int(error_integral)": impl.set_int("error_integral", 1).gas_used,
+        "modify_parameters_uint(per_second_integral_leak)": impl.set_uint("per_second_integral_leak",
+                                                                          RAY - 1).gas_used,
+    }
+
+
+def cached_leak(impl):
+    # Only PIController.vy caches the leak factor for a fixed cadence
+    if isinstance(impl, Solidity):
+        return {}
+    report = {"modify_parameters_uint(leak_cadence)": impl.set_uint("leak_cadence", update_delay).gas_used}
+    return {**report, **measure_updates(impl, [error, error, error // 2])}
+
+
+def observations(impl):
+    # An update once the ring of observations has gone round twice, so it overwrites a
+    # slot, and the windowed averages over the ring
+    if isinstance(impl, Solidity):
+        return {}
+    report = {"modify_parameters_uint(observation_cardinality)":
+              impl.set_uint("observation_cardinality", 64).gas_used}
+    report.update(measure_updates(impl, [error] * 128 + [error // 2]))
+    contract = impl.contract
+    report["average_over_updates(1)"] = contract.average_over_updates.transact(1, sender=impl.owner).gas_used
+    report["average_over_updates(63)"] = contract.average_over_updates.transact(63, sender=impl.owner).gas_used
+    for seconds in (update_delay, 24 * update_delay):
+        report[f"average_over({seconds})"] = contract.average_over.transact(seconds, sender=impl.owner).gas_used
+    return report
+
+
+def rpower(impl):
+    return {f"rpower(n={n})": impl.rpower(per_second_integral_leak, n, RAY).gas_used
+            for n in rpower_exponents}
+
+
+def set_parameters(impl):
+    # A full retune in one set_parameters() call, and back with one setter call per parameter
+    if isinstance(impl, Solidity):
+        return {}
+    retune = dict(kp=kp + 1, ki=ki + 1, co_bias=1, output_upper_bound=output_upper_bound + 1,
+                  output_lower_bound=output_lower_bound - 1, per_second_integral_leak=RAY - 1)
+    report = {
+        "set_parameters(kp)": impl.contract.set_parameters(*parameters_and_mask(kp=kp + 2),
+                                                           sender=impl.owner).gas_used,
+        "set_parameters(retune)": impl.contract.set_parameters(*parameters_and_mask(**retune),
+                                                               sender=impl.owner).gas_used,
+    }
+    receipts = [impl.set_int(name, val) for name, val in
+                [("kp", kp), ("ki", ki), ("co_bias", co_bias), ("output_upper_bound", output_upper_bound),
+                 ("output_lower_bound", output_lower_bound)]]
+    receipts.append(impl.set_uint("per_second_integral_leak", per_second_integral_leak))
+    report["modify_parameters_* x6"] = sum(receipt.gas_used for receipt in receipts)
+    return report
+
+
+def what_if(impl):
+    # One get_new_pi_outputs() call over a grid of errors and future times
+    if isinstance(impl, Solidity):
+        return {}
+    for err in (error, error):
+        impl.update(err)
+        chain.pending_timestamp = impl.last_update_time() + update_delay
+    last = impl.last_update_time()
+    queries = [(err, last + delay) for err in (error, error // 2, 0, -error)
+               for delay in (1, update_delay, 86400, 7 * 86400)] * 4
+    gas = impl.contract.get_new_pi_outputs.transact(queries, sender=impl.owner).gas_used
+    return {f"get_new_pi_outputs({len(queries)})": gas}
+
+
+def registry(impl):
+    # Steady-state updates of registry_size controllers held by one
+    # PIControllerRegistry, in one update_many() or one update() each
+    if impl.name != "vyper":
+        return {}
+    owner = impl.owner
+    contract = owner.deploy(project.PIControllerRegistry, sender=owner)
+    ids = [b'rate-%d' % k for k in range(registry_size)]
+    for id in ids:
+        contract.add_controller(id, kp, ki, co_bias, per_second_integral_leak,
+                                output_upper_bound, output_lower_bound, [0] * 3, sender=owner)
+        contract.modify_parameters_addr(id, "updater", owner, sender=owner)
+    for err in (error, error):
+        contract.update_many(ids, [err] * registry_size, sender=owner)
+        chain.pending_timestamp = contract.last_update_time(ids[0]) + update_delay
+    report = {f"update_many({registry_size})": contract.update_many(ids, [error // 2] * registry_size,
+                                                                    sender=owner).gas_used}
+    chain.pending_timestamp = contract.last_update_time(ids[0]) + update_delay
+    report[f"update x{registry_size}"] = sum(contract.update(id, error, sender=owner).gas_used for id in ids)
+    return report
+
+
+SCENARIOS = [first_update, steady_state, saturated_upper, saturated_lower, deadband, clamping,
+             idle_day, idle_year, modify_parameters, set_parameters, cached_leak, observations, what_if, rpower,
+             registry]
+
+
+def solc_missing(err):
+    """Whether `err`, or an error it was raised from, is ape-solidity finding no solc to compile with."""
+    while err is not None:
+        if isinstance(err, SolcInstallError):
+            return True
+        err = err.__cause__ or err.__context__
+    return False
+
+
+def run_benchmarks(owner):
+    results = {}
+    for implementation in (Vyper, VyperClone, Solidity):
+        try:
+            impl = implementation(owner)
+        except Exception as err:
+            # ape wraps compiler errors when it compiles a contract on first access
+            if implementation is not Solidity or not solc_missing(err):
+                raise
+            print(f"{implementation.name}: no solc 0.6.7, skipping it: {err}")
+            continue
+        results[f"{impl.name}/deploy"] = impl.deploy_gas()
+        for scenario in SCENARIOS:
+            for entry, gas in scenario(implementation(owner)).items():
+                results[f"{impl.name}/{scenario.__name__}/{entry}"] = gas
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Print every measurement against the baseline; return the keys that
+    regressed or that the baseline has and the results lack.
+    """
+    regressions = [key for key in baseline if key not in results]
+    for key in regressions:
+        print(f"{key:<72}{'':>10}  MISSING")
+    for key, gas in results.items():
+        base = baseline.get(key)
+        if base is None:
+            print(f"{key:<72}{gas:>10}  (new)")
+            continue
+        change = (gas - base) / base if base else 0
+        flag = ""
+        if change > threshold:
+            regressions.append(key)
+            flag = "  REGRESSION"
+        print(f"{key:<72}{gas:>10}{change:>+9.2%}{flag}")
+    return regressions
+
+
+@click.command(cls=ConnectedProviderCommand)
+@click.option("--save", is_flag=True, help=f"Write the results to {BASELINE.name}.")
+@click.option("--check", is_flag=True, help="Exit non-zero if anything regressed past the threshold.")
+@click.option("--threshold", default=0.01, show_default=True,
+              help="Allowed relative increase over the baseline.")
+@click.option("--baseline", "baseline_path", type=click.Path(path_type=Path), default=BASELINE,
+              show_default=True)
+def cli(save, check, threshold, baseline_path):
+    results = run_benchmarks(accounts.test_accounts[0])
+
+    baseline = json.loads(baseline_path.read_text()) if baseline_path.exists() else {}
+    regressions = compare(results, baseline, threshold)
+
+    if save:
+        baseline_path.write_text(json.dumps(results, indent=2) + "\n")
+        print(f"baseline written to {baseline_path}")
+    if check and regressions:
+        print(f"{len(regressions)} measurement(s) missing or regressed by more than {threshold:.0%}:")
+        for key in regressions:
+            print(f"  {key}: {baseline[key]} -> {results.get(key, 'missing')}")
+        sys.exit(1)
@@ -0,0 +1,48 @@
+import pytest
+
+kp = 222002205862
+ki = int(10 ** 18)
+co_bias = 0
+per_second_integral_leak = 999997208243937652252849536 # 1% per hour
+output_upper_bound = 18640000000000000000
+output_lower_bound = -51034000000000000000
+
+# The controller is deployed once per session. ape snapshots the chain before
+# each test and reverts it afterwards, so every test still starts from the
+# freshly deployed state.
+
+@pytest.fixture(scope="session")
+def owner(accounts):
+    return accounts[0]
+
+@pytest.fixture(scope="session")
+def controller(owner, project):
+    controller = owner.deploy(project.PIController, b'test control variable',
+            kp,
+            ki,
+            co_bias,
+            per_second_integral_leak,
+            output_upper_bound,
+            output_lower_bound,
+            [0] * 3,
+            sender=owner)
+
+    controller.modify_parameters_addr('updater',  owner, sender=owner)
+    return controller
+
+@pytest.fixture(scope="session")
+def warp(chain):
+    """
+    Move block.timestamp forward by `seconds` without mining the blocks in
+    between. The next transaction lands at the new time; pass mine=True to
+    also seal an empty block there so views see it.
+    """
+    def warp(seconds, mine=False):
+        timestamp = chain.pending_timestamp + seconds
+        if mine:
+            chain.mine(timestamp=timestamp)
+        else:
+            chain.pending_timestamp = timestamp
+        return timestamp
+
+    return warp
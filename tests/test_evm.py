@@ -0,0 +1,117 @@
+import random
+
+import pytest
+
+from picontroller.evm import Method, PIControllerEVM, encode_call
+from picontroller.model import PIControllerModel, Revert, parameters_and_mask
+
+params = dict(kp=222002205862, ki=10**18, co_bias=0, per_second_integral_leak=999997208243937652252849536,
+              output_upper_bound=18640000000000000000, output_lower_bound=-51034000000000000000)
+
+@pytest.fixture(scope="module")
+def deployed():
+    controller = PIControllerEVM(**params)
+    return controller, controller.snapshot()
+
+@pytest.fixture
+def controller(deployed):
+    controller, root = deployed
+    controller.revert(root)
+    return controller
+
+def test_matches_model(controller):
+    rng = random.Random(5)
+    model = PIControllerModel(**params)
+    timestamp = 1_700_000_000
+    for _ in range(60):
+        timestamp += rng.choice([0, 1, 12, 3600, 86400])
+        error = rng.randint(-10**26, 10**26)
+        assert controller.get_new_pi_output(error, timestamp) == model.get_new_pi_output(error, timestamp)
+        try:
+            expected = model.update(error, timestamp)
+        except Revert as revert:
+            with pytest.raises(Revert, match=revert.reason):
+                controller.update(error, timestamp)
+        else:
+            assert controller.update(error, timestamp) == expected
+        assert controller.last_update() == model.last_update()
+        assert controller.call("error_integral") == model.error_integral
+
+def test_deadband_keeps_the_stored_outputs(controller):
+    # A saturated output held by the deadband returns the p and i outputs computed
+    # for the new error, while storage keeps the ones from before
+    model = PIControllerModel(**params)
+    controller.call("modify_parameters_uint", "output_deadband", 10**18)
+    model.modify_parameters_uint("output_deadband", 10**18)
+    timestamp = 1_700_000_000
+    for error in (10**25, 10**25):
+        timestamp += 3600
+        assert controller.update(error, timestamp) == model.update(error, timestamp)
+    stored = controller.last_update()[1:]
+    timestamp += 3600
+    assert not controller.call("should_update", 10**24, timestamp)
+    outputs = controller.update(10**24, timestamp)
+    assert outputs == model.update(10**24, timestamp)
+    assert outputs[0] == stored[0] and outputs[1:] != stored[1:]
+    assert controller.last_update()[1:] == stored
+
+@pytest.mark.parametrize("gains", [(params["kp"], params["ki"], 0), (2**200, 3, -5), (-7, 2**180, 2**252),
+                                   (1, 1, 2**253), (-2**255, 1, 0), (2**254, -2**189, -2**252)])
+def test_update_matches_model_at_extreme_gains(controller, gains):
+    # Errors and integrals from small to the int256 limits, so update() both succeeds
+    # and overflows, and reverts exactly where the model does
+    rng = random.Random(str(gains))
+    model = PIControllerModel(**params)
+    for name, value in zip(("kp", "ki", "co_bias"), gains):
+        controller.call("modify_parameters_int", name, value)
+        model.modify_parameters_int(name, value)
+
+    edges = [0, 1, -1, 2**64, -2**64, 2**130 - 1, -2**130, 2**165, -2**190, 2**255 - 1, -2**255]
+    timestamp = 1_700_000_000
+    for _ in range(60):
+        if rng.random() < 0.2:
+            value = rng.choice(edges)
+            controller.call("modify_parameters_int", "error_integral", value)
+            model.modify_parameters_int("error_integral", value)
+        timestamp += rng.choice([1, 12, 3600, 10**9])
+        error = rng.choice(edges) if rng.random() < 0.5 else rng.randint(-2**130, 2**130 - 1)
+        try:
+            expected = model.update(error, timestamp)
+        except Revert:
+            with pytest.raises(Revert):
+                controller.update(error, timestamp)
+        else:
+            assert controller.update(error, timestamp) == expected
+        assert controller.last_update() == model.last_update()
+        assert controller.call("error_integral") == model.error_integral
+
+def test_struct_arguments_and_results(controller):
+    controller.call("set_parameters", *parameters_and_mask(kp=7, output_lower_bound=-10**18))
+    state = controller.call("get_state")
+    assert (state[1], state[5]) == (7, -10**18)
+    with pytest.raises(Revert, match="PIController/invalid-bounds"):
+        controller.call("set_parameters", *parameters_and_mask(output_lower_bound=10**30))
+
+def test_snapshot_and_revert(controller):
+    root = controller.snapshot()
+    controller.update(10**25, 1_700_000_000)
+    assert controller.call("last_error") == 10**25
+    controller.revert(root)
+    assert controller.call("last_error") == 0
+
+def test_negative_imported_state():
+    controller = PIControllerEVM(**params, imported_state=(1_600_000_000, -10**20, -10**25))
+    assert controller.call("last_error") == -10**20
+    assert controller.call("error_integral") == -10**25
+    assert controller.last_update()[0] == 1_600_000_000
+
+    model = PIControllerModel(**params, imported_state=(1_600_000_000, -10**20, -10**25))
+    assert controller.update(10**24, 1_700_000_000) == model.update(10**24, 1_700_000_000)
+
+def test_method_encoding():
+    method = Method(dict(name="get_raw_pi_output", inputs=[dict(type="int256")] * 2,
+                         outputs=[dict(type="int256")] * 3))
+    assert method.encode(-5, 2**255 - 1) == encode_call("get_raw_pi_output(int256,int256)", -5, 2**255 - 1)
+    with pytest.raises(ValueError):
+        method.encode(2**255, 0)
+    assert method.decode(b"\xff" * 32 + (1).to_bytes(32, "big") * 2) == (-1, 1, 1)
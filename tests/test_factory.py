@@ -0,0 +1,57 @@
+import ape
+import pytest
+
+from picontroller.model import PIControllerModel
+
+kp = 222002205862
+ki = int(10 ** 18)
+co_bias = 0
+per_second_integral_leak = 999997208243937652252849536
+output_upper_bound = 18640000000000000000
+output_lower_bound = -51034000000000000000
+
+args = (kp, ki, co_bias, per_second_integral_leak, output_upper_bound, output_lower_bound)
+
+@pytest.fixture(scope="module")
+def factory(owner, project, controller):
+    return owner.deploy(project.PIControllerFactory, controller.address, sender=owner)
+
+def create(factory, project, sender, control_variable, imported_state=(0, 0, 0), params=args):
+    receipt = factory.create_controller(control_variable, *params, list(imported_state), sender=sender)
+    (event,) = receipt.decode_logs(factory.ControllerCreated)
+    return project.PIController.at(event.controller)
+
+def test_clone_matches_model(owner, factory, project, chain):
+    clone = create(factory, project, owner, b'clone')
+    clone.modify_parameters_addr('updater', owner, sender=owner)
+    assert len(chain.provider.web3.eth.get_code(clone.address)) == 45
+    assert clone.control_variable().rstrip(b'\0') == b'clone'
+    assert clone.authorities(owner) == 1 and clone.authorities(factory) == 0
+
+    model = PIControllerModel(*args)
+    for error in [10**25, -10**24, 3 * 10**26]:
+        chain.pending_timestamp += 3600
+        clone.update(error, sender=owner)
+        model.update(error, clone.last_update_time())
+        assert clone.last_update() == model.last_update()
+        assert (clone.error_integral(), clone.last_error()) == (model.error_integral, model.last_error)
+
+def test_clones_are_independent(owner, factory, project, chain, accounts):
+    first = create(factory, project, owner, b'first')
+    imported_state = (chain.blocks.head.timestamp - 10, 7, 11)
+    second = create(factory, project, accounts[1], b'second', imported_state=imported_state)
+    assert (second.last_update_time(), second.last_error(), second.error_integral()) == imported_state
+    assert first.error_integral() == 0 and first.last_update_time() == 0
+    assert second.authorities(accounts[1]) == 1 and second.authorities(owner) == 0
+
+def test_fail_initialize_twice(owner, controller, factory, project):
+    clone = create(factory, project, owner, b'clone')
+    with ape.reverts("PIController/already-initialized"):
+        clone.initialize(b'again', *args, [0] * 3, owner, sender=owner)
+    # The implementation itself was initialized by its constructor
+    with ape.reverts("PIController/already-initialized"):
+        controller.initialize(b'again', *args, [0] * 3, owner, sender=owner)
+
+def test_fail_create_invalid(owner, factory, project):
+    with ape.reverts("PIController/invalid-bounds"):
+        create(factory, project, owner, b'bad', params=args[:4] + (output_lower_bound, output_upper_bound))
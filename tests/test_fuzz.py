@@ -0,0 +1,55 @@
+import pytest
+
+from picontroller.evm import compile_vyper
+from picontroller.fuzz import REVERTED, TARGETS, Harness, load_initcodes, minimize
+
+def solc_available():
+    try:
+        import solcx
+        return any(str(version) == "0.6.7" for version in solcx.get_installed_solc_versions())
+    except Exception:
+        return False
+
+@pytest.fixture(scope="module")
+def harness():
+    return Harness(compile_vyper()[0])
+
+@pytest.fixture(scope="module")
+def solidity_harness():
+    return Harness(*load_initcodes())
+
+@pytest.mark.parametrize("target", list(TARGETS))
+def test_vyper_agrees_with_model(harness, target):
+    count, reports = harness.run_shard(target, seed=1, count=25)
+    assert count == 25
+    assert reports == []
+
+@pytest.mark.skipif(not solc_available(),
+                    reason="needs solc 0.6.7 for py-solc-x; the Vyper-vs-Solidity lane is untested without it")
+@pytest.mark.parametrize("target", list(TARGETS))
+def test_vyper_agrees_with_solidity(solidity_harness, target):
+    assert [lane.name for lane in solidity_harness.contract_lanes] == ["vyper", "solidity"]
+    count, reports = solidity_harness.run_shard(target, seed=1, count=25)
+    assert count == 25
+    assert reports == []
+
+def test_rpower_zero_base_overflow(harness):
+    # Found by the fuzzer: the model skipped the overflow check when base was 0
+    results = harness.run_case("rpower", dict(x=2**129, n=2, base=0))
+    assert results == {"vyper": REVERTED, "model": REVERTED}
+
+def test_update_results_per_step(harness):
+    case = dict(params=dict(kp=10**18, ki=10**18, co_bias=0, per_second_integral_leak=10**27,
+                            output_upper_bound=10**20, output_lower_bound=-10**20, error_integral=0),
+                steps=[(0, 5), (0, 5), (10, 7)])
+    results = harness.run_case("update", case)
+    assert results["vyper"] == results["model"]
+    steps, state = results["model"]
+    # The second update lands on the first one's timestamp
+    assert steps == [(5, 5, 0), REVERTED, (7 + 60, 7, 60)]
+    assert state == (60, 7)
+
+def test_minimize():
+    case = dict(x=123456789, steps=[(3, -10**30), (4, 2**70), (5, 6)])
+    diverges = lambda c: c["x"] > 1000 and any(error > 2**40 for _, error in c["steps"])
+    assert minimize(case, diverges) == dict(x=1001, steps=[(0, 2**40 + 1)])
@@ -0,0 +1,45 @@
+from picontroller.evm import PIControllerEVM
+from picontroller.gas_profile import GasProfile, SourceMap, main, profile_updates, trace_call
+
+params = dict(kp=222002205862, ki=10**18, co_bias=0, per_second_integral_leak=999997208243937652252849536,
+              output_upper_bound=18640000000000000000, output_lower_bound=-51034000000000000000)
+
+def test_profile_accounts_for_every_opcode():
+    profile, result = profile_updates([-10**25, -10**25, -5 * 10**24])
+    assert profile.total == result.gas_used
+    assert sum(int(line.rsplit(" ", 1)[1]) for line in profile.folded().splitlines()) == result.gas_used
+    assert sum(profile.line_gas.values()) == result.gas_used
+
+    functions = profile.functions()
+    assert functions["PIController"][1] == result.gas_used
+    for name in ("update", "pi_math._get_new_error_integral", "pi_math._rpower", "pi_math._bound_pi_output",
+                 "pi_math.clamp_error_integral", "SSTORE", "SLOAD", "LOG1"):
+        assert functions[name][1] > 0
+    # The leak is computed under the integral, and storage writes stay on their lines
+    assert "PIController;update;pi_math._get_new_error_integral;pi_math._accumulated_leak;pi_math._rpower" \
+        in profile.folded()
+    source = profile.source_map.sources["PIController.vy"]
+    line = next(k for k, text in enumerate(source, 1) if text.strip() == "self.last_error = error")
+    assert profile.line_gas["PIController.vy", line] >= 2900
+
+def test_traced_call_matches_untraced():
+    controller = PIControllerEVM(**params)
+    controller.update(10**24, 1_700_000_000)
+    root = controller.snapshot()
+    data = controller.methods["update"].encode(-10**24)
+    controller.evm.timestamp += 3600
+    plain = controller.evm.call(controller.address, data)
+    controller.revert(root)
+    traced, frames = trace_call(controller.evm, controller.address, data)
+    assert traced == plain
+    assert frames[0].depth == 1 and frames[-1].op == "RETURN"
+    assert sum(frame.gas_cost for frame in frames) == plain.gas_used
+
+    profile = GasProfile(SourceMap()).add(frames).add(frames)
+    assert profile.total == 2 * plain.gas_used
+
+def test_main_writes_folded_stacks(tmp_path, capsys):
+    assert main(["--errors", "10000000000000000000000000", "--folded", str(tmp_path / "update.folded")]) == 0
+    out = capsys.readouterr().out
+    assert "PIController.vy:" in out and "pi_math._bound_pi_output" in out
+    assert (tmp_path / "update.folded").read_text().startswith("PIController")
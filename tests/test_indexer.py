@@ -0,0 +1,57 @@
+import random
+from dataclasses import replace
+
+from picontroller.indexer import ControllerIndexer
+from picontroller.model import parameters_and_mask
+from picontroller.snapshot import read_snapshot
+
+def history(owner, controller, chain, steps):
+    """Random updates and setter calls; (timestamp, state) after each."""
+    rng = random.Random(13)
+    states = []
+    for k in range(steps):
+        chain.pending_timestamp += rng.choice([1, 12, 3600])
+        if k % 5 == 4:
+            controller.modify_parameters_int("kp", rng.randint(1, 10**12), sender=owner)
+        elif k % 6 == 3:
+            controller.set_parameters(*parameters_and_mask(ki=rng.randint(1, 10**18), co_bias=k), sender=owner)
+        elif k % 7 == 6:
+            controller.modify_parameters_uint("leak_cadence", 3600, sender=owner)
+        else:
+            controller.update(rng.randint(-10**25, 10**25), sender=owner)
+        states.append((chain.blocks.head.timestamp, replace(read_snapshot(controller), elapsed=0)))
+    return states
+
+def test_rebuilds_history(owner, controller, chain, accounts):
+    # Some of the updates fall within the deadband and log DeadbandUpdateEvent instead
+    controller.modify_parameters_uint("output_deadband", 2 * 10**18, sender=owner)
+    start = chain.blocks.head.number
+    # Not part of the snapshot, so it changes nothing the indexer follows
+    controller.modify_parameters_uint("observation_cardinality", 16, sender=owner)
+    states = history(owner, controller, chain, 20)
+    controller.modify_parameters_addr("updater", accounts[2], sender=owner)
+    assert list(controller.DeadbandUpdateEvent.range(start, chain.blocks.head.number + 1))
+
+    indexer = ControllerIndexer(chain.provider.web3, controller.address, start, chunk_size=4)
+    assert indexer.backfill() == 22
+    for timestamp, state in states:
+        assert indexer.state_at(timestamp) == state
+    # Before the first step: the freshly deployed state read at the start block
+    initial = indexer.state_at(states[0][0] - 1)
+    assert (initial.last_update_time, initial.error_integral, initial.kp) == (0, 0, 222002205862)
+    assert indexer.states[-1].updater == accounts[2].address
+    assert indexer.state_at_block(start - 1) is None
+
+def test_resume_from_saved_checkpoints(owner, controller, chain, tmp_path):
+    start = chain.blocks.head.number
+    states = history(owner, controller, chain, 6)
+    indexer = ControllerIndexer(chain.provider.web3, controller.address, start)
+    indexer.backfill()
+    indexer.save(tmp_path / "checkpoints.jsonl")
+
+    states += history(owner, controller, chain, 6)
+    indexer = ControllerIndexer.load(chain.provider.web3, tmp_path / "checkpoints.jsonl")
+    assert indexer.backfill() == 6
+    assert len(indexer) == 13
+    for timestamp, state in states:
+        assert indexer.state_at(timestamp) == state
@@ -0,0 +1,132 @@
+import asyncio
+
+import pytest
+from eth_abi import decode, encode
+from eth_account import Account
+from eth_utils import keccak
+from web3 import AsyncWeb3
+from web3.providers.eth_tester import AsyncEthereumTesterProvider
+
+from picontroller.evm import compile_vyper, encode_call
+from picontroller.fuzz import CONSTRUCTOR_TYPES
+from picontroller.keeper import LATENCY_WINDOW, ErrorSource, Keeper, Metrics, MockRelayerSource, update_output
+from picontroller.model import RAY
+
+# eth-tester funds the account of private key 1
+account = Account.from_key((1).to_bytes(32, "big"))
+
+kp = 222002205862
+ki = 10**18
+
+async def transact(w3, tx):
+    tx = dict(tx, nonce=await w3.eth.get_transaction_count(account.address), gas=5_000_000,
+              gasPrice=await w3.eth.gas_price, chainId=await w3.eth.chain_id, value=0)
+    tx_hash = await w3.eth.send_raw_transaction(account.sign_transaction(tx).raw_transaction)
+    return await w3.eth.wait_for_transaction_receipt(tx_hash)
+
+async def deploy(w3, initcode, updater):
+    args = encode(CONSTRUCTOR_TYPES, [b'keeper', kp, ki, 0, RAY, 18640000000000000000, -51034000000000000000,
+                                      [0, 0, 0]])
+    address = (await transact(w3, dict(data=initcode + args)))["contractAddress"]
+    await transact(w3, dict(to=address, data=encode_call("modify_parameters_addr(string,address)",
+                                                         "updater", updater)))
+    return address
+
+async def view(w3, address, signature, types):
+    return decode(types, await w3.eth.call(dict(to=address, data=encode_call(signature))))
+
+def test_keeper_drives_controllers():
+    async def main():
+        w3 = AsyncWeb3(AsyncEthereumTesterProvider())
+        initcode = compile_vyper()[0]
+        controllers = [await deploy(w3, initcode, account.address) for _ in range(3)]
+        # Updater is someone else, so its updates revert
+        stranger = await deploy(w3, initcode, "0x" + "22" * 20)
+
+        source = MockRelayerSource(lambda controller, timestamp: 101 * 10**16)
+        keeper = Keeper(w3, account, controllers + [stranger], source, poll_latency=0.01)
+        tester = w3.provider.ethereum_tester
+        for _ in range(3):
+            await keeper.tick()
+            await keeper.drain()
+            tester.time_travel((await w3.eth.get_block("latest"))["timestamp"] + 3600)
+
+        metrics = keeper.metrics.summary()
+        assert metrics["included"] == 9
+        assert metrics["failed"] == 3
+        assert metrics["mean_gas"] > 0 and metrics["latency_p95"] is not None
+
+        for controller in controllers:
+            (last_error,) = await view(w3, controller, "last_error()", ["int256"])
+            (update_time, output, _, _) = await view(w3, controller, "last_update()", ["uint256"] + ["int256"] * 3)
+            # Market above redemption: negative error and output, which lowers the redemption rate
+            assert last_error < 0 and output < 0
+            assert source.relayers[controller][1] == RAY + output
+            assert source.relayers[controller][0] < RAY
+
+        # The keeper's nonce stayed in step with the chain through the failures
+        assert keeper._nonce == await w3.eth.get_transaction_count(account.address)
+
+    asyncio.run(main())
+
+def test_failing_source_does_not_stop_the_keeper():
+    class Failing(MockRelayerSource):
+        async def on_update(self, controller, timestamp, output):
+            raise RuntimeError("relayer down")
+
+    async def main():
+        w3 = AsyncWeb3(AsyncEthereumTesterProvider())
+        controller = await deploy(w3, compile_vyper()[0], account.address)
+        keeper = Keeper(w3, account, [controller], Failing(lambda controller, timestamp: 10**18),
+                        poll_latency=0.01)
+        tester = w3.provider.ethereum_tester
+        for _ in range(2):
+            await keeper.tick()
+            await keeper.drain()
+            tester.time_travel((await w3.eth.get_block("latest"))["timestamp"] + 3600)
+
+        metrics = keeper.metrics.summary()
+        assert (metrics["submitted"], metrics["included"], metrics["failed"]) == (2, 0, 2)
+        # Both updates were mined all the same
+        (update_time, _, _, _) = await view(w3, controller, "last_update()", ["uint256"] + ["int256"] * 3)
+        assert update_time > 0
+
+    asyncio.run(main())
+
+def test_error_source_must_implement_error():
+    class Silent(ErrorSource):
+        async def on_update(self, controller, timestamp, output):
+            pass
+
+    with pytest.raises(TypeError):
+        Silent()
+
+def test_mock_relayer_rate_limits():
+    # MockPIRateSetterNew.getBoundedRedemptionRate: RAY - 1 at or below -RAY, 1 just above it
+    source = MockRelayerSource(lambda controller, timestamp: 10**18, noise_barrier=10)
+    for output, rate in [(-RAY - 5, RAY - 1), (-RAY, RAY - 1), (-RAY + 1, 1), (-RAY + 2, 2),
+                         (-11, RAY - 11), (-10, RAY), (0, RAY), (10, RAY), (11, RAY + 11)]:
+        asyncio.run(source.on_update("c", 0, output))
+        assert source.relayers["c"][1] == rate
+
+def test_update_output_reads_the_stored_output():
+    # Within the deadband the event carries the held output, not a freshly computed one
+    address = "0x" + "33" * 20
+    word = ((-5 % 2**128) << 128) | 1_700_000_000
+    log = dict(address=address, topics=[keccak(text="DeadbandUpdateEvent(int256,int256,uint256)")],
+               data=encode(["int256", "int256", "uint256"], [7, 8, word]))
+    assert update_output(dict(logs=[log]), AsyncWeb3.to_checksum_address(address)) == (-5, 1_700_000_000)
+    with pytest.raises(ValueError):
+        update_output(dict(logs=[]), address)
+
+def test_metrics_stay_bounded():
+    metrics = Metrics()
+    for k in range(LATENCY_WINDOW + 100):
+        metrics.included += 1
+        metrics.latencies.append(k)
+        metrics.gas_used += 50_000
+    summary = metrics.summary()
+    assert len(metrics.latencies) == LATENCY_WINDOW
+    # Percentiles cover the recent window, the mean gas every update
+    assert summary["latency_p50"] == 100 + LATENCY_WINDOW // 2
+    assert summary["mean_gas"] == 50_000
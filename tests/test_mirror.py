@@ -0,0 +1,49 @@
+import random
+from dataclasses import replace
+
+from picontroller.mirror import ControllerMirror
+from picontroller.snapshot import read_snapshot
+
+def receipt_of(chain, tx):
+    return chain.provider.web3.eth.get_transaction_receipt(tx.txn_hash)
+
+def test_mirror_matches_views(owner, controller, chain):
+    rng = random.Random(14)
+    mirror = ControllerMirror(chain.provider.web3, controller.address)
+    mirror.apply_receipt(receipt_of(chain, controller.modify_parameters_uint("leak_cadence", 3600, sender=owner)))
+    for k in range(12):
+        chain.pending_timestamp += rng.choice([1, 12, 3600])
+        if k % 4 == 3:
+            tx = controller.modify_parameters_int("ki", rng.randint(0, 10**18), sender=owner)
+        else:
+            tx = controller.update(rng.randint(-10**25, 10**25), sender=owner)
+        mirror.apply_receipt(receipt_of(chain, tx))
+
+        chain.pending_timestamp += rng.choice([1, 3600])
+        chain.mine()
+        timestamp = chain.blocks.head.timestamp
+        error = rng.randint(-10**25, 10**25)
+        assert mirror.get_new_pi_output(error, timestamp) == controller.get_new_pi_output(error)
+        assert mirror.get_new_error_integral(error, timestamp) == controller.get_new_error_integral(error)
+        assert mirror.bound_pi_output(10**30) == controller.bound_pi_output(10**30)
+        assert mirror.elapsed(timestamp) == controller.elapsed()
+    assert mirror.state == replace(read_snapshot(controller), elapsed=0)
+    assert not mirror.check_drift()
+
+def test_poll_and_drift(owner, controller, chain):
+    mirror = ControllerMirror(chain.provider.web3, controller.address, check_every=0)
+    controller.update(10**24, sender=owner)
+    controller.modify_parameters_int("kp", 10**12, sender=owner)
+    controller.update(-10**24, sender=owner)
+    mirror.poll()
+    mirror.poll()
+    assert mirror.state == replace(read_snapshot(controller), elapsed=0)
+
+    # A receipt the mirror never saw leaves it stale until the next check
+    controller.update(10**23, sender=owner)
+    tx = controller.modify_parameters_int("co_bias", 5, sender=owner)
+    mirror.apply_receipt(receipt_of(chain, tx))
+    assert mirror.state.co_bias == 5 and mirror.state.last_error == -10**24
+    assert mirror.check_drift()
+    assert mirror.drifts == 1
+    assert mirror.state.last_error == 10**23
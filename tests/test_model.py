@@ -0,0 +1,238 @@
+import random
+
+import ape
+import numpy as np
+import pytest
+
+from picontroller.batch import BatchPIController
+from picontroller.model import PARAMETER_BITS, PIControllerModel, Revert, parameters_and_mask
+from picontroller.snapshot import read_snapshot
+
+TWENTY_SEVEN_DECIMAL_NUMBER = int(10 ** 27)
+
+kp = 222002205862
+ki = int(10 ** 18)
+co_bias = 0
+per_second_integral_leak = 999997208243937652252849536
+output_upper_bound = 18640000000000000000
+output_lower_bound = -51034000000000000000
+
+params = dict(kp=kp, ki=ki, co_bias=co_bias, per_second_integral_leak=per_second_integral_leak,
+              output_upper_bound=output_upper_bound, output_lower_bound=output_lower_bound)
+
+def assert_matches(controller, model):
+    assert controller.error_integral() == model.error_integral
+    assert controller.last_error() == model.last_error
+    assert controller.last_update() == model.last_update()
+
+def test_conformance_random_updates(owner, controller, chain):
+    rng = random.Random(1)
+    model = PIControllerModel(**params)
+
+    for _ in range(40):
+        chain.pending_timestamp += rng.choice([0, 12, 3600, 86400])
+        error = rng.randint(-10**26, 10**26)
+        controller.update(error, sender=owner)
+        model.update(error, controller.last_update_time())
+        assert_matches(controller, model)
+
+def test_conformance_saturated(owner, controller, chain):
+    controller.modify_parameters_int("kp", int(2.25*10**11), sender=owner)
+    controller.modify_parameters_int("ki", int(7.2 * 10**4), sender=owner)
+    model = PIControllerModel(**dict(params, kp=int(2.25*10**11), ki=int(7.2 * 10**4)))
+
+    # Drive the output into both bounds so the integral clamping runs
+    for error in [-10**27 // 2] * 4 + [10**27 // 2] * 8 + [-10**25] * 4:
+        chain.pending_timestamp += 3600
+        controller.update(error, sender=owner)
+        model.update(error, controller.last_update_time())
+        assert_matches(controller, model)
+
+def test_conformance_deadband(owner, controller, chain):
+    rng = random.Random(5)
+    controller.modify_parameters_uint("output_deadband", 10**18, sender=owner)
+    model = PIControllerModel(**params)
+    model.modify_parameters_uint("output_deadband", 10**18)
+
+    # Small errors stay within the deadband, large ones and the bounds leave it
+    for _ in range(30):
+        chain.pending_timestamp += rng.choice([12, 3600])
+        error = rng.choice([rng.randint(-10**24, 10**24), rng.randint(-10**26, 10**26)])
+        timestamp = chain.pending_timestamp
+        assert controller.should_update(error, timestamp) == model.should_update(error, timestamp)
+        assert tuple(controller.fast_forward(error, timestamp)) == \
+            tuple(model.fast_forward(error, timestamp).__dict__.values())
+        controller.update(error, sender=owner)
+        model.update(error, timestamp)
+        assert_matches(controller, model)
+    assert not controller.should_update(0, controller.last_update_time())
+
+def test_conformance_observations(owner, controller, chain):
+    rng = random.Random(9)
+    model = PIControllerModel(**params)
+    controller.update(10**24, sender=owner)
+    model.update(10**24, controller.last_update_time())
+    controller.modify_parameters_uint("observation_cardinality", 8, sender=owner)
+    model.modify_parameters_uint("observation_cardinality", 8)
+
+    # Around the ring more than once, some updates within a deadband
+    controller.modify_parameters_uint("output_deadband", 10**18, sender=owner)
+    model.modify_parameters_uint("output_deadband", 10**18)
+    for k in range(20):
+        chain.pending_timestamp += rng.choice([12, 600, 3600])
+        error = rng.randint(-10**25, 10**25)
+        controller.update(error, sender=owner)
+        model.update(error, controller.last_update_time())
+        count = min(k + 2, 8)
+        for age in range(count):
+            assert controller.observation(age) == model.observation(age)
+        for updates in range(1, count):
+            assert controller.average_over_updates(updates) == model.average_over_updates(updates)
+
+        chain.mine(timestamp=controller.last_update_time() + 100)
+        now = chain.blocks.head.timestamp
+        oldest = model.observation(count - 1)[0]
+        for seconds in [1, 100, 101, 700, now - oldest, rng.randint(1, now - oldest)]:
+            assert controller.average_over(seconds) == model.average_over(seconds, now)
+        with ape.reverts("PIController/observation-too-old"):
+            controller.average_over(now - oldest + 1)
+        with pytest.raises(Revert):
+            model.average_over(now - oldest + 1, now)
+    with ape.reverts("PIController/observation-too-old"):
+        controller.observation(8)
+    with ape.reverts("PIController/observation-too-old"):
+        controller.average_over_updates(8)
+
+def test_conformance_views(owner, controller):
+    model = PIControllerModel(**params)
+    for error in [0, 1, -1, 10**25, -10**25, 10**40, -10**40]:
+        assert controller.get_raw_pi_output(error, error) == model.get_raw_pi_output(error, error)
+        assert controller.bound_pi_output(error) == model.bound_pi_output(error)
+
+def test_conformance_overflow_revert(owner, controller, chain):
+    controller.modify_parameters_int("kp", 2**200, sender=owner)
+    model = PIControllerModel(**dict(params, kp=2**200))
+
+    with ape.reverts():
+        controller.update(2**60, sender=owner)
+    with pytest.raises(Revert):
+        model.update(2**60, chain.pending_timestamp)
+
+    controller.update(2**50, sender=owner)
+    model.update(2**50, controller.last_update_time())
+    assert_matches(controller, model)
+
+def test_conformance_what_if(owner, controller, chain):
+    rng = random.Random(7)
+    model = PIControllerModel(**params)
+    for error in [10**25, -10**24]:
+        chain.pending_timestamp += 3600
+        controller.update(error, sender=owner)
+        model.update(error, controller.last_update_time())
+
+    last = controller.last_update_time()
+    queries = [(rng.randint(-10**26, 10**26), last + rng.choice([0, 1, 3600, 86400, 10**8])) for _ in range(50)]
+    outputs = controller.get_new_pi_outputs(queries)
+    assert [tuple(output) for output in outputs] == model.get_new_pi_outputs(queries)
+
+    with ape.reverts():
+        controller.get_new_pi_outputs([(0, last + 1), (0, last - 1)])
+    with pytest.raises(Revert):
+        model.get_new_pi_outputs([(0, last + 1), (0, last - 1)])
+
+def test_conformance_set_parameters(owner, controller):
+    rng = random.Random(3)
+    model = PIControllerModel(**params)
+    names = list(PARAMETER_BITS)
+    for _ in range(30):
+        values = {name: rng.choice([rng.randint(-10**20, 10**20), rng.randint(0, 10**27), 2**127])
+                  for name in rng.sample(names, rng.randint(1, len(names)))}
+        for name in ("per_second_integral_leak", "leak_cadence", "output_deadband"):
+            if name in values:
+                values[name] = abs(values[name])
+        parameters, mask = parameters_and_mask(**values)
+        try:
+            model.set_parameters(parameters, mask)
+        except Revert:
+            with ape.reverts():
+                controller.set_parameters(parameters, mask, sender=owner)
+        else:
+            controller.set_parameters(parameters, mask, sender=owner)
+        state = read_snapshot(controller)
+        assert (state.kp, state.ki, state.co_bias, state.output_upper_bound, state.output_lower_bound,
+                state.per_second_integral_leak, state.leak_cadence, state.error_integral,
+                state.output_deadband) == \
+            (model.kp, model.ki, model.co_bias, model.output_upper_bound, model.output_lower_bound,
+             model.per_second_integral_leak, model.leak_cadence, model.error_integral, model.output_deadband)
+
+def test_fast_forward_matches_update(owner, controller, chain):
+    model = PIControllerModel(**params)
+    controller.update(10**25, sender=owner)
+    model.update(10**25, controller.last_update_time())
+
+    # Idle gaps up to ~30 years, inside and past both bounds
+    for gap, error in [(1, -10**24), (86400, 10**26), (10**9, -10**27), (3600, 10**27)]:
+        timestamp = controller.last_update_time() + gap
+        expected = controller.fast_forward(error, timestamp)
+        assert tuple(expected) == tuple(model.fast_forward(error, timestamp).__dict__.values())
+
+        chain.pending_timestamp = timestamp
+        controller.update(error, sender=owner)
+        model.update(error, timestamp)
+        assert tuple(controller.get_state())[9:15] == tuple(expected)
+        assert_matches(controller, model)
+
+    last = controller.last_update_time()
+    with ape.reverts("PIController/wait-longer"):
+        controller.fast_forward(0, last)
+    with pytest.raises(Revert):
+        model.fast_forward(0, last)
+
+@pytest.mark.parametrize("scale", [10**3, 10**26])
+def test_batch_matches_model(scale):
+    rng = random.Random(scale)
+    n = 16
+    lanes = [dict(params, kp=rng.randint(-10**12, 10**12), ki=rng.randint(-10**18, 10**18),
+                  output_upper_bound=rng.randint(0, 10**20), output_lower_bound=rng.randint(-10**20, 0))
+             for _ in range(n)]
+    models = [PIControllerModel(**lane) for lane in lanes]
+    batch = BatchPIController(n, **{k: [lane[k] for lane in lanes] for k in params})
+
+    timestamp = 1
+    for _ in range(50):
+        timestamp += rng.choice([0, 1, 12, 3600])
+        errors = [rng.randint(-scale, scale) for _ in range(n)]
+        bounded, p_output, i_output, reverted = batch.update(errors, timestamp)
+        for lane, model in enumerate(models):
+            try:
+                expected = model.update(errors[lane], timestamp)
+            except Revert:
+                assert reverted[lane]
+            else:
+                assert not reverted[lane]
+                assert (bounded[lane], p_output[lane], i_output[lane]) == expected
+            assert batch.error_integral[lane] == model.error_integral
+
+def test_batch_bounds_fit_int128():
+    BatchPIController(2, 3, 2, 0, TWENTY_SEVEN_DECIMAL_NUMBER, 2**127 - 1, [-2**127, 0])
+    with pytest.raises(ValueError, match="output_upper_bound"):
+        BatchPIController(2, 3, 2, 0, TWENTY_SEVEN_DECIMAL_NUMBER, [10**12, 2**127], -10**12)
+    with pytest.raises(ValueError, match="output_lower_bound"):
+        BatchPIController(2, 3, 2, 0, TWENTY_SEVEN_DECIMAL_NUMBER, 10**12, -2**127 - 1)
+
+def test_batch_int64_fast_path():
+    batch = BatchPIController(4, 3, 2, 0, TWENTY_SEVEN_DECIMAL_NUMBER, 10**12, -10**12)
+    model = PIControllerModel(3, 2, 0, TWENTY_SEVEN_DECIMAL_NUMBER, 10**12, -10**12)
+    for step in range(1, 20):
+        errors = np.array([-7, 5, 0, 1000], dtype=np.int64) * step
+        batch.update(errors, step * 12)
+        model.update(int(errors[3]), step * 12)
+    assert not batch.wide
+    assert batch.error_integral[3] == model.error_integral
+
+    # A lane that could overflow int64 promotes the whole batch to exact ints
+    batch.update([2**70, 0, 0, 1000], 1000)
+    model.update(1000, 1000)
+    assert batch.wide
+    assert batch.error_integral[3] == model.error_integral
+    assert batch.last_error[0] == 2**70
@@ -1,7 +1,12 @@
+import random
+
 import ape
 import pytest
 from web3 import Web3
 
+from picontroller.model import PIControllerModel, Revert, parameters_and_mask, rpower, sdiv
+from picontroller.snapshot import decode_snapshot, read_snapshot
+
 #from ape import accounts
 
 FORTY_FIVE_DECIMAL_NUMBER   = int(10 ** 45)
@@ -17,27 +22,6 @@ per_second_integral_leak = 999997208243937652252849536 # 1% per hour
 output_upper_bound = 18640000000000000000
 output_lower_bound = -51034000000000000000
 
-imported_state = [0] * 3
-
-@pytest.fixture
-def owner(accounts):
-    return accounts[0]
-
-@pytest.fixture
-def controller(owner, project):
-    controller = owner.deploy(project.PIController, b'test control variable',
-            kp,
-            ki,
-            co_bias,
-            per_second_integral_leak,
-            output_upper_bound,
-            output_lower_bound,
-            imported_state,
-            sender=owner)
-
-    controller.modify_parameters_addr('updater',  owner, sender=owner)
-    return controller
-
 # Use this to match existing controller tests
 def assertEq(x, y):
     assert x == y
@@ -59,15 +43,41 @@ def relative_error(measured_value, reference_value):
 class TestPIController:
     def check_state(self, owner, controller):
         assertEq(controller.authorities(owner), 1);
-        assertEq(controller.output_upper_bound(), output_upper_bound);
-        assertEq(controller.output_lower_bound(), output_lower_bound);
-        assertEq(controller.last_update_time(), 0);
-        assertEq(controller.error_integral(), 0);
-        assertEq(controller.last_error(), 0);
-        assertEq(controller.per_second_integral_leak(), per_second_integral_leak);
-        assertEq(controller.kp(), kp);
-        assertEq(controller.ki(), ki);
-        assertEq(controller.elapsed(), 0);
+        state = read_snapshot(controller)
+        assertEq(state.output_upper_bound, output_upper_bound);
+        assertEq(state.output_lower_bound, output_lower_bound);
+        assertEq(state.last_update_time, 0);
+        assertEq(state.error_integral, 0);
+        assertEq(state.last_error, 0);
+        assertEq(state.per_second_integral_leak, per_second_integral_leak);
+        assertEq(state.kp, kp);
+        assertEq(state.ki, ki);
+        assertEq(state.elapsed, 0);
+
+    def test_get_state(self, owner, controller, chain):
+        controller.modify_parameters_uint("leak_cadence", update_delay, sender=owner);
+        controller.update(10**23, sender=owner);
+        chain.pending_timestamp += update_delay
+        controller.update(-10**23, sender=owner);
+        chain.mine(timestamp=controller.last_update_time() + 5)
+
+        state = read_snapshot(controller)
+        assertEq(state.control_variable, controller.control_variable());
+        assertEq((state.kp, state.ki, state.co_bias), (kp, ki, co_bias));
+        assertEq(state.output_upper_bound, controller.output_upper_bound());
+        assertEq(state.output_lower_bound, controller.output_lower_bound());
+        assertEq(state.per_second_integral_leak, per_second_integral_leak);
+        assertEq(state.leak_cadence, update_delay);
+        assertEq(state.error_integral, controller.error_integral());
+        assertEq(state.last_error, -10**23);
+        assertEq(state.last_update(), controller.last_update());
+        assertEq(state.elapsed, controller.elapsed());
+        assertEq(state.updater, owner.address);
+
+        # Raw eth_call return data decodes to the same snapshot
+        raw = controller.provider.web3.eth.call({"to": controller.address,
+                                                 "data": controller.get_state.encode_input()})
+        assertEq(decode_snapshot(raw), state);
 
     def test_contract_fixture(self, owner, controller):
         assertEq(controller.authorities(owner), 1);
@@ -104,6 +114,50 @@ class TestPIController:
         with ape.reverts("PIController/invalid-output_lower_bound"):
             controller.modify_parameters_int("output_lower_bound", controller.output_upper_bound() + 1, sender=owner);
 
+    def test_fail_modify_parameters_bound_out_of_range(self, owner, controller):
+        # Bounds are packed into one slot as two int128 values
+        with ape.reverts():
+            controller.modify_parameters_int("output_upper_bound", 2**127, sender=owner);
+        with ape.reverts():
+            controller.modify_parameters_int("output_lower_bound", -2**127 - 1, sender=owner);
+
+        controller.modify_parameters_int("output_upper_bound", 2**127 - 1, sender=owner);
+        controller.modify_parameters_int("output_lower_bound", -2**127, sender=owner);
+        assertEq(controller.output_upper_bound(), 2**127 - 1);
+        assertEq(controller.output_lower_bound(), -2**127);
+
+    def test_set_parameters(self, owner, controller, chain):
+        # Bounds entirely below the current ones: one call, where modify_parameters_int needs an order
+        controller.set_parameters(*parameters_and_mask(kp=1, ki=2, output_upper_bound=-6 * 10**19,
+                                                       output_lower_bound=-7 * 10**19, leak_cadence=update_delay),
+                                  sender=owner);
+        state = read_snapshot(controller)
+        assertEq((state.kp, state.ki, state.co_bias), (1, 2, co_bias));
+        assertEq((state.output_upper_bound, state.output_lower_bound), (-6 * 10**19, -7 * 10**19));
+        assertEq((state.per_second_integral_leak, state.leak_cadence), (per_second_integral_leak, update_delay));
+
+        # The cached leak factor follows a new leak
+        controller.set_parameters(*parameters_and_mask(per_second_integral_leak=TWENTY_SEVEN_DECIMAL_NUMBER - 5),
+                                  sender=owner);
+        assertEq(controller.per_second_integral_leak(), TWENTY_SEVEN_DECIMAL_NUMBER - 5);
+        controller.update(10**20, sender=owner);
+        chain.mine(timestamp=controller.last_update_time() + update_delay)
+        model = PIControllerModel.from_snapshot(read_snapshot(controller))
+        assertEq(controller.get_new_error_integral(0), model.get_new_error_integral(0, chain.blocks.head.timestamp));
+
+    def test_fail_set_parameters_is_atomic(self, owner, controller):
+        with ape.reverts("PIController/invalid-bounds"):
+            controller.set_parameters(*parameters_and_mask(kp=1, output_lower_bound=output_upper_bound),
+                                      sender=owner);
+        with ape.reverts("PIController/invalid-per_second_integral_leak"):
+            controller.set_parameters(*parameters_and_mask(ki=1, per_second_integral_leak=TWENTY_SEVEN_DECIMAL_NUMBER + 1),
+                                      sender=owner);
+        with ape.reverts("PIController/invalid-output_deadband"):
+            controller.set_parameters(*parameters_and_mask(kp=1, output_deadband=2**96), sender=owner);
+        with ape.reverts("PIController/modify-unrecognized-param"):
+            controller.set_parameters((1,) * 9, 512, sender=owner);
+        self.check_state(owner, controller)
+
     def test_get_next_output_zero_error(self, owner, controller):
         error = relative_error(EIGHTEEN_DECIMAL_NUMBER, TWENTY_SEVEN_DECIMAL_NUMBER);
         (pi_output,_,_) = controller.get_new_pi_output(error);
@@ -182,28 +236,20 @@ class TestPIController:
         assertEq(controller.last_error(), 2);
         assert controller.error_integral() != 0;
 
-    """
-   
-    def test_zero_integral_persists(self, owner, controller, chain):
+    def test_zero_integral_persists(self, owner, controller, warp):
         assertEq(controller.error_integral(), 0);
-        next_ts = chain.pending_timestamp + 10000000
+        warp(10000000, mine=True)
         assertEq(controller.error_integral(), 0);
-    """
-
 
-    """
-    def test_nonzero_integral_persists(self, owner, controller, chain):
+    def test_nonzero_integral_persists(self, owner, controller, warp):
         controller.update(1, sender=owner);
         controller.update(1, sender=owner);
-        chain.provider.auto_mine = False
-        chain.mine(1000, timestamp = chain.pending_timestamp + 1000*12)
+        warp(1000*12, mine=True)
 
         initial_error_integral = controller.error_integral();
         assertGt(initial_error_integral, 0)
         assertEq(initial_error_integral, controller.error_integral());
 
-    """
-
     def test_first_get_next_output(self, owner, controller):
         # negative error
         error = relative_error(int(1.01E18), TWENTY_SEVEN_DECIMAL_NUMBER);
@@ -356,8 +402,6 @@ class TestPIController:
                  error_integral3 * controller.ki()/EIGHTEEN_DECIMAL_NUMBER);
 
 
-    """
-    TODO: fix after integral leak is fixed
     def test_integral_leaks(self, owner, controller, chain):
         leak = int(0.999999999E27)
         controller.modify_parameters_uint("per_second_integral_leak", leak, sender=owner);
@@ -372,10 +416,12 @@ class TestPIController:
         assert error_integral1 < 0;
 
         # Second update
-        controller.update(error, sender=owner);
+        # An opposite error adds no area, so only the leak moves the integral
+        chain.pending_timestamp += update_delay
+        controller.update(-error, sender=owner);
         error_integral2 = controller.error_integral();
         assert error_integral2 > error_integral1;
-    """
+        assertEq(error_integral2, -(rpower(leak, update_delay + 1, 10**27) * -error_integral1 // 10**27));
 
     def test_integral_leaks2(self, owner, controller, chain):
         leak = 998721603904830360273103599
@@ -404,35 +450,178 @@ class TestPIController:
         # Third update
         controller.update(error, sender=owner);
         error_integral2 = controller.error_integral();
-        assert error_integral2 == error_integral1 + (update_delay+1)*error;
+        assert error_integral2 == (rpower(leak, update_delay+1, 10**27) * error_integral1 // 10**27
+                                   + (update_delay+1)*error);
+        assert error_integral2 < error_integral1 + (update_delay+1)*error;
+
+    def test_no_leak_at_ray(self, owner, controller, chain):
+        controller.modify_parameters_uint("per_second_integral_leak", 10**27, sender=owner);
+        controller.update(10**23, sender=owner);
+        controller.update(10**23, sender=owner);
+        error_integral1 = controller.error_integral();
+
+        chain.pending_timestamp += 10**8
+        (error_integral2, _) = controller.get_new_error_integral(-10**23);
+        assertEq(error_integral2, error_integral1);
+
+    def test_rpower_matches_reference(self, controller):
+        rng = random.Random(3)
+        cases = [(0, 0, 10**27), (0, 5, 10**27), (10**27, 0, 10**27), (per_second_integral_leak, 1, 10**27),
+                 (per_second_integral_leak, 3600, 10**27), (per_second_integral_leak, 2**64, 10**27),
+                 (per_second_integral_leak, 2**256 - 1, 10**27), (2, 10, 1)]
+        cases += [(rng.randint(0, 10**27), rng.randint(0, 2**rng.randint(1, 40)), 10**27) for _ in range(20)]
+        for x, n, base in cases:
+            assertEq(controller.rpower(x, n, base), rpower(x, n, base));
+
+    def test_rpower_overflow_reverts(self, controller):
+        with ape.reverts():
+            controller.rpower(2**200, 2, 10**27);
+
+    def test_leak_cadence_cache(self, owner, controller, chain):
+        controller.modify_parameters_uint("leak_cadence", update_delay, sender=owner);
+        assertEq(controller.leak_cadence(), update_delay);
+        assertEq(controller.per_second_integral_leak(), per_second_integral_leak);
+
+        controller.update(10**23, sender=owner);
+        controller.update(10**23, sender=owner);
+        error_integral1 = controller.error_integral();
+
+        # Cached factor on an exact cadence, rpower otherwise; both must agree with the reference
+        for elapsed in [update_delay, update_delay + 1]:
+            chain.pending_timestamp = controller.last_update_time() + elapsed
+            chain.mine()
+            (error_integral2, _) = controller.get_new_error_integral(-10**23);
+            assertEq(error_integral2, rpower(per_second_integral_leak, elapsed, 10**27) * error_integral1 // 10**27);
 
+        # Changing the leak refreshes the cached factor
+        leak = 998721603904830360273103599
+        controller.modify_parameters_uint("per_second_integral_leak", leak, sender=owner);
+        assertEq(controller.leak_cadence(), update_delay);
+        controller.update(10**23, sender=owner);
+        error_integral1 = controller.error_integral();
+        chain.pending_timestamp = controller.last_update_time() + update_delay
+        chain.mine()
+        (error_integral2, _) = controller.get_new_error_integral(-10**23);
+        assertEq(error_integral2, rpower(leak, update_delay, 10**27) * error_integral1 // 10**27);
+
+    def test_fail_leak_cadence_out_of_range(self, owner, controller):
+        with ape.reverts():
+            controller.modify_parameters_uint("leak_cadence", 2**32, sender=owner);
+
+    def test_output_deadband(self, owner, controller, chain, accounts):
+        controller.modify_parameters_uint("output_deadband", 10**18, sender=owner);
+        assertEq(controller.output_deadband(), 10**18);
+        assertEq(controller.updater(), owner.address);
+
+        controller.update(10**25, sender=owner);
+        chain.pending_timestamp += update_delay
+        controller.update(10**25, sender=owner);
+        (_, output, p_output, i_output) = controller.last_update()
+        assertEq(output, output_upper_bound);
 
-    """
-    def test_leaks_sets_integral_to_zero(self, owner, controller, chain):
-        #chain.provider.auto_mine = False
+        # Still saturated: within the deadband only the time, error and integral move
+        chain.pending_timestamp += update_delay
+        assert not controller.should_update(10**24, chain.pending_timestamp)
+        receipt = controller.update(10**24, sender=owner);
+        assertEq(len(receipt.decode_logs(controller.DeadbandUpdateEvent)), 1);
+        assertEq(controller.last_update(), (receipt.timestamp, output, p_output, i_output));
+        assertEq(controller.last_error(), 10**24);
+
+        chain.pending_timestamp += update_delay
+        assert controller.should_update(-10**26, chain.pending_timestamp)
+        receipt = controller.update(-10**26, sender=owner);
+        assertEq(len(receipt.decode_logs(controller.UpdateEvent)), 1);
+        assert controller.last_output() != output
+
+        # The updater and the deadband share a slot
+        controller.modify_parameters_addr("updater", accounts[2], sender=owner);
+        assertEq((controller.updater(), controller.output_deadband()), (accounts[2].address, 10**18));
+        controller.modify_parameters_uint("output_deadband", 0, sender=owner);
+        assertEq((controller.updater(), controller.output_deadband()), (accounts[2].address, 0));
+
+    def test_fail_output_deadband_out_of_range(self, owner, controller):
+        with ape.reverts("PIController/invalid-output_deadband"):
+            controller.modify_parameters_uint("output_deadband", 2**96, sender=owner);
+
+    def test_observations(self, owner, controller, chain):
+        assertEq(controller.observation_cardinality(), 0);
+        with ape.reverts("PIController/observation-too-old"):
+            controller.average_over(3600);
+
+        controller.modify_parameters_uint("observation_cardinality", 4, sender=owner);
+        updates = []
+        for error, delay in [(10**24, 600), (-10**24, 1200), (5 * 10**23, 3600), (-10**23, 60), (10**22, 600)]:
+            chain.pending_timestamp += delay
+            controller.update(error, sender=owner);
+            (update_time, output, _, _) = controller.last_update()
+            updates.append((update_time, output, error))
+
+        # The first of the five has left the ring of four
+        for age in range(4):
+            assertEq(controller.observation(age), updates[-1 - age]);
+        with ape.reverts("PIController/observation-too-old"):
+            controller.observation(4);
+
+        # Each output and error holds until the next update; averages round toward zero
+        (t0, o0, e0), (t1, o1, e1), (t2, _, _) = updates[-3:]
+        assertEq(controller.average_over_updates(2),
+                 (sdiv(o0 * (t1 - t0) + o1 * (t2 - t1), t2 - t0), sdiv(e0 * (t1 - t0) + e1 * (t2 - t1), t2 - t0)));
+        chain.mine(timestamp=t2 + 30)
+        assertEq(controller.average_over(20), (updates[-1][1], updates[-1][2]));
+
+        controller.modify_parameters_uint("observation_cardinality", 0, sender=owner);
+        assertEq(controller.observation_cardinality(), 0);
+        chain.pending_timestamp += 600
+        controller.update(10**24, sender=owner);
+        with ape.reverts("PIController/observation-too-old"):
+            controller.observation(0);
+        with ape.reverts("PIController/invalid-observation_cardinality"):
+            controller.modify_parameters_uint("observation_cardinality", 1025, sender=owner);
+
+    def test_fail_constructor_leak_above_ray(self, owner, project):
+        with ape.reverts("PIController/invalid-per_second_integral_leak"):
+            owner.deploy(project.PIController, b'test control variable', kp, ki, co_bias,
+                         TWENTY_SEVEN_DECIMAL_NUMBER + 1, output_upper_bound, output_lower_bound,
+                         [0] * 3, sender=owner)
+
+    def test_fail_equal_bounds(self, owner, controller, project):
+        # Equal bounds are rejected at deployment and by every setter alike
+        with ape.reverts("PIController/invalid-bounds"):
+            owner.deploy(project.PIController, b'test control variable', kp, ki, co_bias,
+                         per_second_integral_leak, output_upper_bound, output_upper_bound,
+                         [0] * 3, sender=owner)
+        with ape.reverts("PIController/invalid-output_upper_bound"):
+            controller.modify_parameters_int("output_upper_bound", output_lower_bound, sender=owner);
+        with ape.reverts("PIController/invalid-output_lower_bound"):
+            controller.modify_parameters_int("output_lower_bound", output_upper_bound, sender=owner);
+        with ape.reverts("PIController/invalid-bounds"):
+            controller.set_parameters(*parameters_and_mask(output_upper_bound=10**18, output_lower_bound=10**18),
+                                      sender=owner);
+        with pytest.raises(Revert, match="PIController/invalid-bounds"):
+            PIControllerModel(kp, ki, co_bias, per_second_integral_leak, output_upper_bound, output_upper_bound)
+        self.check_state(owner, controller)
+
+    def test_leaks_sets_integral_to_zero(self, owner, controller, warp):
         assert controller.error_integral() == 0
         controller.modify_parameters_int("kp", 1000, sender=owner);
         controller.modify_parameters_uint("per_second_integral_leak", 998721603904830360273103599,
                                         sender=owner); # -99% per hour
 
-        first_ts = chain.pending_timestamp
         # First update
-        controller.update(10**27//10000, sender=owner);
-        #chain.mine(1)
+        warp(update_delay)
+        controller.update(-10**27//10000, sender=owner);
         # Second update
-        controller.update(10**27//10000, sender=owner);
-        #chain.mine(1)
+        warp(update_delay)
+        controller.update(-10**27//10000, sender=owner);
         # Third update
-        controller.update(10**27//10000, sender=owner);
-        #chain.mine(1)
-        last_ts = chain.pending_timestamp
+        warp(update_delay)
+        controller.update(-10**27//10000, sender=owner);
 
         error_integral1 = controller.error_integral()
-        assert error_integral1 > 0;
+        assert error_integral1 < 0;
 
-        #chain.provider.auto_mine = False
-        blocktime = 1
-        chain.mine(360000, timestamp = chain.pending_timestamp + 360000*blocktime)
+        # Final update
+        warp(update_delay * 100, mine=True)
         error = relative_error(int(10**18), int(10**27));
         assert error == 0;
 
@@ -440,14 +629,9 @@ class TestPIController:
         assert p_output == 0;
 
         controller.update(error, sender=owner);
-        error_integral2 = controller.error_integral()
-        assert error_integral2 < error_integral1;
-
-        chain.mine(360000, timestamp = chain.pending_timestamp + 360000*blocktime)
+        warp(update_delay * 100)
         controller.update(error, sender=owner);
-        last_ts = chain.pending_timestamp
         assert controller.error_integral() == 0;
-    """
 
 
     def test_update_prate(self, owner, controller, chain):
@@ -780,85 +964,41 @@ class TestPIController:
         assertEq(controller.error_integral(), error * 3 * update_delay + 3*error);
 
 
-"""
-    }
-    function test_leak_sets_integral_to_zero() public {
-        assertEq(uint(controller.error_integral()), 0);
-
-        controller.modify_parameters("kp", int(1000));
-        controller.modify_parameters("per_second_integral_leak", uint(998721603904830360273103599)); // -99% per hour
-        //controller.modify_parameters("per_second_integral_leak", uint(0.95E27)); // -99% per hour
-
-        // First update
-        hevm.warp(now + update_delay);
-        (int output, int p_output, int i_output) = controller.update(-0.0001E27);
-        //assert(controller.error_integral() == 0);
-
-        // Second update
-        hevm.warp(now + update_delay);
-        (pi_output, p_output, i_output) = controller.update(-0.0001E27);
-        //assert(controller.error_integral() == 0);
-
-        // Third update
-        hevm.warp(now + update_delay);
-        (pi_output, i_output, p_output) = controller.update(-0.0001E27);
-
-        assert(controller.error_integral() < 0);
-
-        // Final update
-        hevm.warp(now + update_delay * 100);
-
-        int256 error = relative_error(1E18, 1E27);
-        assertEq(error, 0);
-
-        (pi_output, p_output, i_output) =
-          controller.get_new_pi_output(error);
-        assertEq(p_output, 0);
-
-        (pi_output, p_output, i_output) = controller.update(error);
-        hevm.warp(now + update_delay * 100);
-        (pi_output, p_output, i_output) = controller.update(error);
-        assertEq(controller.error_integral(), 0);
+    def test_get_next_error_integral_leak(self, owner, controller, chain, warp):
+        leak = int(0.95E27)
+        controller.modify_parameters_int("kp", int(2.25E11), sender=owner);
+        controller.modify_parameters_int("ki", int(7.2E4), sender=owner);
+        controller.modify_parameters_uint("per_second_integral_leak", leak, sender=owner);
+        warp(update_delay)
 
-    }
-    function test_get_next_error_integral_leak() public {
-        controller.modify_parameters("updater", address(this));
-        controller.modify_parameters("kp", int(2.25E11));
-        controller.modify_parameters("ki", int(7.2E4));
-        controller.modify_parameters("per_second_integral_leak", uint(0.95E27));
-        hevm.warp(now + update_delay);
-
-        // First update doesn't create an integral or output contribution
-        // as elapsed time is set to 0
-        int256 error = relative_error(1.01E18, 1.00E27);
-        (int256 new_integral, int256 new_area) = controller.getNewErrorIntegral(error);
+        # First update doesn't create an integral or output contribution
+        # as elapsed time is set to 0
+        error = relative_error(int(1.01E18), 10**27);
+        (new_integral, new_area) = controller.get_new_error_integral(error);
         assertEq(new_integral, 0);
         assertEq(new_area, 0);
-        controller.update(error);
+        controller.update(error, sender=owner);
         assertEq(controller.error_integral(), new_integral);
 
-        hevm.warp(now + update_delay);
-
-        // Second update
-        int error2 = relative_error(1.01E18, 1.00E27);
-        (int new_integral2, int new_area2) = controller.getNewErrorIntegral(error2);
-        assertEq(new_integral2, error2 * int(update_delay));
-        assertEq(new_area2, error2 * int(update_delay));
-
-        controller.update(error2);
-        assertEq(controller.error_integral(), new_integral2);
+        # Second update. The view is read at the mined block, the update lands
+        # in the next one, a second later
+        warp(update_delay - 1, mine=True)
+        error2 = relative_error(int(1.01E18), 10**27);
+        (new_integral2, new_area2) = controller.get_new_error_integral(error2);
+        assertEq(new_integral2, error2 * update_delay);
+        assertEq(new_area2, error2 * update_delay);
+        controller.update(error2, sender=owner);
+        assertEq(controller.error_integral(), error2 * (update_delay + 1));
+        new_integral2 = controller.error_integral()
 
-        hevm.warp(now + update_delay);
+        warp(update_delay - 1, mine=True)
 
-        // Third update
-        int error3 = relative_error(1.00E18, 1.00E27);
+        # Third update
+        error3 = relative_error(int(1.00E18), 10**27);
         assertEq(error3, 0);
-        (int new_integral3, int new_area3) = controller.getNewErrorIntegral(error3);
-        assertEq(new_area3, (error2 + error3)/2 * int(update_delay));
-        assert(new_integral3 -new_area3 > new_integral2);
-        controller.update(error3);
-        assertEq(controller.error_integral(), new_integral3);
-
-    }
-
-"""
+        (new_integral3, new_area3) = controller.get_new_error_integral(error3);
+        assertEq(new_area3, (error2 + error3)//2 * update_delay);
+        assertEq(new_integral3 - new_area3, rpower(leak, update_delay, 10**27) * new_integral2 // 10**27);
+        assertGt(new_integral3 - new_area3, new_integral2);
+        controller.update(error3, sender=owner);
+        assertEq(controller.error_integral(), (error2 + error3)//2 * (update_delay + 1));
@@ -0,0 +1,183 @@
+import random
+from dataclasses import replace
+
+import ape
+import pytest
+
+from picontroller.indexer import ControllerIndexer
+from picontroller.mirror import ControllerMirror
+from picontroller.model import PIControllerModel
+from picontroller.snapshot import read_snapshot
+
+kp = 222002205862
+ki = int(10 ** 18)
+co_bias = 0
+per_second_integral_leak = 999997208243937652252849536
+output_upper_bound = 18640000000000000000
+output_lower_bound = -51034000000000000000
+update_delay = 3600
+
+ids = [b'rate-%d' % k for k in range(4)]
+
+def lane_params(k):
+    # Distinct gains and bounds per controller
+    return dict(kp=kp * (k + 1), ki=ki // (k + 1), co_bias=k * 10**18,
+                per_second_integral_leak=per_second_integral_leak,
+                output_upper_bound=output_upper_bound * (k + 1),
+                output_lower_bound=output_lower_bound * (k + 1))
+
+@pytest.fixture(scope="module")
+def registry(owner, project):
+    registry = owner.deploy(project.PIControllerRegistry, sender=owner)
+    for k, id in enumerate(ids):
+        p = lane_params(k)
+        registry.add_controller(id, p["kp"], p["ki"], p["co_bias"], p["per_second_integral_leak"],
+                                p["output_upper_bound"], p["output_lower_bound"], [0] * 3, sender=owner)
+        registry.modify_parameters_addr(id, 'updater', owner, sender=owner)
+    return registry
+
+def test_add_controller(owner, registry):
+    for k, id in enumerate(ids):
+        p = lane_params(k)
+        assert registry.registered(id)
+        assert registry.authorities(id, owner) == 1
+        assert registry.kp(id) == p["kp"]
+        assert registry.output_upper_bound(id) == p["output_upper_bound"]
+        assert registry.output_lower_bound(id) == p["output_lower_bound"]
+        assert registry.per_second_integral_leak(id) == per_second_integral_leak
+        assert registry.updater(id) == owner
+
+    with ape.reverts("PIControllerRegistry/already-registered"):
+        registry.add_controller(ids[0], kp, ki, co_bias, per_second_integral_leak,
+                                output_upper_bound, output_lower_bound, [0] * 3, sender=owner)
+
+def test_only_the_admin_registers(owner, registry, accounts):
+    other = accounts[1]
+    assert registry.admin() == owner
+    with ape.reverts("PIControllerRegistry/not-the-admin"):
+        registry.add_controller(b'rate-9', kp, ki, co_bias, per_second_integral_leak,
+                                output_upper_bound, output_lower_bound, [0] * 3, sender=other)
+    with ape.reverts("PIControllerRegistry/not-the-admin"):
+        registry.set_admin(other, sender=other)
+
+    registry.set_admin(other, sender=owner)
+    registry.add_controller(b'rate-9', kp, ki, co_bias, per_second_integral_leak,
+                            output_upper_bound, output_lower_bound, [0] * 3, sender=other)
+    assert registry.authorities(b'rate-9', other) == 1
+    with ape.reverts("PIControllerRegistry/not-the-admin"):
+        registry.add_controller(b'rate-10', kp, ki, co_bias, per_second_integral_leak,
+                                output_upper_bound, output_lower_bound, [0] * 3, sender=owner)
+
+def test_update_many_matches_model(owner, registry, chain):
+    rng = random.Random(6)
+    models = [PIControllerModel(**lane_params(k)) for k in range(len(ids))]
+
+    for _ in range(10):
+        chain.pending_timestamp += rng.choice([1, 12, update_delay])
+        errors = [rng.randint(-10**26, 10**26) for _ in ids]
+        registry.update_many(ids, errors, sender=owner)
+        timestamp = chain.blocks.head.timestamp
+
+        for id, model, error in zip(ids, models, errors):
+            model.update(error, timestamp)
+            assert registry.error_integral(id) == model.error_integral
+            assert registry.last_error(id) == model.last_error
+            assert registry.last_update(id) == model.last_update()
+
+def test_get_state(owner, registry):
+    registry.update(ids[3], 10**25, sender=owner)
+    state = read_snapshot(registry, ids[3])
+    assert state.control_variable == ids[3].ljust(32, b'\0')
+    assert state.kp == lane_params(3)["kp"]
+    assert state.output_lower_bound == lane_params(3)["output_lower_bound"]
+    assert state.last_update() == registry.last_update(ids[3])
+    assert state.updater == owner.address
+
+def test_update_many_subset(owner, registry, chain):
+    registry.update_many([ids[2]], [10**25], sender=owner)
+    assert registry.last_error(ids[2]) == 10**25
+    assert registry.last_update_time(ids[0]) == 0
+
+    (bounded, p_output, i_output) = registry.get_new_pi_output(ids[1], 10**25)
+    registry.update(ids[1], 10**25, sender=owner)
+    assert registry.last_update(ids[1])[1:] == (bounded, p_output, i_output)
+
+def test_what_if(owner, registry, chain):
+    registry.update_many(ids, [10**25] * len(ids), sender=owner)
+    last = registry.last_update_time(ids[0])
+    model = PIControllerModel(**lane_params(1))
+    model.update(10**25, last)
+
+    queries = [(10**24, last + 1), (-10**25, last + update_delay)]
+    outputs = registry.get_new_pi_outputs(ids[1], queries)
+    assert [tuple(output) for output in outputs] == model.get_new_pi_outputs(queries)
+
+def test_update_many_reverts_as_a_whole(owner, registry, chain, accounts):
+    registry.modify_parameters_addr(ids[3], 'updater', accounts[1], sender=owner)
+    with ape.reverts("PIController/invalid-msg-sender"):
+        registry.update_many(ids, [1] * len(ids), sender=owner)
+    assert registry.last_update_time(ids[0]) == 0
+
+    registry.update_many(ids[:2], [1, 1], sender=owner)
+    with ape.reverts("PIController/wait-longer"):
+        registry.update_many(ids[:2] + ids[:1], [1, 1, 1], sender=owner)
+
+    with ape.reverts("PIControllerRegistry/length-mismatch"):
+        registry.update_many(ids[:2], [1], sender=owner)
+
+def test_authorities_per_controller(owner, registry, accounts):
+    other = accounts[1]
+    with ape.reverts("PIControllerRegistry/not-an-authority"):
+        registry.modify_parameters_int(ids[0], "kp", 1, sender=other)
+
+    registry.add_authority(ids[0], other, sender=owner)
+    registry.modify_parameters_int(ids[0], "kp", 1, sender=other)
+    assert registry.kp(ids[0]) == 1
+    with ape.reverts("PIControllerRegistry/not-an-authority"):
+        registry.modify_parameters_int(ids[1], "kp", 1, sender=other)
+
+    registry.remove_authority(ids[0], other, sender=owner)
+    with ape.reverts("PIControllerRegistry/not-an-authority"):
+        registry.modify_parameters_uint(ids[0], "per_second_integral_leak", 10**27, sender=other)
+
+def test_modify_parameters(owner, registry):
+    registry.modify_parameters_int(ids[0], "output_upper_bound", 10**20, sender=owner)
+    registry.modify_parameters_int(ids[0], "output_lower_bound", -10**20, sender=owner)
+    assert registry.output_upper_bound(ids[0]) == 10**20
+    assert registry.output_lower_bound(ids[0]) == -10**20
+    assert registry.output_upper_bound(ids[1]) == output_upper_bound * 2
+
+    with ape.reverts("PIController/invalid-output_upper_bound"):
+        registry.modify_parameters_int(ids[0], "output_upper_bound", -10**20, sender=owner)
+    with ape.reverts("PIController/modify-unrecognized-param"):
+        registry.modify_parameters_int(ids[0], "bogus", 1, sender=owner)
+
+    registry.modify_parameters_uint(ids[0], "leak_cadence", update_delay, sender=owner)
+    assert registry.leak_cadence(ids[0]) == update_delay
+    assert registry.per_second_integral_leak(ids[0]) == per_second_integral_leak
+
+def test_indexer_and_mirror_follow_an_entry(owner, registry, chain):
+    # Events of the other entries carry another id, so neither picks them up
+    rng = random.Random(13)
+    web3 = chain.provider.web3
+    start = chain.blocks.head.number
+    mirror = ControllerMirror(web3, registry.address, check_every=0, id=ids[1])
+    states = []
+    for k in range(12):
+        chain.pending_timestamp += rng.choice([1, 12, update_delay])
+        if k % 4 == 3:
+            registry.modify_parameters_int(ids[1], "ki", rng.randint(0, 10**18), sender=owner)
+        elif k % 5 == 4:
+            registry.modify_parameters_uint(ids[1], "leak_cadence", update_delay, sender=owner)
+        else:
+            registry.update_many(ids, [rng.randint(-10**25, 10**25) for _ in ids], sender=owner)
+        states.append((chain.blocks.head.timestamp, replace(read_snapshot(registry, ids[1]), elapsed=0)))
+
+    indexer = ControllerIndexer(web3, registry.address, start, chunk_size=4, id=ids[1])
+    assert indexer.backfill() == 12
+    for timestamp, state in states:
+        assert indexer.state_at(timestamp) == state
+
+    mirror.poll()
+    assert mirror.state == states[-1][1]
+    assert not mirror.check_drift()
@@ -0,0 +1,142 @@
+import asyncio
+import json
+
+import pytest
+from eth_abi import encode
+from eth_account import Account
+from web3 import AsyncWeb3
+from web3.providers.eth_tester import AsyncEthereumTesterProvider
+
+from picontroller.evm import compile_vyper, encode_call
+from picontroller.fuzz import CONSTRUCTOR_TYPES
+from picontroller.model import PIControllerModel, RAY
+from picontroller.replay import EthTesterNode, Replay, read_errors
+from picontroller.snapshot import decode_snapshot
+from picontroller.trace import FIELDS, Trace
+
+# eth-tester funds the account of private key 1
+account = Account.from_key((1).to_bytes(32, "big"))
+
+kp = 222002205862
+ki = 10**18
+deadband = 10**15
+
+async def transact(w3, tx):
+    tx = dict(tx, nonce=await w3.eth.get_transaction_count(account.address), gas=5_000_000,
+              gasPrice=await w3.eth.gas_price, chainId=await w3.eth.chain_id, value=0)
+    tx_hash = await w3.eth.send_raw_transaction(account.sign_transaction(tx).raw_transaction)
+    return await w3.eth.wait_for_transaction_receipt(tx_hash)
+
+async def deploy(w3):
+    args = encode(CONSTRUCTOR_TYPES, [b'replay', kp, ki, 0, RAY, 18640000000000000000, -51034000000000000000,
+                                      [0, 0, 0]])
+    address = (await transact(w3, dict(data=compile_vyper()[0] + args)))["contractAddress"]
+    await transact(w3, dict(to=address, data=encode_call("modify_parameters_addr(string,address)",
+                                                         "updater", account.address)))
+    await transact(w3, dict(to=address, data=encode_call("modify_parameters_uint(string,uint256)",
+                                                         "output_deadband", deadband)))
+    raw = await w3.eth.call(dict(to=address, data=encode_call("get_state()")))
+    return address, PIControllerModel.from_snapshot(decode_snapshot(raw))
+
+def write_series(path, start, n):
+    # Small errors stay within the deadband, large ones move the output
+    with open(path, "w") as f:
+        f.write("timestamp,error\n")
+        for k in range(n):
+            error = (-1) ** k * (10**21 if k % 3 else 10**24) * (k + 1)
+            f.write(f"{start + 600 * k + 37 * (k % 5)},{error}\n")
+    return list(read_errors(path))
+
+def expected(model, records):
+    rows = []
+    for timestamp, error in records:
+        model.update(error, timestamp)
+        s = model.state
+        rows.append((timestamp, error, s.error_integral, s.last_output, s.last_p_output, s.last_i_output))
+    return rows
+
+def rows(path):
+    trace = Trace(path)
+    return list(zip(*(trace.ints(name) for name in FIELDS)))
+
+def test_replay_matches_model(tmp_path):
+    async def main():
+        w3 = AsyncWeb3(AsyncEthereumTesterProvider())
+        controller, model = await deploy(w3)
+        start = (await w3.eth.get_block("latest"))["timestamp"] + 3600
+        records = write_series(tmp_path / "errors.csv", start, 30)
+
+        replay = Replay(w3, EthTesterNode(w3), account, controller, tmp_path / "replay.trace", batch_size=8)
+        summary = await replay.run(read_errors(tmp_path / "errors.csv"))
+        assert summary["replayed"] == summary["records"] == 30 and summary["recovered"] == 0
+
+        want = expected(model, records)
+        assert rows(tmp_path / "replay.trace") == want
+        # Both kinds of update were replayed
+        moved = [a[3] != b[3] for a, b in zip(want, want[1:])]
+        assert any(moved) and not all(moved)
+        blocks = [(await w3.eth.get_block(n))["timestamp"] for n in range(await w3.eth.block_number + 1)]
+        assert {timestamp for timestamp, _ in records} <= set(blocks)
+
+        # Automine is back on
+        await transact(w3, dict(to=controller, data=encode_call("get_state()")))
+
+    asyncio.run(main())
+
+def test_replay_resumes(tmp_path):
+    async def main():
+        w3 = AsyncWeb3(AsyncEthereumTesterProvider())
+        controller, model = await deploy(w3)
+        start = (await w3.eth.get_block("latest"))["timestamp"] + 3600
+        records = write_series(tmp_path / "errors.csv", start, 24)
+        output = tmp_path / "replay.trace"
+
+        node = EthTesterNode(w3)
+        await Replay(w3, node, account, controller, output, batch_size=5).run(records[:10])
+        checkpoint = json.loads((tmp_path / "replay.trace.checkpoint").read_text())
+        assert checkpoint["records"] == 10 and checkpoint["last_update_time"] == records[9][0]
+
+        # Stopped after mining three more updates but before writing them
+        await node.set_automine(False)
+        for timestamp, error in records[10:13]:
+            tx = dict(to=controller, data=encode_call("update(int256)", error), value=0, gas=200_000,
+                      maxFeePerGas=10**10, maxPriorityFeePerGas=10**9, chainId=await w3.eth.chain_id,
+                      nonce=await w3.eth.get_transaction_count(account.address))
+            await w3.eth.send_raw_transaction(account.sign_transaction(tx).raw_transaction)
+            await node.mine(timestamp)
+        await node.set_automine(True)
+        # ... and after flushing records the checkpoint does not cover
+        with open(output, "ab") as f:
+            f.write(bytes(168))
+
+        summary = await Replay(w3, node, account, controller, output, batch_size=5).run(
+            read_errors(tmp_path / "errors.csv"))
+        assert summary["recovered"] == 3 and summary["replayed"] == 11 and summary["records"] == 24
+        assert rows(output) == expected(model, records)
+
+    asyncio.run(main())
+
+def test_resume_needs_the_checkpointed_output(tmp_path):
+    async def main():
+        w3 = AsyncWeb3(AsyncEthereumTesterProvider())
+        controller, _ = await deploy(w3)
+        start = (await w3.eth.get_block("latest"))["timestamp"] + 3600
+        records = write_series(tmp_path / "errors.csv", start, 6)
+        output = tmp_path / "replay.trace"
+        node = EthTesterNode(w3)
+        await Replay(w3, node, account, controller, output, batch_size=5).run(records)
+        data = output.read_bytes()
+
+        # Rotated away, cut short, or replaced by something else: nothing is truncated or rewritten
+        for broken in (None, data[:len(data) - 1], b"not a trace file"):
+            if broken is None:
+                output.unlink()
+            else:
+                output.write_bytes(broken)
+            with pytest.raises(ValueError, match="replay.trace"):
+                await Replay(w3, node, account, controller, output).run(records)
+            assert output.exists() == (broken is not None)
+            if broken is not None:
+                assert output.read_bytes() == broken
+
+    asyncio.run(main())
@@ -0,0 +1,114 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+from picontroller.keeper import MockRelayerSource
+from picontroller.model import PIControllerModel
+from picontroller.system import (ConstantMarket, LoopSimulator, MarketModel, MeanRevertingMarket, RandomWalkMarket,
+                                 RecordedMarket)
+
+params = dict(kp=[222002205862, 10 * 222002205862, 0], ki=25000, co_bias=0,
+              per_second_integral_leak=999997208243937652252849536,
+              output_upper_bound=18640000000000000000, output_lower_bound=-51034000000000000000)
+
+def lane(k):
+    return {name: value[k] if isinstance(value, list) else value for name, value in params.items()}
+
+def test_matches_model_and_relayer():
+    sim = LoopSimulator(3, market=RandomWalkMarket(0.5), update_every=300, noise_barrier=10**15, **params)
+    result = sim.run(300 * 50)
+    assert result.market.shape == (50, 3)
+
+    for k in range(3):
+        model = PIControllerModel(**lane(k))
+        source = MockRelayerSource(lambda controller, timestamp: int(result.market[u, k] * 10**18),
+                                   noise_barrier=10**15)
+        for u, timestamp in enumerate(result.timestamps):
+            error = asyncio.run(source.error(k, int(timestamp)))
+            (output, _, _) = model.update(error, int(timestamp))
+            asyncio.run(source.on_update(k, int(timestamp), output))
+            assert result.output[u, k] == float(output)
+            assert result.redemption[u, k] == float(source.relayers[k][0]) / float(10**27)
+        assert sim.controller.error_integral[k] == model.error_integral
+        assert sim.redemption_rate[k] == source.relayers[k][1]
+
+def test_relay_matches_mock_rate_setter():
+    # MockPIRateSetterNew.getBoundedRedemptionRate, taken from the Solidity source:
+    # output <= -RAY gives NEGATIVE_RATE_LIMIT (RAY - 1), (-RAY, -(RAY - 1)] gives 1
+    RAY = 10**27
+    sim = LoopSimulator(1, market=ConstantMarket(), noise_barrier=10, **lane(0))
+    outputs = [-2 * RAY, -RAY - 1, -RAY, -RAY + 1, -RAY + 2, -11, -10, 0, 10, 11, 10**26]
+    rates = [RAY - 1, RAY - 1, RAY - 1, 1, 2, RAY - 11, RAY, RAY, RAY, RAY + 11, RAY + 10**26]
+    assert list(sim._relay(np.array(outputs, dtype=object))) == rates
+
+def test_lower_bound_past_ray():
+    # Outputs pinned at bounds of -2 RAY and -(RAY - 1) relay RAY - 1 and 1
+    RAY = 10**27
+    sim = LoopSimulator(2, market=ConstantMarket(), update_every=300, kp=0, ki=0, co_bias=-3 * RAY,
+                        per_second_integral_leak=RAY, output_upper_bound=10**20,
+                        output_lower_bound=[-2 * RAY, -RAY + 1])
+    result = sim.run(300)
+    assert list(result.output[-1]) == [float(-2 * RAY), float(-RAY + 1)]
+    assert list(sim.redemption_rate) == [RAY - 1, 1]
+
+def test_redemption_price_overflow_halts_the_lane():
+    # A rate of RAY + 2**126 overflows rpower over the second interval; MockOracleRelayer
+    # reverts there and at every later update, so that lane stays as it was
+    RAY = 10**27
+    sim = LoopSimulator(2, market=ConstantMarket(), update_every=300, kp=0, ki=0, co_bias=[2**126, 0],
+                        per_second_integral_leak=RAY, output_upper_bound=2**127 - 1, output_lower_bound=-RAY)
+    result = sim.run(300 * 4)
+    assert list(result.halted) == [True, False]
+    assert sim.redemption_price[0] == RAY and sim.redemption_rate[0] == RAY + 2**126
+    assert sim.controller.last_update_time[0] == result.timestamps[0]
+    assert sim.controller.last_update_time[1] == result.timestamps[-1]
+    assert list(result.output[:, 0]) == [float(2**126)] * 4
+
+def test_saturates_at_lower_bound():
+    # A market stuck above redemption: the rate goes negative, the redemption
+    # price falls further away and the output ends up pinned at the lower bound
+    sim = LoopSimulator(2, market=ConstantMarket(1.01), update_every=3000, **params | dict(kp=222002205862))
+    result = sim.run(300 * 24 * 365)
+    upper, lower = result.saturated_fraction()
+    assert list(upper) == [0, 0] and 0.5 < lower[0] == lower[1] < 1
+    assert result.output[-1, 0] == params["output_lower_bound"]
+    assert result.redemption[-1, 0] < result.redemption[0, 0] == 1
+
+def test_mean_reverting_path():
+    market = MeanRevertingMarket(half_life=60, volatility=0.8)
+    market.reset(4, 12, np.random.default_rng(3))
+    log_redemption = np.cumsum(np.full((4, 500), 1e-7), axis=1)
+    path = market.path(log_redemption)
+
+    # The same recursion one block at a time
+    a = 0.5 ** (12 / 60)
+    sigma = 0.8 * np.sqrt(12 / (365 * 24 * 3600))
+    noise = np.random.default_rng(3).normal(0, sigma, (4, 500))
+    x = np.zeros(4)
+    for t in range(500):
+        x = a * x + (1 - a) * log_redemption[:, t] + noise[:, t]
+        assert np.allclose(path[:, t], x, rtol=0, atol=1e-12)
+    assert np.allclose(market.log_price, x)
+
+def test_mean_reversion_tracks_redemption():
+    kwargs = dict(market=None, update_every=300, **params | dict(kp=222002205862))
+    walk = LoopSimulator(8, **kwargs | dict(market=RandomWalkMarket(0.5))).run(300 * 200)
+    reverting = LoopSimulator(8, **kwargs | dict(market=MeanRevertingMarket(3600, 0.5))).run(300 * 200)
+    assert reverting.max_deviation.max() < walk.max_deviation.min()
+
+def test_recorded_market():
+    prices = 1 + 0.01 * np.sin(np.arange(3000) / 100)
+    sim = LoopSimulator(2, market=RecordedMarket(prices), update_every=300, **params | dict(kp=222002205862))
+    result = sim.run(3000)
+    assert np.allclose(result.market[:, 0], prices[299::300])
+    assert np.array_equal(result.output[:, 0], result.output[:, 1])
+    with pytest.raises(ValueError):
+        sim.run(300)
+
+def test_market_model_must_implement_path():
+    class Flat(MarketModel):
+        pass
+
+    with pytest.raises(TypeError):
+        Flat()
@@ -0,0 +1,79 @@
+import random
+
+import pytest
+
+from picontroller.model import MAX_INT256, MIN_INT256, PIControllerModel
+from picontroller.trace import FIELDS, Trace, TraceWriter
+
+params = dict(kp=222002205862, ki=10**18, co_bias=0, per_second_integral_leak=999997208243937652252849536,
+              output_upper_bound=18640000000000000000, output_lower_bound=-51034000000000000000)
+
+def run(path, n, chunk_size, perturb=None):
+    rng = random.Random(11)
+    model = PIControllerModel(**params)
+    timestamp = 1_700_000_000
+    records = []
+    with TraceWriter(path, chunk_size=chunk_size) as writer:
+        for k in range(n):
+            timestamp += rng.choice([1, 12, 3600])
+            error = rng.randint(-10**25, 10**25)
+            if k == perturb:
+                error += 10**20
+            output = model.update(error, timestamp)
+            records.append((timestamp, error, model.error_integral) + output)
+            writer.append(*records[-1])
+    return records
+
+def test_round_trip(tmp_path):
+    records = run(tmp_path / "trace.bin", 100, chunk_size=7)
+    trace = Trace(tmp_path / "trace.bin")
+    assert len(trace) == 100
+    for k, name in enumerate(FIELDS):
+        assert trace.ints(name) == [record[k] for record in records]
+    assert trace.ints("error", 10, 12) == [records[10][1], records[11][1]]
+    assert trace["error"].shape == (100, 4)
+
+def test_extremes_and_append(tmp_path):
+    path = tmp_path / "trace.bin"
+    with TraceWriter(path) as writer:
+        writer.append(1, MIN_INT256, MAX_INT256, -1, 0, 1)
+    with TraceWriter(path) as writer:
+        assert len(writer) == 1
+        writer.append(2, -5, 5, 2**64, -2**64, 2**63 - 1)
+
+    trace = Trace(path)
+    assert trace.ints("timestamp") == [1, 2]
+    assert trace.ints("error") == [MIN_INT256, -5]
+    assert trace.ints("error_integral") == [MAX_INT256, 5]
+    assert trace.ints("bounded_output") == [-1, 2**64]
+    assert list(trace.int64("i_output")) == [1, 2**63 - 1]
+    with pytest.raises(ValueError):
+        trace.int64("p_output")
+
+def test_chunked_writes(tmp_path):
+    path = tmp_path / "trace.bin"
+    writer = TraceWriter(path, chunk_size=4)
+    for k in range(6):
+        writer.append(k, k, k, k, k, k)
+    # Only the full chunk has reached the file
+    assert len(Trace(path)) == 4
+    writer.close()
+    assert len(Trace(path)) == 6
+
+def test_mismatches(tmp_path):
+    run(tmp_path / "a.bin", 50, chunk_size=16)
+    run(tmp_path / "b.bin", 50, chunk_size=16, perturb=30)
+    a, b = Trace(tmp_path / "a.bin"), Trace(tmp_path / "b.bin")
+    assert list(a.mismatches(b, "timestamp")) == []
+    assert list(a.mismatches(b, "error")) == [30]
+    assert list(a.mismatches(b, "p_output")) == [30]
+
+def test_rejects_other_files(tmp_path):
+    path = tmp_path / "trace.csv"
+    path.write_bytes(b"timestamp,error\n")
+    with pytest.raises(ValueError):
+        Trace(path)
+    with pytest.raises(ValueError):
+        TraceWriter(path)
+    with TraceWriter(tmp_path / "empty.bin"):
+        assert len(Trace(tmp_path / "empty.bin")) == 0
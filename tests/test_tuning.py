@@ -0,0 +1,36 @@
+from picontroller.model import PIControllerModel
+from picontroller.system import MeanRevertingMarket
+from picontroller.tuning import DEFAULTS, evaluate, format_call, grid, parameter_calls, tune
+
+blocks = 300 * 24 * 5
+
+def test_grid():
+    configs = grid(kp=[1, 2], output_upper_bound=[-10**20, 10**19])
+    assert [(c["kp"], c["output_upper_bound"]) for c in configs] == [(1, 10**19), (2, 10**19)]
+    assert configs[0]["per_second_integral_leak"] == DEFAULTS["per_second_integral_leak"]
+
+def test_metrics():
+    weak, strong, saturating = grid(kp=[10**9, 2 * 10**12, 10**15])
+    market = MeanRevertingMarket(half_life=24 * 3600, volatility=0, premium=0.05, rate_sensitivity=1)
+    metrics = evaluate([weak, strong, saturating], market, blocks)
+    # Too weak to ever offset the premium; strong enough to hold it in the band
+    assert list(metrics["settling"][:2]) == [1, 0]
+    assert metrics["saturated"][1] == 0 and metrics["overshoot"][1] == 0
+    # Too strong: bang-bang between the bounds, overshooting every time
+    assert metrics["saturated"][2] == 1 and metrics["settling"][2] == 1 and metrics["overshoot"][2] > 1
+
+def test_tune_ranks_and_calls():
+    configs = grid(kp=[10**9, 2 * 10**12], ki=[0, 10**5])
+    rows = tune(configs, blocks=blocks, workers=1, chunk_size=3)
+    assert len(rows) == 4
+    assert rows[0]["kp"] == 2 * 10**12 and rows[-1]["kp"] == 10**9
+    assert [row["score"] for row in rows] == sorted(row["score"] for row in rows)
+
+    # Bounds entirely below the current ones apply in one call
+    model = PIControllerModel(**{k: v for k, v in DEFAULTS.items()}, co_bias=0)
+    best = dict(rows[0], output_upper_bound=-6 * 10**19, output_lower_bound=-7 * 10**19)
+    calls = parameter_calls(best)
+    for name, kwargs in calls:
+        getattr(model, name)(**kwargs)
+    assert (model.kp, model.output_upper_bound, model.output_lower_bound) == (2 * 10**12, -6 * 10**19, -7 * 10**19)
+    assert format_call(*calls[0]).startswith("set_parameters(parameters=(2000000000000, ")